@@ -0,0 +1,2 @@
+# Benchmarks for the plugin, run them from your limnoria plugins/ directory.
+# e.g. python -m WeatherBot.benchmarks.cache_contention
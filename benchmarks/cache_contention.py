@@ -0,0 +1,64 @@
+import argparse
+import random
+import threading
+import time
+from typing import List
+
+from ..utils.cache import StripedTTLCache
+
+
+def run(stripes: int, threads: int, operations: int, keys: int, write_ratio: float) -> float:
+    """
+    Hammers a cache from many threads at once with a mix of reads and writes.
+
+    Args:
+        stripes: The number of lock stripes of the cache. 1 is a single global lock.
+        threads: The number of threads using the cache at the same time.
+        operations: The number of operations each thread makes.
+        keys: The number of distinct keys used.
+        write_ratio: The share of operations that are writes.
+
+    Returns:
+        The number of operations per second across all threads.
+    """
+    cache = StripedTTLCache(maxsize=keys, ttl=900, stripes=stripes)
+    start = threading.Barrier(threads + 1)
+
+    def worker(seed: int) -> None:
+        rand = random.Random(seed)
+        queries: List[str] = [f"{rand.randrange(keys)}" for _ in range(operations)]
+        writes: List[bool] = [rand.random() < write_ratio for _ in range(operations)]
+        start.wait()
+        for query, write in zip(queries, writes):
+            if write:
+                cache[query] = query
+            else:
+                cache.get(query)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    start.wait()
+    began: float = time.perf_counter()
+    for thread in workers:
+        thread.join()
+
+    return threads * operations / (time.perf_counter() - began)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Lock contention benchmark for StripedTTLCache.")
+    parser.add_argument("--stripes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--operations", type=int, default=50000)
+    parser.add_argument("--keys", type=int, default=4096)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    for stripes in args.stripes:
+        ops: float = run(stripes, args.threads, args.operations, args.keys, args.write_ratio)
+        print(f"stripes={stripes:<3} threads={args.threads:<3} {ops:>12,.0f} ops/s")
+
+
+if __name__ == "__main__":
+    main()
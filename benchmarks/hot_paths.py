@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+from contextlib import contextmanager
+from os.path import abspath, dirname, join
+from typing import Callable, Dict, Iterator, List, Tuple
+from unittest import mock
+
+from peewee import SqliteDatabase
+
+from ..models.users import User, UserSchema
+from ..test_responses import weather_response
+from ..utils import users
+from ..utils.cache import StripedTTLCache
+from ..utils.snapshot import WeatherSnapshot
+from ..utils.templates import compile_template, default_template
+from ..utils.users import UserRecord, get_user
+from ..utils.weather import OpenWeatherMapAPI
+
+# Baselines of every benchmark in multiples of the time of the calibration loop, saved with
+# --save. Both are timed in the same run, so a baseline holds while the load of the machine
+# changes. They still depend on the machine and Python version, so they aren't committed.
+baselines_path: str = join(dirname(abspath(__file__)), "baselines.json")
+threshold = float(os.getenv("BENCH_THRESHOLD", "50"))
+
+
+def display_format() -> Callable[[], str]:
+    weather_api = OpenWeatherMapAPI("New York, NY")
+    weather_api.location, weather_api.region = "New York", "New York"
+    weather_api.data = WeatherSnapshot.from_onecall(weather_response)
+    template = compile_template(default_template)
+    return lambda: weather_api.display_format(1, template)
+
+
+def format_directions() -> Callable[[], str]:
+    weather_api = OpenWeatherMapAPI("New York, NY")
+    return lambda: weather_api.format_directions(300)
+
+
+def snapshot() -> Callable[[], WeatherSnapshot]:
+    return lambda: WeatherSnapshot.from_onecall(weather_response)
+
+
+def schema_load() -> Callable[[], Dict[str, str]]:
+    schema = UserSchema()
+    user: Dict[str, str] = {
+        "nick": "Johnno",
+        "host": "test@test.com",
+        "format": 1,
+        "location": "New Orleans",
+        "region": "Louisiana",
+        "coordinates": "29.974,-90.087",
+    }
+    return lambda: schema.load(user)
+
+
+def get_user_db() -> Callable[[], User]:
+    users.directory.clear()
+    return lambda: get_user("user500")
+
+
+def get_user_directory() -> Callable[[], UserRecord]:
+    users.directory.load()
+    return lambda: get_user("user500")
+
+
+def cache_get() -> Callable[[], WeatherSnapshot]:
+    cache = StripedTTLCache(maxsize=256, ttl=900)
+    snapshot = WeatherSnapshot.from_onecall(weather_response)
+    for key in range(256):
+        cache[f"{key}"] = snapshot
+    return lambda: cache["128"]
+
+
+def cache_set() -> Callable[[], None]:
+    cache = StripedTTLCache(maxsize=256, ttl=900, maxbytes=1024 * 1024)
+    snapshot = WeatherSnapshot.from_onecall(weather_response)
+    return lambda: cache.__setitem__("128", snapshot)
+
+
+def calibration() -> Callable[[], str]:
+    """
+    A fixed loop of plain Python work, dict updates, float math and string formatting,
+    that the benchmarks are timed against.
+    """
+    words: List[str] = [f"word{number}" for number in range(64)]
+
+    def loop() -> str:
+        counts: Dict[str, float] = {}
+        for word in words:
+            counts[word] = counts.get(word, 0.0) + len(word) * 1.5
+        return ",".join(f"{word}:{count:.1f}" for word, count in counts.items())
+
+    return loop
+
+
+# Every benchmark by name. Each one sets up its state and returns the call to time.
+benchmarks: Dict[str, Callable[[], Callable[[], object]]] = {
+    "display_format": display_format,
+    "format_directions": format_directions,
+    "snapshot": snapshot,
+    "schema_load": schema_load,
+    "get_user_db": get_user_db,
+    "get_user_directory": get_user_directory,
+    "cache_get": cache_get,
+    "cache_set": cache_set,
+}
+
+
+@contextmanager
+def users_database(count: int = 1000) -> Iterator[None]:
+    """
+    Binds the user model to an in-memory database of saved users, so nothing touches the disk.
+    """
+    db = SqliteDatabase(":memory:")
+    with db.bind_ctx([User]), mock.patch.object(users, "isfile", return_value=True):
+        User.create_table()
+        User.insert_many(
+            [
+                {
+                    "nick": f"user{number}",
+                    "host": "test@test.com",
+                    "format": 1,
+                    "location": "New Orleans",
+                    "region": "Louisiana",
+                    "coordinates": "29.974,-90.087",
+                }
+                for number in range(count)
+            ]
+        ).execute()
+        try:
+            yield
+        finally:
+            users.directory.clear()
+
+
+def measure(call: Callable[[], object], repeat: int = 5) -> float:
+    """
+    Times a call and returns the best of a few runs in nanoseconds per call.
+    """
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def calibrated(call: Callable[[], object], loop: Callable[[], object]) -> Tuple[float, float]:
+    """
+    Times a call against the calibration loop. The loop is timed right before and after the
+    call and the faster time is kept, so the load of the machine changing during a run skews
+    the results less.
+
+    Returns:
+        The nanoseconds per call, and the time of the call in multiples of the loop's.
+    """
+    unit: float = measure(loop)
+    timing: float = measure(call)
+    unit = min(unit, measure(loop))
+    return timing, timing / unit
+
+
+def compare(results: Dict[str, float], baselines: Dict[str, float], threshold: float) -> List[Tuple[str, float]]:
+    """
+    Finds the benchmarks that got slower than their baseline by more than the threshold.
+
+    Args:
+        results: The time of every benchmark run, in multiples of the calibration loop's.
+        baselines: The saved time of every benchmark, in multiples of the calibration loop's.
+        threshold: The percentage a benchmark may get slower by.
+
+    Returns:
+        The name and percentage change of every regressed benchmark.
+    """
+    regressions: List[Tuple[str, float]] = []
+    for name, result in results.items():
+        if name in baselines:
+            change: float = (result - baselines[name]) / baselines[name] * 100
+            if change > threshold:
+                regressions.append((name, change))
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the plugin's hot paths, offline.")
+    parser.add_argument("names", nargs="*", default=list(benchmarks), help="benchmarks to run, all by default")
+    parser.add_argument("--threshold", type=float, default=threshold, help="percent slower than baseline that fails")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baselines")
+    args = parser.parse_args()
+
+    try:
+        with open(baselines_path) as baselines_file:
+            baselines: Dict[str, float] = json.load(baselines_file)
+    except FileNotFoundError:
+        baselines = {}
+
+    results: Dict[str, float] = {}
+    loop: Callable[[], str] = calibration()
+    with users_database():
+        for name in args.names:
+            timing, results[name] = calibrated(benchmarks[name](), loop)
+            baseline: str = f"{baselines[name]:>10.4f}x" if name in baselines else f"{'-':>11}"
+            print(f"{name:<20} {timing:>12,.0f} ns {results[name]:>10.4f}x  baseline {baseline}")
+
+    if args.save:
+        with open(baselines_path, "w") as baselines_file:
+            saved: Dict[str, float] = {**baselines, **{name: round(result, 4) for name, result in results.items()}}
+            json.dump(saved, baselines_file, indent=4)
+            baselines_file.write("\n")
+        print(f"Saved the baselines to {baselines_path}")
+        return
+
+    regressions: List[Tuple[str, float]] = compare(results, baselines, args.threshold)
+    for name, change in regressions:
+        print(f"{name} regressed by {change:.1f}%, more than {args.threshold:.1f}%")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
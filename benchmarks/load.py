@@ -0,0 +1,233 @@
+import argparse
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from os.path import abspath, dirname, join
+from typing import Any, Callable, Dict, List
+
+# The settings of the bot the load runs against, like supybot-test's. Commands aren't
+# flood limited, replies aren't throttled and everything it writes goes in a temporary directory.
+registry_settings = """
+supybot.directories.backup: /dev/null
+supybot.directories.conf: {directory}/conf
+supybot.directories.data: {directory}/data
+supybot.directories.log: {directory}/logs
+supybot.flush: False
+supybot.log.stdout: False
+supybot.abuse.flood.command: False
+supybot.protocols.irc.throttleTime: 0
+supybot.reply.whenNotCommand: False
+supybot.nick: WeatherBot
+"""
+
+
+class ErrorReply(Exception):
+    """
+    A reply to the weather command that isn't a weather display, e.g. Unable to find this location.
+    """
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of sorted latencies.
+    """
+    if not latencies:
+        return 0.0
+    return latencies[max(0, ceil(percent / 100 * len(latencies)) - 1)]
+
+
+class LoadResult:
+    """
+    The outcome of a load run.
+
+    Attributes:
+        latencies: The sorted latency of every request in seconds, from when it was due to be sent.
+        errors: The number of failed requests, by exception name.
+        elapsed: The seconds the run took.
+    """
+
+    def __init__(self, latencies: List[float], errors: Dict[str, int], elapsed: float):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self) -> float:
+        return (len(self.latencies) + sum(self.errors.values())) / self.elapsed
+
+    def __str__(self) -> str:
+        p50, p95, p99 = (percentile(self.latencies, percent) * 1000 for percent in (50, 95, 99))
+        errors: str = ", ".join(f"{name}: {count}" for name, count in sorted(self.errors.items())) or "none"
+        return (
+            f"{len(self.latencies)} ok in {self.elapsed:.1f}s, {self.throughput:.1f} req/s | "
+            f"p50 {p50:.1f}ms p95 {p95:.1f}ms p99 {p99:.1f}ms | errors: {errors}"
+        )
+
+
+def run(request: Callable[[int], object], qps: float, concurrency: int, total: int) -> LoadResult:
+    """
+    Sends requests at a target rate from a pool of threads. Requests are scheduled open loop,
+    so their latency counts the time spent waiting for a free thread when the pool falls behind.
+
+    Args:
+        request: Makes request number n, raising if it fails.
+        qps: The target requests per second, or 0 to send as fast as the threads allow.
+        concurrency: The number of threads sending requests.
+        total: The number of requests to send.
+
+    Returns:
+        The latencies and errors of the run.
+    """
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def send(number: int, due: float) -> None:
+        try:
+            request(number)
+        except Exception as exc:
+            with lock:
+                errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - due)
+
+    began: float = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="WeatherBot-load") as pool:
+        for number in range(total):
+            due: float = began + number / qps if qps else time.perf_counter()
+            delay: float = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, number, due)
+
+    return LoadResult(latencies, errors, time.perf_counter() - began)
+
+
+class Bot:
+    """
+    The plugin loaded on an Irc object without a network connection, the way supybot-test
+    loads it, so requests go through the whole weather command: the user lookup, location
+    validation, trace, template and reply. Its database and files are in a temporary directory.
+
+    Attributes:
+        irc: The Irc object the plugin is loaded on.
+        timeout: The seconds a request waits for its reply.
+    """
+
+    def __init__(self, directory: str, timeout: float = 30.0):
+        from supybot import conf, registry
+
+        for name in ("conf", "data", "logs"):
+            os.makedirs(join(directory, name), exist_ok=True)
+        registry_file: str = join(directory, "conf", "load.conf")
+        with open(registry_file, "w") as settings:
+            settings.write(registry_settings.format(directory=directory))
+        registry.open_registry(registry_file)
+        # The plugin package imported supybot.conf before the registry was opened, so the
+        # settings already registered are set here rather than read from the file.
+        for line in registry_settings.format(directory=directory).strip().splitlines():
+            name, value = line.split(": ", 1)
+            setting: Any = conf.supybot
+            for part in registry.split(name)[1:]:
+                setting = setting.get(part)
+            setting.set(value)
+        conf.registerNetwork("test")
+        conf.supybot.directories.plugins.setValue([dirname(dirname(dirname(abspath(__file__))))])
+        # Loading the plugin reloads its modules, so they pick up the temporary database.
+        os.environ["DB_NAME"] = join(directory, "data", "Weather.db")
+
+        from supybot import plugin
+        from supybot.test import getTestIrc
+
+        self.timeout = timeout
+        self.irc = getTestIrc()
+        self._replies: Dict[str, queue.Queue] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        plugin.loadPluginClass(self.irc, plugin.loadPluginModule("Owner"))
+        module: Any = plugin.loadPluginModule("WeatherBot")
+        module.models.users.User.create_tables()
+        module.models.users.GeoCache.create_tables()
+        plugin.loadPluginClass(self.irc, module)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="WeatherBot-load-replies", daemon=True)
+        self._dispatcher.start()
+
+    def command(self, nick: str, text: str) -> str:
+        """
+        Sends a command to the bot in a private message from a nick and waits for its reply.
+        Every request needs its own nick, since replies are matched to requests by nick.
+        """
+        from supybot import ircmsgs
+
+        replies: queue.Queue = queue.Queue()
+        with self._lock:
+            self._replies[nick] = replies
+            # The Irc object is fed from one thread at a time, like from its driver in a running bot.
+            self.irc.feedMsg(ircmsgs.privmsg(self.irc.nick, text, prefix=f"{nick}!load@load.test"))
+        try:
+            return replies.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No reply to {text} in {self.timeout}s") from None
+        finally:
+            with self._lock:
+                self._replies.pop(nick, None)
+
+    def _dispatch(self) -> None:
+        while not self._stopped.is_set():
+            msg = self.irc.takeMsg()
+            if msg is None:
+                time.sleep(0.001)
+                continue
+            if msg.command in ("PRIVMSG", "NOTICE"):
+                with self._lock:
+                    replies = self._replies.get(msg.args[0])
+                if replies is not None:
+                    replies.put(msg.args[1])
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._dispatcher.join()
+        self.irc._reallyDie()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load generator for the weather command. Point WS_API_URL and OWM_API_URL at the stub server."
+    )
+    parser.add_argument("--qps", type=float, default=50.0, help="target requests per second, 0 for no limit")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--locations", type=int, default=100, help="distinct locations queried")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds a request waits for its reply")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    from ..utils.weather import OWM_URL, WS_URL
+
+    rand = random.Random(args.seed)
+    queries: List[str] = [f"Stub City {rand.randrange(args.locations)}" for _ in range(args.requests)]
+
+    print(f"Weatherstack: {WS_URL} | OpenWeatherMap: {OWM_URL}")
+    with tempfile.TemporaryDirectory(prefix="WeatherBot-load-") as directory:
+        bot = Bot(directory, args.timeout)
+
+        def request(number: int) -> str:
+            reply: str = bot.command(f"load{number}", f"weather {queries[number]}")
+            if " :: " not in reply:
+                raise ErrorReply(reply)
+            return reply
+
+        try:
+            print(run(request, args.qps, args.concurrency, args.requests))
+        finally:
+            bot.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from ..test_responses import current_response, geo_response, weather_response
+
+
+def latency_sampler(distribution: str, mean: float, rand: random.Random) -> Callable[[], float]:
+    """
+    Returns a function sampling response latencies in seconds.
+
+    Args:
+        distribution: fixed, uniform (0 to twice the mean), exponential or lognormal.
+        mean: The mean latency in milliseconds.
+        rand: The random number generator to sample with.
+    """
+    mean /= 1000
+    if mean <= 0:
+        return lambda: 0.0
+    if distribution == "fixed":
+        return lambda: mean
+    if distribution == "uniform":
+        return lambda: rand.uniform(0, 2 * mean)
+    if distribution == "exponential":
+        return lambda: rand.expovariate(1 / mean)
+    if distribution == "lognormal":
+        # A sigma of 0.5 gives a long tail, with the mean kept at the one asked for.
+        return lambda: rand.lognormvariate(0, 0.5) * mean / 1.1331
+    raise ValueError(f"Unknown latency distribution {distribution}.")
+
+
+class StubState:
+    """
+    The behavior of the stub server shared by its handler threads.
+
+    Attributes:
+        latency: Samples the latency of a response in seconds.
+        error_rate: The share of requests answered with a 500.
+        throttle_rate: The share of requests answered with a 429.
+        max_qps: The requests per second allowed before answering with a 429, or 0 for no limit.
+        requests: The number of requests received, by path.
+    """
+
+    def __init__(
+        self,
+        latency: Callable[[], float],
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        max_qps: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_qps = max_qps
+        self.requests: Dict[str, int] = {}
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = max_qps
+        self._refilled = time.monotonic()
+
+    def admit(self, path: str) -> int:
+        """
+        Counts a request and decides its status code.
+        """
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            if self.max_qps:
+                now: float = time.monotonic()
+                self._tokens = min(self.max_qps, self._tokens + (now - self._refilled) * self.max_qps)
+                self._refilled = now
+                if self._tokens < 1:
+                    return 429
+                self._tokens -= 1
+            roll: float = self._rand.random()
+
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return 200
+
+
+def geolocation(query: str) -> Dict[str, Any]:
+    """
+    Returns the current weather fixture for a query, at a location moved by an offset
+    derived from the query, so different queries land on different weather cache keys.
+    """
+    offset: int = zlib.crc32(query.encode("utf-8"))
+    location: Dict[str, Any] = dict(geo_response["location"])
+    location["name"] = query or location["name"]
+    location["lat"] = f"{float(location['lat']) + (offset % 1000) / 100 - 5:.3f}"
+    location["lon"] = f"{float(location['lon']) + (offset // 1000 % 1000) / 100 - 5:.3f}"
+    return {"location": location, "current": current_response["current"]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers /current like Weatherstack and /data/2.5/onecall like OpenWeatherMap, from the test fixtures.
+    Weatherstack's answer has the current weather too, so it can stand in for either provider.
+    """
+
+    state: StubState
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/current":
+            body: Dict[str, Any] = geolocation(parse_qs(url.query).get("query", [""])[0])
+        elif url.path == "/data/2.5/onecall":
+            body = weather_response
+        else:
+            self._send(404, {"error": "not found"})
+            return
+
+        status: int = self.state.admit(url.path)
+        time.sleep(self.state.latency())
+        self._send(status, body if status == 200 else {"cod": status, "message": "stubbed error"})
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send(self, status: int, body: Dict[str, Any]) -> None:
+        payload: bytes = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering every connection from its own thread. The same as the standard
+    library's ThreadingHTTPServer, which isn't there before Python 3.7.
+    """
+
+    daemon_threads = True
+
+
+def make_server(host: str, port: int, state: StubState) -> StubServer:
+    """
+    Creates a stub server answering from its own thread per connection.
+
+    Args:
+        host: The address to listen on.
+        port: The port to listen on, 0 for any free port.
+        state: The behavior of the server.
+
+    Returns:
+        The server, which isn't serving until serve_forever() is called.
+    """
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    return StubServer((host, port), handler)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stub Weatherstack and OpenWeatherMap server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=50.0, help="mean latency in ms")
+    parser.add_argument(
+        "--distribution", default="lognormal", choices=("fixed", "uniform", "exponential", "lognormal")
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--max-qps", type=float, default=0.0, help="requests per second before answering 429s")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    latency = latency_sampler(args.distribution, args.latency, random.Random(args.seed))
+    state = StubState(latency, args.error_rate, args.throttle_rate, args.max_qps, args.seed)
+    server = make_server(args.host, args.port, state)
+    url: str = f"http://{args.host}:{server.server_address[1]}"
+    print(f"Serving on {url}, run the bot or load generator with WS_API_URL={url} OWM_API_URL={url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Requests: {state.requests}")
+
+
+if __name__ == "__main__":
+    main()
@@ -30,10 +30,12 @@
 
 from supybot import conf, registry
 
+from .utils.templates import compile_template, default_template
+
 try:
     from supybot.i18n import PluginInternationalization
 
-    _ = PluginInternationalization("APIXUWeather")
+    _ = PluginInternationalization("WeatherBot")
 except:
     # Placeholder that allows to run the plugin on a bot
     # without the i18n module
@@ -47,13 +49,34 @@ def configure(advanced):
     # registry as appropriate.
     from supybot.questions import anything, expect, something, yn
 
-    conf.registerPlugin("APIXUWeather", True)
+    conf.registerPlugin("WeatherBot", True)
+
+
+class Template(registry.String):
+    """Value must be a weather display template using only the known fields."""
+
+    def setValue(self, v):
+        try:
+            compile_template(v)
+        except ValueError as exc:
+            self.error(str(exc))
+        super().setValue(v)
 
 
-APIXUWeather = conf.registerPlugin("APIXUWeather")
-# This is where your configuration variables (if any) should go.  For example:
-# conf.registerGlobalValue(APIXUWeather, 'someConfigVariableName',
-#     registry.Boolean(False, _("""Help for someConfigVariableName.""")))
+WeatherBot = conf.registerPlugin("WeatherBot")
+conf.registerChannelValue(
+    WeatherBot,
+    "template",
+    Template(
+        default_template,
+        _(
+            """The template of the weather display. Fields are written as {field}, {b} toggles bold.
+    Fields: place, location, region, condition, summary, humidity, wind_dir, temperature, temp_f, temp_c,
+    feels_like, feels_f, feels_c, high, high_f, high_c, low, low_f, low_c, wind, wind_mph, wind_kph.
+    Fields without a unit show both units in the order of the user's format."""
+        ),
+    ),
+)
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
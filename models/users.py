@@ -1,6 +1,7 @@
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from os.path import abspath, dirname, isfile, join
+from typing import Dict, Optional
 
 from dotenv import load_dotenv
 from marshmallow import Schema, ValidationError, fields, validates
@@ -12,7 +13,45 @@ env_path: str = join(path, "..", ".env")
 load_dotenv(dotenv_path=env_path)
 db_path: str = join(path, "..", "data", os.getenv("DB_NAME"))
 
-db = SqliteDatabase(db_path)
+# Configurable sqlite settings that you can change through environment variables.
+# WAL lets the threads reading users and locations carry on while another thread writes,
+# and a writer waits up to the busy timeout in seconds for a lock instead of failing.
+journal_mode: str = os.getenv("DB_JOURNAL_MODE", "wal")
+synchronous: str = os.getenv("DB_SYNCHRONOUS", "normal")
+cache_size = int(os.getenv("DB_CACHE_SIZE", "-8000"))  # Negative sizes are in KiB.
+mmap_size = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+busy_timeout = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+
+# Peewee keeps one connection per thread, opened the first time a thread queries.
+# The connections are never closed between queries, so every worker thread reuses its own.
+db = SqliteDatabase(
+    db_path,
+    pragmas={
+        "journal_mode": journal_mode,
+        "synchronous": synchronous,
+        "cache_size": cache_size,
+        "mmap_size": mmap_size,
+    },
+    timeout=busy_timeout,
+)
+
+# Configurable geocode cache settings that you can change through environment variables.
+geo_cache_ttl = timedelta(days=int(os.getenv("GEO_CACHE_TTL_DAYS", "90")))
+geo_cache_max_rows = int(os.getenv("GEO_CACHE_MAX_ROWS", "10000"))
+geo_cache_prune_batch = int(os.getenv("GEO_CACHE_PRUNE_BATCH", "500"))
+
+
+def connect() -> bool:
+    """
+    Opens the calling thread's connection ahead of its first query, so long-lived threads
+    pay for connecting once up front. Does nothing until createdb has made the database file.
+
+    Returns:
+        Whether a new connection was opened.
+    """
+    if not isfile(db_path):
+        return False
+    return db.connect(reuse_if_open=True)
 
 
 class User(Model):
@@ -32,7 +71,7 @@ class User(Model):
     def create_tables(cls) -> str:
         if isfile(db_path) and cls.table_exists():
             return "Users table already created."
-        with db:
+        with db.atomic():
             cls.create_table()
             log.info("Created the users table")
             return "Created users table."
@@ -41,6 +80,106 @@ class User(Model):
         return f"<User {self.nick}>"
 
 
+class GeoCache(Model):
+    query = CharField(unique=True, max_length=80, null=False)
+    location = CharField(max_length=80, null=False)
+    region = CharField(max_length=80, null=False)
+    coordinates = CharField(max_length=20, null=False)
+    created_at = DateTimeField(default=datetime.now)
+    last_hit_at = DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        database = db
+        db_table = "geocache"
+
+    @classmethod
+    def create_tables(cls) -> str:
+        if isfile(db_path) and cls.table_exists():
+            return "Geocache table already created."
+        with db.atomic():
+            cls.create_table()
+            log.info("Created the geocache table")
+            return "Created geocache table."
+
+    @classmethod
+    def lookup(cls, query: str) -> Optional[Dict[str, str]]:
+        """
+        Gets the saved location of a query if it hasn't expired, and marks it as hit.
+
+        Args:
+            query: The location that was queried.
+
+        Returns:
+            A dictionary of the location, region and coordinates, or None if not found.
+        """
+        if not isfile(db_path) or not cls.table_exists():
+            return None
+
+        now = datetime.now()
+        geo: Optional[GeoCache] = cls.get_or_none((cls.query == query) & (cls.created_at > now - geo_cache_ttl))
+        if geo is None:
+            return None
+
+        cls.update(last_hit_at=now).where(cls.id == geo.id).execute()
+        return {"location": geo.location, "region": geo.region, "coordinates": geo.coordinates}
+
+    @classmethod
+    def store(cls, query: str, geo: Dict[str, str]) -> None:
+        """
+        Saves the location found for a query, replacing any expired one, and prunes the
+        table if it has grown past its max rows.
+
+        Args:
+            query: The location that was queried.
+            geo: A dictionary of the location, region and coordinates found.
+        """
+        if not isfile(db_path) or not cls.table_exists():
+            return
+
+        now = datetime.now()
+        cls.insert(
+            query=query,
+            location=geo["location"],
+            region=geo["region"],
+            coordinates=geo["coordinates"],
+            created_at=now,
+            last_hit_at=now,
+        ).on_conflict_replace().execute()
+
+        if cls.select().count() > geo_cache_max_rows:
+            cls.prune()
+
+    @classmethod
+    def prune(cls, max_rows: Optional[int] = None, batch_size: Optional[int] = None) -> int:
+        """
+        Deletes the least recently hit rows in batches until the table fits in max rows.
+
+        Args:
+            max_rows(optional): The max number of rows to keep.
+            batch_size(optional): The number of rows to delete per transaction.
+
+        Returns:
+            The number of rows deleted.
+        """
+        max_rows = geo_cache_max_rows if max_rows is None else max_rows
+        batch_size = batch_size or geo_cache_prune_batch
+        deleted = 0
+        while True:
+            excess: int = cls.select().count() - max_rows
+            if excess <= 0:
+                break
+            with db.atomic():
+                oldest = cls.select(cls.id).order_by(cls.last_hit_at, cls.id).limit(min(excess, batch_size))
+                deleted += cls.delete().where(cls.id.in_(oldest)).execute()
+
+        if deleted:
+            log.info("Pruned %s rows from the geocache table", deleted)
+        return deleted
+
+    def __repr__(self):
+        return f"<GeoCache {self.query}>"
+
+
 class UserSchema(Schema):
     id = fields.Integer()
     nick = fields.String(required=True)
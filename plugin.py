@@ -5,18 +5,43 @@
 # All rights reserved.
 
 import html
-from typing import Dict, List, Tuple, Union
+import threading
+from concurrent import futures
+from os.path import abspath, basename, dirname, join
+from typing import Dict, List, Optional, Tuple, Union
 
 from marshmallow import ValidationError
 from peewee import DatabaseError
 from requests import RequestException
-from supybot import callbacks, ircmsgs, log
+from supybot import callbacks, ircmsgs, log, schedule, world
 from supybot.commands import getopts, optional, wrap
 
-from .models.users import User, UserSchema
-from .utils.errors import LocationNotFound, WeatherNotFound
-from .utils.services import query_current_weather, query_location
-from .utils.users import AnonymousUser, get_user
+from .models.users import GeoCache, User, UserSchema, db, db_path
+from .utils.errors import CircuitOpen, LocationNotFound, RateLimited, WeatherNotFound
+from .utils.metrics import Trace, metrics, metrics_file, metrics_interval
+from .utils.refresh import interval as refresh_interval
+from .utils.services import (
+    cache_stats,
+    compact_caches,
+    compact_interval,
+    engine,
+    flights,
+    gazetteer,
+    many_max,
+    providers,
+    query_current_weather,
+    query_forecast,
+    query_location,
+    query_many,
+    refresh_ahead,
+    refresher,
+    write_metrics,
+)
+from .utils.sessions import prewarm
+from .utils.templates import Template, compile_template
+from .utils.transfer import export_users, import_users
+from .utils.users import AnonymousUser, UserRecord, directory, get_user
+from .utils.weather import shared_async_pool, shared_pool
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -35,20 +60,189 @@ class WeatherBot(callbacks.Plugin):
 
     threaded = True
 
+    def __init__(self, irc: callbacks.NestedCommandsIrcProxy):
+        self.__parent = super(WeatherBot, self)
+        self.__parent.__init__(irc)
+        try:
+            directory.load()
+        except DatabaseError as exc:
+            log.info("User directory not loaded: %s", exc)
+        engine.start()
+        schedule.addPeriodicEvent(refresh_ahead, refresh_interval, name="WeatherBot-refresh", now=False)
+        schedule.addPeriodicEvent(compact_caches, compact_interval, name="WeatherBot-compact", now=False)
+        if metrics_file:
+            schedule.addPeriodicEvent(self._write_metrics, metrics_interval, name="WeatherBot-metrics", now=False)
+        # Opens the keep-alive connections in the background so loading the plugin isn't held up.
+        if prewarm and not world.testing:
+            threading.Thread(target=shared_pool.warm, name="WeatherBot-prewarm", daemon=True).start()
+
+    def die(self) -> None:
+        schedule.removePeriodicEvent("WeatherBot-refresh")
+        schedule.removePeriodicEvent("WeatherBot-compact")
+        if metrics_file:
+            schedule.removePeriodicEvent("WeatherBot-metrics")
+        if engine.running:
+            engine.run(shared_async_pool.close())
+        engine.stop()
+        providers.close()
+        shared_pool.close()
+        db.close()
+        self.__parent.die()
+
     @wrap(["owner"])
     def createdb(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str]) -> None:
         """- takes no arguments.
-        Creates a new user table.
+        Creates new user and geocache tables.
         """
         try:
-            result: str = User.create_tables()
+            result: str = f"{User.create_tables()} {GeoCache.create_tables()}"
+            directory.load()
             irc.reply(result, prefixNick=False)
 
         except DatabaseError as exc:
             log.error(str(exc))
             irc.reply("There was an error with the database. Check logs.", prefixNick=False)
 
-    @wrap([getopts({"user": ""}), optional("text")])
+    @wrap(["owner", "somethingWithoutSpaces"])
+    def exportusers(
+        self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str], name: str
+    ) -> None:
+        """<file> - e.g. users.jsonl or users.csv
+        Exports every saved user to a JSONL or CSV file in the plugin's data directory.
+        """
+        path: Optional[str] = self._users_file(name)
+        if path is None:
+            irc.reply("Users can only be exported to a .jsonl or .csv file.", prefixNick=False)
+            return
+
+        try:
+            count: int = export_users(path)
+            irc.reply(f"Exported {count} users to {basename(name)}.", prefixNick=False)
+
+        except DatabaseError as exc:
+            log.error(str(exc))
+            irc.reply(str(exc), prefixNick=False)
+
+        except OSError as exc:
+            log.error(str(exc))
+            irc.reply(f"Unable to write {basename(name)}.", prefixNick=False)
+
+    @wrap(["owner", "somethingWithoutSpaces"])
+    def importusers(
+        self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str], name: str
+    ) -> None:
+        """<file> - e.g. users.jsonl or users.csv
+        Imports saved users from a JSONL or CSV file in the plugin's data directory, replacing users with the same nick.
+        """
+        path: Optional[str] = self._users_file(name)
+        if path is None:
+            irc.reply("Users can only be imported from a .jsonl or .csv file.", prefixNick=False)
+            return
+
+        try:
+            imported, skipped = import_users(path)
+            directory.load()
+            irc.reply(
+                f"Imported {imported} users from {basename(name)}. Skipped {skipped} invalid rows.", prefixNick=False
+            )
+
+        except DatabaseError as exc:
+            log.error(str(exc))
+            irc.reply("There was an error with the database. Check logs.", prefixNick=False)
+
+        except (OSError, ValueError) as exc:
+            log.error(str(exc))
+            irc.reply(f"Unable to read {basename(name)}.", prefixNick=False)
+
+    def _data_file(self, name: str) -> str:
+        """
+        Returns the path of a file in the plugin's data directory, ignoring any directories in the name.
+        """
+        return join(dirname(abspath(__file__)), "data", basename(name))
+
+    def _users_file(self, name: str) -> Optional[str]:
+        """
+        Returns the path of a users file in the plugin's data directory, or None if it isn't a .jsonl
+        or .csv file or it is one of the files the plugin keeps there, so exports can't overwrite them.
+        """
+        path: str = self._data_file(name)
+        kept: List[str] = [db_path, gazetteer.path] + ([self._data_file(metrics_file)] if metrics_file else [])
+        if not name.lower().endswith((".jsonl", ".csv")) or abspath(path) in {abspath(kept_path) for kept_path in kept}:
+            return None
+        return path
+
+    @wrap(["owner"])
+    def cachestats(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str]) -> None:
+        """- takes no arguments.
+        Shows the entries, approximate memory used and evictions of every cache tier.
+        """
+        tiers: List[str] = []
+        for tier, stats in cache_stats().items():
+            budget: str = f"/{stats['maxbytes'] / 1024:.1f}" if stats["maxbytes"] else ""
+            tiers.append(
+                f"\x02{tier}\x02: {stats['entries']} entries, {stats['bytes'] / 1024:.1f}{budget} KiB, "
+                f"{stats['evictions']} evictions"
+            )
+        irc.reply(" | ".join(tiers), prefixNick=False)
+
+    @wrap(["owner"])
+    def refreshstats(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str]) -> None:
+        """- takes no arguments.
+        Shows how many saved users' weather refreshes ahead of expiry were used or wasted.
+        """
+        stats: Dict[str, int] = refresher.stats()
+        irc.reply(
+            f"Refreshes: {stats['refreshes']} | Used: {stats['hits']} | Wasted: {stats['wasted']} "
+            f"| Tracked locations: {stats['tracked']}",
+            prefixNick=False,
+        )
+
+    @wrap(["owner"])
+    def weatherstats(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str]) -> None:
+        """- takes no arguments.
+        Shows where the time of weather requests went by stage, the upstream responses, the calls
+        coalesced, the weather providers and the cache hit rates.
+        """
+        stages: List[str] = [
+            f"{stage} {histogram.count}x "
+            + "/".join(f"{histogram.percentile(percent) * 1000:.1f}" for percent in (50, 95, 99))
+            for stage, histogram in sorted(metrics.stages.items())
+        ]
+        hosts: Dict[str, List[str]] = {}
+        for (host, status), count in sorted(metrics.upstream.items()):
+            hosts.setdefault(host, []).append(f"{status}: {count}")
+        upstream: List[str] = [f"{host} {', '.join(counts)}" for host, counts in hosts.items()]
+        upstream += [f"{host} circuit {breaker.state}" for host, breaker in sorted(shared_pool.breakers.items())]
+        coalesced: Dict[str, int] = flights.stats()
+        upstream.append(f"coalesced {coalesced['calls']} calls made, {coalesced['saved']} saved")
+        caches: List[str] = []
+        for tier, stats in cache_stats().items():
+            lookups: int = stats["hits"] + stats["misses"]
+            rate: float = stats["hits"] / lookups * 100 if lookups else 0.0
+            caches.append(f"{tier} {rate:.0f}% hits ({stats['hits']}/{lookups}), {stats['evictions']} evictions")
+
+        hedging: str = f"{providers.hedges} hedged, {providers.hedge_wins} won, {providers.failovers} failed over"
+        for name, stats in providers.stats().items():
+            hedging += (
+                f" | {name} {stats['calls']} calls, {stats['latency']:.0f}ms avg, {stats['p95']:.0f}ms p95, "
+                f"{stats['error_rate']:.0%} errors"
+            )
+
+        irc.replies(
+            [
+                f"\x02Stages\x02 (count, p50/p95/p99 ms): {' | '.join(stages) or 'none yet'}",
+                f"\x02Upstream\x02: {' | '.join(upstream) or 'none yet'}",
+                f"\x02Providers\x02: {hedging}",
+                f"\x02Caches\x02: {' | '.join(caches)} | \x02Slow requests\x02: {metrics.slow_requests}",
+            ],
+            prefixNick=False,
+            oneToOne=False,
+        )
+
+    def _write_metrics(self) -> None:
+        write_metrics(self._data_file(metrics_file))
+
+    @wrap([getopts({"user": "", "channel": ""}), optional("text")])
     def weather(
         self,
         irc: callbacks.NestedCommandsIrcProxy,
@@ -57,27 +251,43 @@ class WeatherBot(callbacks.Plugin):
         optlist: List[Tuple[str, bool]],
         text: str,
     ) -> None:
-        """- optional <location> OR [--user] <username>
+        """- optional <location> OR [--user] <username> OR [--channel]
         Calls the current weather given an optional arg .e.g. .weather 70119 -
         If you leave out the location, it will try to use the user's set location that is saved -
-        You can find another user's weather by using the --user flag. e.g. .weather --user Chad
+        You can find another user's weather by using the --user flag. e.g. .weather --user Chad -
+        Separate locations with | to get them all at once. e.g. .weather 70119 | Chicago, IL -
+        Use the --channel flag to get the weather of everyone in the channel that set a location.
         """
         lookup_user: bool = False
+        lookup_channel: bool = False
         for opt, _ in optlist:
             if opt == "user":
                 lookup_user = True
+            elif opt == "channel":
+                lookup_channel = True
 
+        trace = Trace(f"weather {text or ''}".strip())
         try:
+            template: Template = self._template(irc, msg)
+            if lookup_channel:
+                self._weather_channel(irc, msg, template, trace)
+                return
+
+            if not lookup_user and text and "|" in text:
+                self._weather_many(irc, msg, text, template, trace)
+                return
+
             optional_user = html.escape(text) if lookup_user and text else msg.nick
             if lookup_user and not text:
                 irc.reply(f"Please specify the user name.", prefixNick=False)
                 return
 
-            user: Union[User, AnonymousUser] = get_user(optional_user)
+            with trace.stage("get_user"):
+                user: Union[User, UserRecord, AnonymousUser] = get_user(optional_user)
 
             if lookup_user:
                 if not isinstance(user, AnonymousUser):
-                    weather: str = query_current_weather("", user)
+                    weather: str = query_current_weather("", user, template, trace)
                     irc.reply(weather, prefixNick=False)
                 else:
                     irc.reply(f"No such user by the name of {text}.", prefixNick=False)
@@ -86,12 +296,12 @@ class WeatherBot(callbacks.Plugin):
                 irc.reply(f"No weather location set by {msg.nick}", prefixNick=False)
 
             elif not text:
-                weather: str = query_current_weather(text, user)
+                weather: str = query_current_weather(text, user, template, trace)
                 irc.reply(weather, prefixNick=False)
 
             else:
                 deserialized_location: Dict[str, str] = UserSchema().load({"location": html.escape(text)}, partial=True)
-                weather: str = query_current_weather(deserialized_location["location"], user)
+                weather: str = query_current_weather(deserialized_location["location"], user, template, trace)
                 irc.reply(weather, prefixNick=False)
 
         except ValidationError as exc:
@@ -107,16 +317,137 @@ class WeatherBot(callbacks.Plugin):
             else:
                 irc.reply("There is an error. Contact admin.", prefixNick=False)
 
-        except (LocationNotFound, WeatherNotFound) as exc:
+        except (CircuitOpen, LocationNotFound, RateLimited, WeatherNotFound) as exc:
             irc.reply(str(exc), prefixNick=False)
 
         except RequestException as exc:
             log.error(str(exc), exc_info=True)
-            if exc.response.status_code == 400:
+            if exc.response is not None and exc.response.status_code == 400:
                 irc.reply("Unable to find this location.", prefixNick=False)
             else:
                 irc.reply("There is an error. Contact admin.", prefixNick=False)
 
+        except futures.TimeoutError:
+            log.error("Timed out waiting on the weather engine for %s", trace.label)
+            irc.reply("There is an error. Contact admin.", prefixNick=False)
+
+        finally:
+            trace.finish()
+
+    @wrap([optional("text")])
+    def forecast(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str], text: str) -> None:
+        """- optional <location>
+        Calls the forecast of the coming days given an optional arg e.g. .forecast 70119 -
+        If you leave out the location, it will try to use the user's set location that is saved.
+        """
+        self._forecast(irc, msg, text, hourly=False)
+
+    @wrap([optional("text")])
+    def hourly(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, args: List[str], text: str) -> None:
+        """- optional <location>
+        Calls the forecast of the coming hours given an optional arg e.g. .hourly 70119 -
+        If you leave out the location, it will try to use the user's set location that is saved.
+        """
+        self._forecast(irc, msg, text, hourly=True)
+
+    def _forecast(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, text: str, hourly: bool) -> None:
+        """
+        Replies with the daily or hourly forecast of a location, or of the user's saved location.
+        It is read from the same cached weather data as the weather command.
+        """
+        trace = Trace(f"{'hourly' if hourly else 'forecast'} {text or ''}".strip())
+        try:
+            with trace.stage("get_user"):
+                user: Union[User, UserRecord, AnonymousUser] = get_user(msg.nick)
+            if not text and isinstance(user, AnonymousUser):
+                irc.reply(f"No weather location set by {msg.nick}", prefixNick=False)
+                return
+
+            query: str = UserSchema().load({"location": html.escape(text)}, partial=True)["location"] if text else ""
+            irc.reply(query_forecast(query, user, hourly, trace), prefixNick=False)
+
+        except ValidationError as exc:
+            irc.reply(exc.messages.get("location", ["Invalid location."])[0], prefixNick=False)
+
+        except DatabaseError as exc:
+            log.error(str(exc), exc_info=True)
+            irc.reply("There is an error. Contact admin.", prefixNick=False)
+
+        except RequestException as exc:
+            irc.reply(self._result_message(exc), prefixNick=False)
+
+        finally:
+            trace.finish()
+
+    def _template(self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg) -> Template:
+        """
+        Returns the display template configured for the channel of a message, or the global one.
+        """
+        channel: Optional[str] = msg.args[0] if irc.isChannel(msg.args[0]) else None
+        return compile_template(self.registryValue("template", channel))
+
+    def _weather_channel(
+        self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, template: Template, trace: Trace
+    ) -> None:
+        """
+        Replies with the weather of every user in the channel that has set a location,
+        up to many_max of them, and how many more were left out.
+        """
+        channel: str = msg.args[0]
+        if not irc.isChannel(channel) or channel not in irc.state.channels:
+            irc.reply("The --channel flag can only be used in a channel.", prefixNick=False)
+            return
+
+        users: List[Union[User, UserRecord]] = []
+        for nick in sorted(irc.state.channels[channel].users, key=str.lower):
+            with trace.stage("get_user"):
+                user: Union[User, UserRecord, AnonymousUser] = get_user(nick)
+            if not isinstance(user, AnonymousUser):
+                users.append(user)
+        if not users:
+            irc.reply(f"No one in {channel} has set a weather location.", prefixNick=False)
+            return
+
+        results: List[Union[str, Exception]] = query_many([("", user) for user in users[:many_max]], template, trace)
+        replies: List[str] = [f"{user.nick}: {self._result_message(result)}" for user, result in zip(users, results)]
+        if len(users) > many_max:
+            replies.append(f"...and {len(users) - many_max} more.")
+        irc.replies(replies, prefixNick=False, oneToOne=False)
+
+    def _weather_many(
+        self, irc: callbacks.NestedCommandsIrcProxy, msg: ircmsgs.IrcMsg, text: str, template: Template, trace: Trace
+    ) -> None:
+        """
+        Replies with the weather of every location separated by a |.
+        """
+        with trace.stage("get_user"):
+            user: Union[User, UserRecord, AnonymousUser] = get_user(msg.nick)
+        queries: List[str] = [
+            UserSchema().load({"location": html.escape(query.strip())}, partial=True)["location"]
+            for query in text.split("|")
+            if query.strip()
+        ][:many_max]
+
+        results: List[Union[str, Exception]] = query_many([(query, user) for query in queries], template, trace)
+        irc.replies([self._result_message(result) for result in results], prefixNick=False, oneToOne=False)
+
+    def _result_message(self, result: Union[str, Exception]) -> str:
+        """
+        Returns the weather display of a batch result, or the message to reply with if it failed.
+        """
+        if not isinstance(result, Exception):
+            return result
+
+        if isinstance(result, (CircuitOpen, LocationNotFound, RateLimited, WeatherNotFound)):
+            return str(result)
+
+        log.error(str(result), exc_info=result)
+        if isinstance(result, RequestException) and result.response is not None:
+            if result.response.status_code == 400:
+                return "Unable to find this location."
+
+        return "There is an error. Contact admin."
+
     @wrap([getopts({"metric": ""}), "text"])
     def setweather(
         self,
@@ -165,6 +496,7 @@ class WeatherBot(callbacks.Plugin):
                 user.region = user_schema["region"]
                 user.coordinates = user_schema["coordinates"]
                 user.save()
+            directory.put(user)
 
             units = "imperial" if format == 1 else "metric"
             log.info(f"{msg.nick} set their location to {text}")
@@ -186,7 +518,7 @@ class WeatherBot(callbacks.Plugin):
             else:
                 irc.reply("There is an error. Contact admin.", prefixNick=False)
 
-        except LocationNotFound as exc:
+        except (CircuitOpen, LocationNotFound, RateLimited) as exc:
             irc.reply(str(exc), prefixNick=False)
 
         except RequestException as exc:
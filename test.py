@@ -28,29 +28,67 @@
 
 ###
 
+import asyncio
+import csv
+import gzip
+import json
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from unittest import mock
 
+import requests
 from marshmallow import ValidationError
 from peewee import DatabaseError, Model, SqliteDatabase
-from requests import HTTPError, RequestException
-from supybot.test import PluginTestCase, SupyTestCase
+from requests import ConnectionError, HTTPError, RequestException, Timeout
+from supybot import conf
+from supybot.test import ChannelPluginTestCase, PluginTestCase, SupyTestCase
 
-from .models.users import User, UserSchema
+from .benchmarks import hot_paths, load
+from .benchmarks.stub_server import StubState, latency_sampler, make_server
+from .models.users import GeoCache, User, UserSchema, connect, db
 from .test_responses import (
+    current_response,
+    display_cf_response,
     display_default_response,
     failed_geo_response,
     geo_response,
     geo_response_without_region,
     weather_response,
 )
-from .utils.errors import LocationNotFound, WeatherNotFound
-from .utils.services import WeatherService
-from .utils.users import AnonymousUser, get_user
-from .utils.weather import OpenWeatherMapAPI, WeatherAPI
+from .utils import aiosessions, metrics, services, sessions
+from .utils.aiosessions import AsyncSessionPool, Response
+from .utils.aliases import AliasIndex
+from .utils.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from .utils.cache import StripedTTLCache, approximate_size, entry_overhead
+from .utils.engine import WeatherEngine
+from .utils.errors import CircuitOpen, LocationNotFound, RateLimited, WeatherNotFound
+from .utils.gazetteer import Gazetteer, build_index, canonicalize, normalize
+from .utils.providers import Provider, ProviderRegistry, make_registry
+from .utils.ratelimit import BACKGROUND, INTERACTIVE, RateLimiter, current_priority, priority
+from .utils.refresh import RefreshScheduler
+from .utils.services import WeatherService, snap_coordinates
+from .utils.sessions import SessionPool
+from .utils.singleflight import SingleFlight
+from .utils.snapshot import WeatherSnapshot
+from .utils.templates import Conditions, compile_template, default_template, render_forecast
+from .utils.transfer import export_users, import_users
+from .utils.users import AnonymousUser, UserDirectory, UserRecord, directory, get_user
+from .utils.weather import OpenWeatherMapAPI, WeatherAPI, WeatherstackAPI
 
 # Sqlite3 test database
 test_db = SqliteDatabase(":memory:")
 
+weather_snapshot = WeatherSnapshot.from_onecall(weather_response)
+
 
 def _mock_error_response(status: int, raise_for_status: RequestException) -> mock.Mock:
     mock_error = mock.Mock()
@@ -61,6 +99,10 @@ def _mock_error_response(status: int, raise_for_status: RequestException) -> moc
     return mock_error
 
 
+def _mock_weather_response() -> mock.Mock:
+    return mock.Mock(status_code=200, json=lambda: weather_response, content=json.dumps(weather_response).encode())
+
+
 def get_mock_user():
     return User(
         nick="Johnno",
@@ -83,15 +125,30 @@ class MockAPI(WeatherAPI):
         self.region = None
         self.coordinates = None
 
+    def set_location(self, user):
+        self.find_geolocation()
+
+    async def set_location_async(self, user):
+        self.find_geolocation()
+
+    def fetch_weather(self):
+        return weather_snapshot
+
+    async def fetch_weather_async(self):
+        return self.fetch_weather()
+
     def find_current_weather(self, user):
-        return weather_response
+        return weather_snapshot
 
     def find_geolocation(self):
         self.location = "New York"
         self.region = "NY"
         self.coordinates = "40.714,-74.006"
 
-    def display_format(self, format):
+    async def find_geolocation_async(self):
+        self.find_geolocation()
+
+    def display_format(self, format, template=None):
         return display_default_response
 
 
@@ -101,12 +158,141 @@ class MockAPI(WeatherAPI):
 class WeatherBotTestCase(PluginTestCase):
     plugins = ("WeatherBot",)
 
+    def test_cachestats(self):
+        """
+        Testing cachestats replies with the stats of every cache tier.
+        """
+        self.assertRegexp(
+            "cachestats",
+            "^\x02Locations\x02: 0 entries, 0.0/1024.0 KiB, 0 evictions \\| \x02Aliases\x02: .* \\| "
+            "\x02Weather\x02: .*/4096.0 KiB, \\d+ evictions \\| \x02Rendered\x02: ",
+        )
+
+    def test_refreshstats(self):
+        """
+        Testing refreshstats replies with the refresh-ahead stats.
+        """
+        self.assertRegexp("refreshstats", "^Refreshes: 0 \\| Used: 0 \\| Wasted: 0 \\| Tracked locations: \\d+$")
+
+    def test_weatherstats(self):
+        """
+        Testing weatherstats replies with the stage timings, upstream responses and cache hit rates.
+        """
+        self.assertRegexp("weatherstats", "Stages.* \\(count, p50/p95/p99 ms\\): ")
+        self.assertRegex(self.irc.takeMsg().args[1], "Upstream.*: .*coalesced \\d+ calls made, \\d+ saved")
+        self.assertRegex(
+            self.irc.takeMsg().args[1],
+            "Providers.*: 0 hedged, 0 won, 0 failed over \\| "
+            "openweathermap \\d+ calls, \\d+ms avg, \\d+ms p95, \\d+% errors$",
+        )
+        self.assertRegex(self.irc.takeMsg().args[1], "Caches.*: Locations \\d+% hits .*Slow requests.*: \\d+")
+
+    def test_exportusers_refuses_plugin_files(self):
+        """
+        Testing exportusers and importusers only use .jsonl or .csv files, so the database can't be overwritten.
+        """
+        for name in (os.getenv("DB_NAME"), "gazetteer.tsv", "../users"):
+            self.assertResponse(f"exportusers {name}", "Users can only be exported to a .jsonl or .csv file.")
+        self.assertResponse("importusers Weather.db", "Users can only be imported from a .jsonl or .csv file.")
+
+    def test_forecast(self):
+        """
+        Testing forecast and hourly reply with the forecast of a location, and need a location.
+        """
+        User.create_table()
+        try:
+            with mock.patch("WeatherBot.plugin.query_forecast", return_value="Forecast") as mocker:
+                self.assertResponse("forecast 70119", "Forecast")
+                self.assertResponse("hourly 70119", "Forecast")
+                self.assertResponse("hourly", "No weather location set by test")
+        finally:
+            User.drop_table()
+
+        self.assertEqual([call.args[0::2] for call in mocker.call_args_list], [("70119", False), ("70119", True)])
+
+    def test_template_config(self):
+        """
+        Testing the template config rejects templates with unknown fields or invalid format specs.
+        """
+        try:
+            self.assertNotError("config plugins.WeatherBot.template {place}: {temperature}")
+            self.assertError("config plugins.WeatherBot.template {place}: {pressure}")
+            self.assertError("config plugins.WeatherBot.template {place} {temperature:d}")
+            self.assertRegexp("config plugins.WeatherBot.template", "Global: {place}: {temperature};")
+        finally:
+            conf.supybot.plugins.WeatherBot.template.setValue(default_template)
+
+    def test_weather_many(self):
+        """
+        Testing weather replies with one line per location separated by a |,
+        in order, with the error message of any location that failed.
+        """
+        User.create_table()
+        try:
+            # The plugin reloads its modules when it loads, so use its own exception class.
+            plugin = sys.modules["WeatherBot.plugin"]
+            results = [display_default_response, plugin.LocationNotFound("Unable to find this location.")]
+            with mock.patch("WeatherBot.plugin.query_many", return_value=results) as mocker:
+                self.assertResponse("weather New York, NY | nowhere", display_default_response)
+                self.assertEqual(self.irc.takeMsg().args[1], "Unable to find this location.")
+        finally:
+            User.drop_table()
+
+        queries = [query for query, _ in mocker.call_args[0][0]]
+        self.assertEqual(queries, ["New York, NY", "nowhere"])
+
+    def test_weather_engine_timeout(self):
+        """
+        Testing weather replies with the error message when the engine doesn't answer a batch in time.
+        """
+        User.create_table()
+        try:
+            with mock.patch("WeatherBot.plugin.query_many", side_effect=futures.TimeoutError()):
+                self.assertResponse("weather New York, NY | Chicago, IL", "There is an error. Contact admin.")
+        finally:
+            User.drop_table()
+
+
+class WeatherBotChannelTestCase(ChannelPluginTestCase):
+    plugins = ("WeatherBot",)
+
+    def test_weather_channel(self):
+        """
+        Testing weather --channel replies with the weather of the first users in the channel
+        that set a location, and how many more were left out.
+        """
+        plugin = sys.modules["WeatherBot.plugin"]
+        for number in range(1, 5):
+            self.irc.state.channels[self.channel].addUser(f"user{number}")
+
+        def get_user(nick):
+            if not nick.startswith("user"):
+                return plugin.AnonymousUser()
+            user = get_mock_user()
+            user.nick = nick
+            return user
+
+        user_patch = mock.patch("WeatherBot.plugin.get_user", side_effect=get_user)
+        many_patch = mock.patch("WeatherBot.plugin.many_max", 2)
+        query_patch = mock.patch("WeatherBot.plugin.query_many", return_value=[display_default_response] * 2)
+        with user_patch, many_patch, query_patch as mocker:
+            self.assertResponse("weather --channel", f"user1: {display_default_response}")
+            self.assertEqual(self.irc.takeMsg().args[1], f"user2: {display_default_response}")
+            self.assertEqual(self.irc.takeMsg().args[1], "...and 2 more.")
+
+        self.assertEqual([user.nick for _, user in mocker.call_args[0][0]], ["user1", "user2"])
+
 
 ##################################
 # Unit tests for utils/users.py
 ##################################
 class UtilsGetUserTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        directory.clear()
+
     def tearDown(self):
+        directory.clear()
         User.drop_table()
         test_db.close()
         SupyTestCase.tearDown(self)
@@ -149,6 +335,49 @@ class UtilsGetUserTestCase(SupyTestCase):
         self.assertIsInstance(anonymous_user, AnonymousUser)
         self.assertEqual(anonymous_user.format, 1)
 
+    def test_get_users_from_directory(self):
+        """
+        Testing that get_user() uses the user directory once it is loaded,
+        without touching the database.
+        """
+        User.create_table()
+        User.create(
+            nick="Johnno",
+            host="test@test.com",
+            location="New Orleans",
+            region="Louisiana",
+            coordinates="29.974,-90.087",
+            format=2,
+        )
+        self.assertEqual(directory.load(), 1)
+        User.drop_table()
+
+        user = get_user("Johnno")
+        self.assertIsInstance(user, UserRecord)
+        self.assertEqual((user.nick, user.format, user.coordinates), ("Johnno", 2, "29.974,-90.087"))
+        self.assertIsInstance(get_user("Bruce"), AnonymousUser)
+        User.create_table()
+
+    def test_directory_write_through(self):
+        """
+        Testing users put in the directory replace the loaded ones, and that
+        loading without the users table raises a DatabaseError.
+        """
+        user_directory = UserDirectory()
+        self.assertRaises(DatabaseError, user_directory.load)
+        self.assertFalse(user_directory.loaded)
+
+        User.create_table()
+        user_directory.load()
+        user = get_mock_user()
+        user_directory.put(user)
+        user.location = "Covington"
+        self.assertEqual(user_directory.get("Johnno").location, "New York")
+        user_directory.put(user)
+        self.assertEqual(user_directory.get("Johnno").location, "Covington")
+        self.assertEqual(len(user_directory), 1)
+        self.assertEqual(repr(user_directory.get("Johnno")), "<UserRecord Johnno>")
+
 
 ##################################
 # Unit tests for utils/services.py
@@ -175,6 +404,335 @@ class UtilsWeatherServiceTestCase(SupyTestCase):
         location = service.get_location()
         self.assertEqual(location, expected)
 
+    def test_get_current_with_weather_cache(self):
+        """
+        Testing get_current only fetches the weather once for
+        coordinates that snap to the same grid point.
+        """
+        weather_cache = StripedTTLCache(maxsize=8, ttl=600)
+        with mock.patch.object(MockAPI, "fetch_weather", return_value=weather_snapshot) as mocker:
+            for _ in range(3):
+                service = WeatherService(MockAPI("New York, NY"), weather_cache)
+                weather = service.get_current(get_mock_user())
+                self.assertEqual(weather, display_default_response)
+
+        self.assertEqual(mocker.call_count, 1)
+        self.assertEqual(list(weather_cache), ["40.70,-74.00"])
+        self.assertEqual(service.weather_api.data, weather_snapshot)
+
+    def test_get_current_with_location_cache(self):
+        """
+        Testing get_current reuses the cached geolocation of a query.
+        """
+        weather_cache, location_cache = StripedTTLCache(maxsize=8, ttl=600), {}
+        find_geolocation = MockAPI.find_geolocation
+        with mock.patch.object(MockAPI, "find_geolocation", autospec=True, side_effect=find_geolocation) as mocker:
+            for _ in range(2):
+                service = WeatherService(MockAPI("New York, NY"), weather_cache, location_cache)
+                service.get_current(AnonymousUser())
+
+        self.assertEqual(mocker.call_count, 1)
+        self.assertEqual(service.weather_api.coordinates, "40.714,-74.006")
+        self.assertIn("new york ny", location_cache)
+
+    def test_get_current_records_stages(self):
+        """
+        Testing get_current records the time spent geocoding, fetching and rendering to its trace.
+        """
+        trace = metrics.Trace("weather New York, NY")
+        service = WeatherService(MockAPI("New York, NY"), StripedTTLCache(maxsize=8, ttl=600), {}, trace=trace)
+        service.get_current(AnonymousUser())
+
+        self.assertEqual(list(trace.stages), ["geocode", "onecall", "render"])
+        self.assertIn("render", metrics.metrics.stages)
+
+    def test_get_current_with_providers(self):
+        """
+        Testing get_current fetches the weather from the providers when it has them.
+        """
+        providers = mock.Mock(fetch=mock.Mock(return_value=weather_snapshot))
+        service = WeatherService(MockAPI("New York, NY"), StripedTTLCache(maxsize=8, ttl=600), {}, providers=providers)
+
+        self.assertEqual(service.get_current(AnonymousUser()), display_default_response)
+        providers.fetch.assert_called_once_with("40.714,-74.006")
+
+    def test_get_current_does_not_wait_on_background_refresh(self):
+        """
+        Testing a command fetches the weather itself while a background refresh of the same
+        coordinates is in flight, instead of sharing the refresh the rate limiter refuses.
+        """
+        fetching, release = threading.Event(), threading.Event()
+
+        def fetch(coordinates):
+            if current_priority() == BACKGROUND:
+                fetching.set()
+                release.wait(5)
+                raise RateLimited("Only the reserve is left.")
+            return weather_snapshot
+
+        errors = []
+
+        def refresh_weather():
+            try:
+                services.refresh_weather("40.70,-74.00", "40.714,-74.006")
+            except RateLimited as exc:
+                errors.append(exc)
+
+        providers = mock.Mock(fetch=mock.Mock(side_effect=fetch))
+        weather_cache = StripedTTLCache(maxsize=8, ttl=600)
+        with mock.patch.object(services, "providers", providers), mock.patch.object(
+            services, "weather_cache", weather_cache
+        ):
+            refresh = threading.Thread(target=refresh_weather)
+            refresh.start()
+            self.assertTrue(fetching.wait(5))
+            service = WeatherService(MockAPI("New York, NY"), weather_cache, {}, providers=providers)
+            try:
+                self.assertEqual(service.get_current(AnonymousUser()), display_default_response)
+            finally:
+                release.set()
+                refresh.join()
+
+        self.assertEqual(providers.fetch.call_count, 2)
+        self.assertEqual(len(errors), 1)
+
+    def test_get_current_with_rendered_cache(self):
+        """
+        Testing get_current reuses a rendered line until the weather snapshot changes,
+        and renders every display format separately.
+        """
+        rendered_cache = StripedTTLCache(maxsize=8, ttl=600)
+        newer = WeatherSnapshot(*weather_snapshot._fields()[:9], low=40.0)
+        display_format = MockAPI.display_format
+        with mock.patch.object(MockAPI, "display_format", autospec=True, side_effect=display_format) as mocker:
+            for format, snapshot in ((1, weather_snapshot), (1, weather_snapshot), (2, weather_snapshot), (1, newer)):
+                user = get_mock_user()
+                user.format = format
+                with mock.patch.object(MockAPI, "fetch_weather", return_value=snapshot):
+                    weather_cache = StripedTTLCache(maxsize=8, ttl=600)
+                    service = WeatherService(MockAPI("New York, NY"), weather_cache, {}, rendered_cache=rendered_cache)
+                    self.assertEqual(service.get_current(user), display_default_response)
+
+        self.assertEqual([call.args[1] for call in mocker.call_args_list], [1, 2, 1])
+        self.assertEqual(len(rendered_cache), 2)
+
+    def test_get_forecast(self):
+        """
+        Testing get_forecast reads the days and hours from the same cached weather data as get_current.
+        """
+        weather_cache = StripedTTLCache(maxsize=8, ttl=600)
+        fetch_patch = mock.patch.object(OpenWeatherMapAPI, "fetch_weather", return_value=weather_snapshot)
+        # The forecast skips the days and hours that ended, so it is shown as of the time of the fixture.
+        time_patch = mock.patch.object(time, "time", return_value=weather_response["current"]["dt"])
+        with fetch_patch as mocker, time_patch:
+            current = WeatherService(OpenWeatherMapAPI(""), weather_cache).get_current(get_mock_user())
+            daily = WeatherService(OpenWeatherMapAPI(""), weather_cache).get_forecast(get_mock_user())
+            hourly = WeatherService(OpenWeatherMapAPI(""), weather_cache).get_forecast(get_mock_user(), hourly=True)
+
+        self.assertEqual(mocker.call_count, 1)
+        self.assertEqual(current, display_default_response)
+        self.assertIn("Clear sky 60.1F/15.6C - 45.5F/7.5C", daily)
+        self.assertIn("Overcast clouds 51.8F/11.0C", hourly)
+
+    def test_get_forecast_refetches_weather_without_forecasts(self):
+        """
+        Testing get_forecast fetches cached weather that came from a provider without forecasts
+        again from one that has them, and caches it for the next forecast.
+        """
+        weather_cache = StripedTTLCache(maxsize=8, ttl=600)
+        weather_cache[snap_coordinates("40.714,-74.006")] = WeatherSnapshot.from_weatherstack(current_response)
+        primary = Provider("weatherstack", WeatherstackAPI)
+        secondary = Provider("openweathermap", OpenWeatherMapAPI)
+        primary.fetch = mock.Mock(side_effect=WeatherNotFound("FAILED"))
+        secondary.fetch = mock.Mock(return_value=weather_snapshot)
+        registry = ProviderRegistry([primary, secondary])
+        time_patch = mock.patch.object(time, "time", return_value=weather_response["current"]["dt"])
+        with time_patch:
+            for _ in range(2):
+                daily = WeatherService(OpenWeatherMapAPI(""), weather_cache, providers=registry).get_forecast(
+                    get_mock_user()
+                )
+                self.assertIn("Clear sky 60.1F/15.6C - 45.5F/7.5C", daily)
+
+        primary.fetch.assert_not_called()
+        secondary.fetch.assert_called_once_with("40.714,-74.006")
+        self.assertEqual(weather_cache[snap_coordinates("40.714,-74.006")], weather_snapshot)
+
+        registry = ProviderRegistry([primary])
+        with self.assertRaisesRegex(WeatherNotFound, "forecast"):
+            registry.fetch_forecast("40.714,-74.006")
+
+    def test_get_location_with_location_store(self):
+        """
+        Testing get_location uses the persistent location store when the cache misses,
+        and only finds the location with the weather api if it isn't stored.
+        """
+        stored = {"location": "New Orleans", "region": "Louisiana", "coordinates": "29.974,-90.087"}
+        location_store = mock.Mock()
+        location_store.lookup.side_effect = [stored, None]
+
+        service = WeatherService(MockAPI("70119"), {}, {}, location_store)
+        self.assertEqual(service.get_location(), stored)
+
+        service = WeatherService(MockAPI("New York, NY"), {}, {}, location_store)
+        geo = service.get_location()
+        self.assertEqual(geo["location"], "New York")
+        location_store.store.assert_called_once_with("new york ny", geo)
+
+    def test_get_location_ignores_location_store_errors(self):
+        """
+        Testing get_location still finds the location when the persistent store fails.
+        """
+        location_store = mock.Mock()
+        location_store.lookup.side_effect = DatabaseError("FAILED")
+        location_store.store.side_effect = DatabaseError("FAILED")
+
+        service = WeatherService(MockAPI("New York, NY"), {}, {}, location_store)
+        self.assertEqual(service.get_location()["location"], "New York")
+
+    def test_get_location_with_aliases(self):
+        """
+        Testing get_location resolves other spellings of a location it already found,
+        and the name it resolved to, without the weather api.
+        """
+        aliases = AliasIndex(StripedTTLCache(maxsize=8, ttl=600))
+        find_geolocation = MockAPI.find_geolocation
+        with mock.patch.object(MockAPI, "find_geolocation", autospec=True, side_effect=find_geolocation) as mocker:
+            for query in ("New York, New York", "new york,NY", "New York, NY, USA"):
+                service = WeatherService(MockAPI(query), {}, {}, aliases=aliases)
+                self.assertEqual(service.get_location()["coordinates"], "40.714,-74.006")
+
+        self.assertEqual(mocker.call_count, 1)
+        self.assertEqual(len(aliases), 1)
+
+        with mock.patch.object(MockAPI, "find_geolocation", autospec=True, side_effect=find_geolocation) as mocker:
+            WeatherService(MockAPI("10007"), {}, {}, aliases=aliases).get_location()
+            WeatherService(MockAPI("10007-1234"), {}, {}, aliases=aliases).get_location()
+
+        self.assertEqual(mocker.call_count, 1)
+        self.assertEqual(aliases.get("10007")["location"], "New York")
+
+    def test_get_location_with_gazetteer(self):
+        """
+        Testing get_location uses the gazetteer before the location store and weather api.
+        """
+        gazetteer = mock.Mock()
+        gazetteer.resolve.return_value = {"location": "New Orleans", "region": "Louisiana", "coordinates": "1,1"}
+        location_store = mock.Mock()
+
+        service = WeatherService(MockAPI("70119"), {}, {}, location_store, gazetteer)
+        self.assertEqual(service.get_location()["location"], "New Orleans")
+        self.assertFalse(location_store.lookup.called)
+
+    def test_get_location_and_weather_async(self):
+        """
+        Testing get_location_async and get_weather_async find the same location and weather on the engine.
+        """
+        engine = WeatherEngine(workers=2)
+        engine.start()
+        try:
+            service = WeatherService(MockAPI("New York, NY"), StripedTTLCache(maxsize=8, ttl=600), {})
+            location = engine.run(service.get_location_async(engine))
+            weather, age = engine.run(service.get_weather_async(engine, snap_coordinates(location["coordinates"])))
+        finally:
+            engine.stop()
+
+        self.assertEqual(location["coordinates"], "40.714,-74.006")
+        self.assertEqual((weather, age), (weather_snapshot, None))
+
+    def test_get_current_serves_stale_weather(self):
+        """
+        Testing expired weather data in its grace period is served with its age
+        while one revalidation fetches it again in the background.
+        """
+        now = [0.0]
+        weather_cache = StripedTTLCache(maxsize=8, ttl=600, grace=1800, timer=lambda: now[0])
+        weather_cache["40.70,-74.00"] = weather_snapshot
+        now[0] = 900.0
+
+        fetched = threading.Event()
+        release = threading.Event()
+
+        def fetch_weather(api):
+            fetched.set()
+            release.wait(5)
+            return weather_snapshot
+
+        with mock.patch.object(MockAPI, "fetch_weather", autospec=True, side_effect=fetch_weather) as mocker:
+            for _ in range(2):
+                weather = WeatherService(MockAPI(""), weather_cache).get_current(get_mock_user())
+                self.assertEqual(weather, display_default_response + " | \x02Updated\x02: 15m ago")
+            self.assertTrue(fetched.wait(5))
+            release.set()
+            for _ in range(500):
+                if "40.70,-74.00" in weather_cache:
+                    break
+                time.sleep(0.01)
+
+        self.assertEqual(mocker.call_count, 1)
+        weather = WeatherService(MockAPI(""), weather_cache).get_current(get_mock_user())
+        self.assertEqual(weather, display_default_response)
+
+    def test_query_many(self):
+        """
+        Testing query_many resolves each distinct query once, fetches each distinct
+        snapped coordinates once, and returns results and errors in order.
+        """
+
+        mock_find_geolocation = MockAPI.find_geolocation
+
+        def find_geolocation(api):
+            if api.query == "nowhere":
+                raise LocationNotFound("Unable to find this location.")
+            mock_find_geolocation(api)
+
+        engine = WeatherEngine(workers=2)
+        engine.start()
+        try:
+            services_patch = mock.patch.multiple(
+                services,
+                OpenWeatherMapAPI=MockAPI,
+                providers=None,
+                GeoCache=None,
+                gazetteer=None,
+                engine=engine,
+                weather_cache=StripedTTLCache(maxsize=8, ttl=600),
+                ttl_cache=StripedTTLCache(maxsize=8, ttl=600),
+                alias_index=AliasIndex(StripedTTLCache(maxsize=8, ttl=600)),
+                rendered_cache=None,
+            )
+            geo_patch = mock.patch.object(MockAPI, "find_geolocation", autospec=True, side_effect=find_geolocation)
+            fetch_patch = mock.patch.object(MockAPI, "fetch_weather", return_value=weather_snapshot)
+            with services_patch, geo_patch as geo, fetch_patch as fetch:
+                results = services.query_many(
+                    [
+                        ("New York, NY", AnonymousUser()),
+                        ("nowhere", AnonymousUser()),
+                        ("", get_mock_user()),
+                        ("New York, NY", AnonymousUser()),
+                        ("", AnonymousUser()),
+                    ]
+                )
+        finally:
+            engine.stop()
+
+        self.assertEqual(results[0], display_default_response)
+        self.assertIsInstance(results[1], LocationNotFound)
+        self.assertEqual(results[2:4], [display_default_response] * 2)
+        self.assertIsInstance(results[4], LocationNotFound)
+        # MockAPI sets a saved user's location with find_geolocation too, hence the empty query.
+        self.assertEqual(sorted(call[0][0].query for call in geo.call_args_list), ["", "New York, NY", "nowhere"])
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_snap_coordinates(self):
+        """
+        Testing snap_coordinates snaps nearby coordinates to the same grid point.
+        """
+        self.assertEqual(snap_coordinates("29.974,-90.087", 0.05), "29.95,-90.10")
+        self.assertEqual(snap_coordinates("29.951,-90.076", 0.05), "29.95,-90.10")
+        self.assertEqual(snap_coordinates("29.974,-90.087", 0.5), "30.0,-90.0")
+        self.assertEqual(snap_coordinates("29.974,-90.087", 1), "30,-90")
+
 
 ##################################
 # Unit tests for utils/weather.py
@@ -188,7 +746,7 @@ class UtilsOpenWeatherMapApiTestCase(SupyTestCase):
         self.assertTrue(isinstance(weather, WeatherAPI))
 
 
-@mock.patch("requests.get", autospec=True)
+@mock.patch("requests.Session.get", autospec=True)
 class UtilsFindGeoTestCase(SupyTestCase):
     def setUp(self) -> None:
         SupyTestCase.setUp(self)
@@ -254,7 +812,7 @@ class UtilsFindGeoTestCase(SupyTestCase):
         self.assertTrue(mocker.return_value.raise_for_status.called)
 
 
-@mock.patch("requests.get", autospec=True)
+@mock.patch("requests.Session.get", autospec=True)
 class UtilsFindWeatherTestCase(SupyTestCase):
     def setUp(self):
         SupyTestCase.setUp(self)
@@ -265,25 +823,25 @@ class UtilsFindWeatherTestCase(SupyTestCase):
         """
         mocker.side_effect = [
             mock.Mock(status_code=200, json=lambda: geo_response),
-            mock.Mock(status_code=200, json=lambda: weather_response),
+            _mock_weather_response(),
         ]
         mock_user = get_mock_user()
         service = OpenWeatherMapAPI("40.714,-74.006")
         service.find_current_weather(mock_user)
 
-        self.assertEqual(service.data, weather_response)
+        self.assertEqual(service.data, weather_snapshot)
 
     def test_find_current_weather_with_empty_query(self, mocker: mock.patch) -> None:
         """
         Testing find_current_weather will use the User object to set geo attributes instead of
         find_geolocation with an empty query and return back the correct dictionary of results.
         """
-        mocker.side_effect = [mock.Mock(status_code=200, json=lambda: weather_response)]
+        mocker.side_effect = [_mock_weather_response()]
         mock_user = get_mock_user()
         service = OpenWeatherMapAPI("")
         service.find_current_weather(mock_user)
 
-        self.assertEqual(service.data, weather_response)
+        self.assertEqual(service.data, weather_snapshot)
 
     def test_find_geolocation_raises_http_error(self, mocker: mock.patch) -> None:
         """
@@ -350,6 +908,1176 @@ class UtilsFormatDirectionTestCase(SupyTestCase):
         self.assertEqual(service.format_directions(None), "N/A")
 
 
+###############################
+# Unit tests for utils/cache.py
+###############################
+class UtilsStripedTTLCacheTestCase(SupyTestCase):
+    def test_entries_expire(self):
+        """
+        Testing entries are no longer returned once their ttl has passed.
+        """
+        now = [0.0]
+        cache = StripedTTLCache(maxsize=8, ttl=10, timer=lambda: now[0])
+        cache["70119"] = geo_response
+
+        self.assertEqual(cache["70119"], geo_response)
+        now[0] = 10.0
+        self.assertNotIn("70119", cache)
+        self.assertIsNone(cache.get("70119"))
+        self.assertEqual(cache.stats(), {"entries": 0, "bytes": 0, "hits": 1, "misses": 1, "evictions": 0})
+
+    def test_get_stale(self):
+        """
+        Testing expired entries can still be read as stale during the grace period.
+        """
+        now = [0.0]
+        cache = StripedTTLCache(maxsize=8, ttl=10, grace=20, timer=lambda: now[0])
+        cache["70119"] = geo_response
+
+        self.assertEqual(cache.get_stale("70119"), (geo_response, 0.0))
+        now[0] = 15.0
+        self.assertIsNone(cache.get("70119"))
+        self.assertEqual(cache.get_stale("70119"), (geo_response, 15.0))
+        now[0] = 30.0
+        self.assertIsNone(cache.get_stale("70119"))
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        """
+        Testing the least recently used entry of a stripe is evicted when it is full.
+        """
+        cache = StripedTTLCache(maxsize=2, ttl=10, stripes=1)
+        cache["70119"] = 1
+        cache["70118"] = 2
+        cache["70119"]
+        cache["70117"] = 3
+
+        self.assertEqual(sorted(cache), ["70117", "70119"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_byte_budget(self):
+        """
+        Testing entries are evicted to keep the cache within its byte budget, and their sizes are accounted.
+        """
+        small = approximate_size("70119") + approximate_size(geo_response) + entry_overhead
+        cache = StripedTTLCache(maxsize=100, ttl=10, stripes=1, maxbytes=small * 2)
+        cache["70119"] = geo_response
+        cache["70118"] = geo_response
+        self.assertEqual(cache.stats()["bytes"], small * 2)
+
+        cache["70117"] = geo_response
+        self.assertEqual(sorted(cache), ["70117", "70118"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        del cache["70117"]
+        self.assertEqual(cache.stats()["bytes"], small)
+
+    def test_compact(self):
+        """
+        Testing large cold entries are compressed and restored when they are used again.
+        """
+        forecast = {"daily": [weather_response["daily"][0]] * 8, "snapshot": weather_snapshot}
+        cache = StripedTTLCache(maxsize=8, ttl=10, stripes=1, compress_min=1024)
+        cache["29.95,-90.10"] = forecast
+        cache["40.70,-74.00"] = forecast
+        before = cache.stats()["bytes"]
+
+        self.assertEqual(cache.compact(), 1)
+        self.assertEqual(cache.compact(), 0)
+        compressed = cache.stats()["bytes"]
+        self.assertLess(compressed, before * 0.6)
+        self.assertEqual(cache["29.95,-90.10"], forecast)
+        self.assertGreater(cache.stats()["bytes"], before * 0.9)
+        self.assertEqual(list(cache), ["40.70,-74.00", "29.95,-90.10"])
+
+    def test_small_cache_fills_up(self):
+        """
+        Testing a striped cache holds maxsize entries whatever stripes their hashes land on,
+        and evicts from the stripe written to once the cache as a whole is full.
+        """
+        cache = StripedTTLCache(maxsize=64, ttl=10, stripes=8)
+        for i in range(64):
+            cache[f"key {i}"] = i
+
+        self.assertIn("stripes=8", repr(cache))
+        self.assertEqual((len(cache), cache.stats()["evictions"]), (64, 0))
+        for i in range(64, 128):
+            cache[f"key {i}"] = i
+        self.assertLessEqual(len(cache), 64 + 8)
+        self.assertIn("key 127", cache)
+
+        size = approximate_size("key 100") + approximate_size("x" * 100) + entry_overhead
+        cache = StripedTTLCache(maxsize=1000, ttl=10, stripes=8, maxbytes=size * 20)
+        for i in range(100, 300):
+            cache[f"key {i}"] = "x" * 100
+        self.assertGreaterEqual(len(cache), 20)
+        self.assertLessEqual(cache.stats()["bytes"], size * (20 + 8))
+        self.assertEqual(cache.stats()["entries"], len(list(cache)))
+
+    def test_concurrent_access(self):
+        """
+        Testing many threads can read and write the cache at once.
+        """
+        cache = StripedTTLCache(maxsize=128, ttl=10, stripes=4)
+
+        def worker(offset):
+            for i in range(1000):
+                cache[(offset + i) % 300] = i
+                cache.get(i % 300)
+                if i % 10 == 0:
+                    cache.pop(i % 300, None)
+
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(len(cache), 128)
+
+
+################################
+# Unit tests for utils/engine.py
+################################
+class UtilsWeatherEngineTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.engine = WeatherEngine(workers=2)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        SupyTestCase.tearDown(self)
+
+    def test_run_and_call(self):
+        """
+        Testing coroutines submitted from another thread can hand blocking calls to the workers.
+        """
+
+        async def pipeline():
+            return await self.engine.call(threading.current_thread), threading.current_thread()
+
+        worker, loop = self.engine.run(pipeline())
+        self.assertTrue(worker.name.startswith("WeatherBot-worker"))
+        self.assertEqual(loop.name, "WeatherBot-engine")
+        self.assertTrue(self.engine.running)
+
+    def test_gather_overlaps_blocking_calls(self):
+        """
+        Testing gather runs blocking calls on the workers at the same time and
+        returns results and exceptions in order.
+        """
+        barrier = threading.Barrier(2, timeout=5)
+
+        def fail():
+            raise LocationNotFound("FAILED")
+
+        results = self.engine.run(
+            self.engine.gather(self.engine.call(barrier.wait), self.engine.call(barrier.wait), self.engine.call(fail))
+        )
+        self.assertEqual(sorted(results[:2]), [0, 1])
+        self.assertIsInstance(results[2], LocationNotFound)
+
+    def test_initializer(self):
+        """
+        Testing workers are initialized before their first call, and a failing initializer
+        is logged and tried again without breaking the calls.
+        """
+        initializer = mock.Mock(side_effect=[DatabaseError("database is locked"), None])
+        engine = WeatherEngine(workers=1, initializer=initializer)
+        engine.start()
+        try:
+            for _ in range(3):
+                self.assertEqual(engine.run(engine.call(sum, [1, 2])), 3)
+        finally:
+            engine.stop()
+
+        self.assertEqual(initializer.call_count, 2)
+
+    def test_stop(self):
+        """
+        Testing a stopped engine refuses new coroutines and can be started again.
+        """
+        self.engine.stop()
+        self.assertFalse(self.engine.running)
+        coroutine = self.engine.gather()
+        self.assertRaises(RuntimeError, self.engine.submit, coroutine)
+        coroutine.close()
+        self.engine.start()
+        self.assertEqual(self.engine.run(self.engine.gather()), [])
+
+
+###################################
+# Unit tests for utils/gazetteer.py
+###################################
+class UtilsGazetteerTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.index_path = os.path.join(tempfile.mkdtemp(), "gazetteer.tsv")
+        rows = [
+            ("70119", "New Orleans", "Louisiana", "29.975,-90.086"),
+            ("New Orleans, LA", "New Orleans", "Louisiana", "29.975,-90.086"),
+            ("New Orleans, Louisiana", "New Orleans", "Louisiana", "29.975,-90.086"),
+            ("New York, NY", "New York", "New York", "40.714,-74.006"),
+            ("Montréal, QC", "Montréal", "Quebec", "45.509,-73.588"),
+            ("70119", "Duplicate", "Louisiana", "0.000,0.000"),
+        ]
+        self.assertEqual(build_index(rows, self.index_path), 5)
+        self.gazetteer = Gazetteer(self.index_path)
+
+    def tearDown(self):
+        self.gazetteer.close()
+        SupyTestCase.tearDown(self)
+
+    def test_normalize(self):
+        """
+        Testing normalize lowercases and strips accents, punctuation and extra whitespace.
+        """
+        self.assertEqual(normalize(" New Orleans,LA "), "new orleans la")
+        self.assertEqual(normalize("MONTRÉAL, QC"), "montreal qc")
+
+    def test_canonicalize(self):
+        """
+        Testing canonicalize gives every spelling of a US location the same key.
+        """
+        for query in ("New Orleans, LA", "new orleans louisiana", "New Orleans, Louisiana, USA", "NEW ORLEANS,LA,US"):
+            self.assertEqual(canonicalize(query), "new orleans la")
+        self.assertEqual(canonicalize("Charleston, West Virginia"), "charleston wv")
+        self.assertEqual(canonicalize("70119-1234"), "70119")
+        self.assertEqual(canonicalize("New York"), "new york")
+        self.assertEqual(canonicalize("Montréal, QC"), "montreal qc")
+
+    def test_lookup(self):
+        """
+        Testing lookup finds exact keys once normalized and keeps the first duplicate.
+        """
+        new_orleans = {"location": "New Orleans", "region": "Louisiana", "coordinates": "29.975,-90.086"}
+        self.assertEqual(self.gazetteer.lookup("70119"), new_orleans)
+        self.assertEqual(self.gazetteer.lookup("new orleans la"), new_orleans)
+        self.assertEqual(self.gazetteer.lookup("Montreal QC")["location"], "Montréal")
+        self.assertIsNone(self.gazetteer.lookup("New"))
+        self.assertIsNone(self.gazetteer.lookup("70118"))
+        self.assertIsNone(self.gazetteer.lookup("zzz"))
+
+    def test_resolve_prefix(self):
+        """
+        Testing resolve only uses a prefix match when every match is the same place.
+        """
+        self.assertEqual(len(self.gazetteer.search_prefix("new")), 3)
+        self.assertEqual(self.gazetteer.resolve("New Orleans")["location"], "New Orleans")
+        self.assertIsNone(self.gazetteer.resolve("New"))
+
+    def test_missing_index(self):
+        """
+        Testing a gazetteer without an index file finds nothing.
+        """
+        gazetteer = Gazetteer(os.path.join(tempfile.mkdtemp(), "missing.tsv"))
+        self.assertIsNone(gazetteer.resolve("70119"))
+        self.assertEqual(gazetteer.search_prefix("70119"), [])
+
+
+#################################
+# Unit tests for utils/refresh.py
+#################################
+class UtilsRefreshSchedulerTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.now = [0.0]
+        self.cache = StripedTTLCache(maxsize=8, ttl=600, timer=lambda: self.now[0])
+        self.refresh = mock.Mock(side_effect=lambda key, coordinates: self.cache.__setitem__(key, weather_response))
+        self.scheduler = RefreshScheduler(self.cache, self.refresh, window=60, half_life=1800, min_score=2)
+
+    def test_refreshes_hot_entries_before_expiry(self):
+        """
+        Testing only keys asked for often are refreshed, and only once they are about to expire.
+        """
+        self.cache["29.95,-90.10"] = weather_response
+        self.cache["40.70,-74.00"] = weather_response
+        for _ in range(3):
+            self.scheduler.record("29.95,-90.10", "29.974,-90.087")
+        self.scheduler.record("40.70,-74.00", "40.714,-74.006")
+
+        self.assertEqual(self.scheduler.run(), 0)
+        self.now[0] = 550.0
+        self.assertEqual(self.scheduler.due(), [("29.95,-90.10", "29.974,-90.087")])
+        self.assertEqual(self.scheduler.run(), 1)
+        self.refresh.assert_called_once_with("29.95,-90.10", "29.974,-90.087")
+        self.assertEqual(self.cache.expires_at("29.95,-90.10"), 1150.0)
+
+    def test_counts_used_and_wasted_refreshes(self):
+        """
+        Testing refreshes are counted as used when asked for again, and wasted otherwise.
+        """
+        self.cache["29.95,-90.10"] = weather_response
+        for _ in range(3):
+            self.scheduler.record("29.95,-90.10", "29.974,-90.087")
+
+        self.now[0] = 550.0
+        self.scheduler.run()
+        self.scheduler.record("29.95,-90.10", "29.974,-90.087")
+        self.now[0] = 1100.0
+        self.scheduler.run()
+        self.now[0] = 1800.0
+        self.scheduler.due()
+
+        self.assertEqual(self.scheduler.stats(), {"refreshes": 2, "hits": 1, "wasted": 1, "tracked": 1})
+
+    def test_failed_refresh_is_not_counted(self):
+        """
+        Testing a refresh that fails is logged and not counted.
+        """
+        self.refresh.side_effect = LocationNotFound("FAILED")
+        self.assertFalse(self.scheduler.refresh_key("29.95,-90.10", "29.974,-90.087"))
+        self.assertEqual(self.scheduler.refreshes, 0)
+
+    def test_refresh_weather(self):
+        """
+        Testing the refresh fetches the weather at background priority into the weather cache.
+        """
+        priorities = []
+        registry = mock.Mock(spec=ProviderRegistry)
+        registry.fetch.side_effect = lambda coordinates: priorities.append(current_priority()) or weather_response
+        with mock.patch.object(services, "providers", registry), mock.patch.object(
+            services, "weather_cache", StripedTTLCache(maxsize=8, ttl=600)
+        ):
+            services.refresh_weather("29.95,-90.10", "29.974,-90.087")
+            self.assertEqual(services.weather_cache["29.95,-90.10"], weather_response)
+
+        registry.fetch.assert_called_once_with("29.974,-90.087")
+        self.assertEqual(priorities, [BACKGROUND])
+
+
+##################################
+# Unit tests for utils/sessions.py
+##################################
+class UtilsSessionPoolTestCase(SupyTestCase):
+    def test_sessions_share_adapters(self):
+        """
+        Testing that each thread gets its own session, but that every
+        session uses the same pooled adapter for a host.
+        """
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(pool.session))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(pool.session, sessions[0])
+        self.assertIs(pool.session, pool.session)
+        self.assertIs(
+            pool.session.get_adapter("https://api.openweathermap.org/data/2.5/onecall"),
+            sessions[0].get_adapter("https://api.openweathermap.org/data/2.5/onecall"),
+        )
+
+    def test_get_counts_responses(self):
+        """
+        Testing that get() counts responses by host and status code, and failures by exception.
+        """
+        metrics.metrics.reset()
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        with mock.patch("requests.Session.get", return_value=mock.Mock(status_code=429)):
+            pool.get("https://api.openweathermap.org/data/2.5/onecall")
+            pool.get("https://api.openweathermap.org/data/2.5/onecall")
+        with mock.patch("requests.Session.get", side_effect=RequestException("FAILED")):
+            with self.assertRaises(RequestException):
+                pool.get("https://api.openweathermap.org/data/2.5/onecall")
+
+        self.assertEqual(
+            metrics.metrics.upstream,
+            {("api.openweathermap.org", "429"): 2, ("api.openweathermap.org", "RequestException"): 1},
+        )
+
+    def test_get_retries_server_errors(self):
+        """
+        Testing that get() retries server errors and connection errors, but not client errors.
+        """
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        url = "https://api.openweathermap.org/data/2.5/onecall"
+        responses = [mock.Mock(status_code=503), ConnectionError("FAILED"), mock.Mock(status_code=200)]
+        with mock.patch("time.sleep") as sleep, mock.patch("requests.Session.get", side_effect=responses) as mocker:
+            self.assertEqual(pool.get(url).status_code, 200)
+        self.assertEqual(mocker.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertIn("timeout", mocker.call_args[1])
+
+        with mock.patch("requests.Session.get", return_value=mock.Mock(status_code=404)) as mocker:
+            self.assertEqual(pool.get(url).status_code, 404)
+        self.assertEqual(mocker.call_count, 1)
+
+    def test_get_takes_a_token_per_attempt(self):
+        """
+        Testing that get() takes a rate limit token for every attempt, and stops retrying without one.
+        """
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        url = "https://api.openweathermap.org/data/2.5/onecall"
+        acquire = mock.Mock()
+        responses = [mock.Mock(status_code=503), mock.Mock(status_code=200)]
+        with mock.patch("time.sleep"), mock.patch("requests.Session.get", side_effect=responses):
+            self.assertEqual(pool.get(url, acquire=acquire).status_code, 200)
+        self.assertEqual(acquire.call_count, 2)
+
+        acquire = mock.Mock(side_effect=[None, RateLimited("FAILED")])
+        get_patch = mock.patch("requests.Session.get", return_value=mock.Mock(status_code=503))
+        with mock.patch("time.sleep"), get_patch as mocker:
+            with self.assertRaises(RateLimited):
+                pool.get(url, acquire=acquire)
+        self.assertEqual(mocker.call_count, 1)
+        self.assertEqual(pool.breaker("api.openweathermap.org").state, CLOSED)
+
+    def test_get_retries_within_deadline(self):
+        """
+        Testing that get() cuts the last attempt short and stops retrying at the deadline.
+        """
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        clock = [0.0]
+        timeouts = []
+
+        def get(url, **kwargs):
+            timeouts.append(kwargs["timeout"])
+            clock[0] += kwargs["timeout"]
+            raise Timeout("FAILED")
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        fake_time = mock.Mock(monotonic=lambda: clock[0], sleep=sleep)
+        with mock.patch.object(sessions, "time", fake_time), mock.patch.object(sessions, "deadline", 12.0):
+            with mock.patch.object(sessions, "timeout", 10.0), mock.patch("requests.Session.get", side_effect=get):
+                with self.assertRaises(Timeout):
+                    pool.get("https://api.openweathermap.org/data/2.5/onecall")
+
+        self.assertEqual(len(timeouts), 2)
+        self.assertEqual(timeouts[0], 10.0)
+        self.assertLess(timeouts[1], 2.0)
+        self.assertLessEqual(clock[0], 12.0)
+
+    def test_get_fails_fast_while_circuit_is_open(self):
+        """
+        Testing that get() stops sending requests to a host once its circuit opens.
+        """
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        url = "https://api.openweathermap.org/data/2.5/onecall"
+        pool.breakers["api.openweathermap.org"] = CircuitBreaker("api.openweathermap.org", failure_threshold=3)
+        get_patch = mock.patch("requests.Session.get", side_effect=ConnectionError("FAILED"))
+        with mock.patch("time.sleep"), get_patch as mocker:
+            with self.assertRaises(ConnectionError):
+                pool.get(url)
+            with self.assertRaises(CircuitOpen):
+                pool.get(url)
+        self.assertEqual(mocker.call_count, 3)
+
+    def test_warm_ignores_request_errors(self):
+        """
+        Testing that warm() doesn't raise when a host can't be reached.
+        """
+        pool = SessionPool({"https://api.openweathermap.org": 4})
+        with mock.patch("requests.Session.head", side_effect=RequestException("FAILED")) as mocker:
+            pool.warm()
+        self.assertTrue(mocker.called)
+
+
+######################################
+# Unit tests for utils/aiosessions.py
+######################################
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Local upstream for the async session pool, with a path for every kind of response.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address[1]))
+        if self.path.startswith("/flaky") and self.server.failures:
+            self.server.failures -= 1
+            self.send_body(503, b"{}")
+        elif self.path.startswith("/slow"):
+            time.sleep(1)
+            self.send_body(200, b"{}")
+        elif self.path.startswith("/chunked"):
+            body = gzip.compress(json.dumps(geo_response).encode())
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(body), 64):
+                chunk = body[start:start + 64]
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_body(200, json.dumps(geo_response).encode())
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Upstream(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The client hangs up on the slow path once it times out.
+        pass
+
+
+class UtilsAsyncSessionPoolTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = Upstream(("127.0.0.1", 0), UpstreamHandler)
+        self.server.requests, self.server.failures = [], 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.pool = AsyncSessionPool(SessionPool({self.url: 2}))
+        self.engine = WeatherEngine(workers=2)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.run(self.pool.close())
+        self.engine.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        SupyTestCase.tearDown(self)
+
+    def test_get_reuses_connections(self):
+        """
+        Testing that get() decodes responses and sends requests one after another over one connection.
+        """
+        for _ in range(3):
+            response = self.engine.run(self.pool.get(f"{self.url}/geo", params={"q": "New York"}))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), geo_response)
+
+        self.assertEqual(self.server.requests[0][0], "/geo?q=New+York")
+        self.assertEqual(len({port for _, port in self.server.requests}), 1)
+
+    def test_get_reads_chunked_gzip(self):
+        """
+        Testing that get() reads chunked and gzipped bodies.
+        """
+        response = self.engine.run(self.pool.get(f"{self.url}/chunked"))
+        self.assertEqual(response.json(), geo_response)
+
+    def test_get_bounds_connections(self):
+        """
+        Testing that get() opens no more connections to a host than its pool size.
+        """
+        results = self.engine.run(self.engine.gather(*(self.pool.get(f"{self.url}/geo") for _ in range(6))))
+        self.assertEqual([response.status_code for response in results], [200] * 6)
+        self.assertLessEqual(len({port for _, port in self.server.requests}), 2)
+
+    def test_get_retries_server_errors(self):
+        """
+        Testing that get() retries server errors, taking a rate limit token for every attempt.
+        """
+        self.server.failures = 1
+        acquire = mock.Mock()
+        with mock.patch("random.uniform", return_value=0):
+            response = self.engine.run(self.pool.get(f"{self.url}/flaky", acquire=acquire))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(acquire.call_count, 2)
+        with self.assertRaises(HTTPError) as context:
+            Response(self.url, 503, {}, b"{}").raise_for_status()
+        self.assertEqual(context.exception.response.status_code, 503)
+
+    def test_get_times_out(self):
+        """
+        Testing that get() raises requests' Timeout once the deadline is used up.
+        """
+        with mock.patch.object(aiosessions, "deadline", 0.2):
+            with self.assertRaises(Timeout):
+                self.engine.run(self.pool.get(f"{self.url}/slow", timeout=0.1))
+
+
+#################################
+# Unit tests for utils/breaker.py
+#################################
+class UtilsCircuitBreakerTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.metrics.reset()
+        self.now = [0.0]
+        self.breaker = CircuitBreaker("api.openweathermap.org", 2, 30, lambda: self.now[0])
+
+    def test_opens_and_recovers(self):
+        """
+        Testing the circuit opens after failures in a row, and closes when a trial call succeeds.
+        """
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaisesRegex(CircuitOpen, "try again in 30s"):
+            self.breaker.allow()
+
+        self.now[0] = 30.0
+        self.breaker.allow()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.allow()
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(
+            metrics.metrics.circuits,
+            {
+                ("api.openweathermap.org", OPEN): 1,
+                ("api.openweathermap.org", HALF_OPEN): 1,
+                ("api.openweathermap.org", CLOSED): 1,
+            },
+        )
+
+    def test_failed_trial_opens_again(self):
+        """
+        Testing a failed trial call opens the circuit for another reset timeout.
+        """
+        for _ in range(2):
+            self.breaker.failure()
+        self.now[0] = 31.0
+        self.breaker.allow()
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now[0] = 60.0
+        with self.assertRaises(CircuitOpen):
+            self.breaker.allow()
+
+
+###################################
+# Unit tests for utils/providers.py
+###################################
+class UtilsProviderRegistryTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.primary = Provider("openweathermap", OpenWeatherMapAPI)
+        self.secondary = Provider("weatherstack", WeatherstackAPI)
+        self.registry = ProviderRegistry([self.primary, self.secondary], workers=4, delay=0.05, min_delay=0)
+
+    def tearDown(self):
+        self.registry.close()
+        super().tearDown()
+
+    def test_fast_primary_is_not_hedged(self):
+        """
+        Testing a primary that answers within its p95 is the only provider asked.
+        """
+        self.primary.fetch = mock.Mock(return_value="primary")
+        self.secondary.fetch = mock.Mock(return_value="secondary")
+
+        self.assertEqual(self.registry.fetch("40.714,-74.006"), "primary")
+        self.secondary.fetch.assert_not_called()
+        self.assertEqual(self.registry.hedges, 0)
+
+    def test_slow_primary_is_hedged(self):
+        """
+        Testing a primary slower than its p95 is hedged, and the first answer wins.
+        """
+        answered = threading.Event()
+        self.primary.fetch = lambda coordinates: answered.wait(5) and "primary"
+        self.secondary.fetch = mock.Mock(return_value="secondary")
+        try:
+            self.assertEqual(self.registry.fetch("40.714,-74.006"), "secondary")
+        finally:
+            answered.set()
+
+        self.secondary.fetch.assert_called_once_with("40.714,-74.006")
+        self.assertEqual((self.registry.hedges, self.registry.hedge_wins), (1, 1))
+
+    def test_failed_primary_fails_over(self):
+        """
+        Testing a failed primary fails over to the next provider right away, and the
+        first error is raised when every provider fails.
+        """
+        self.primary.fetch = mock.Mock(side_effect=WeatherNotFound("primary"))
+        self.secondary.fetch = mock.Mock(return_value="secondary")
+        self.assertEqual(self.registry.fetch("40.714,-74.006"), "secondary")
+        self.assertEqual((self.registry.hedges, self.registry.failovers), (0, 1))
+
+        self.secondary.fetch.side_effect = WeatherNotFound("secondary")
+        with self.assertRaisesRegex(WeatherNotFound, "primary"):
+            self.registry.fetch("40.714,-74.006")
+
+    def test_fetch_async_is_hedged(self):
+        """
+        Testing fetch_async hedges a slow primary with a task on the event loop, and fails
+        over from a failed one, like fetch does.
+        """
+        # Made on the engine's loop, since an event belongs to the loop it was made on before 3.10.
+        answered = {}
+
+        async def slow(coordinates):
+            await answered["event"].wait()
+            return "primary"
+
+        async def fast(coordinates):
+            return "secondary"
+
+        async def failed(coordinates):
+            raise WeatherNotFound("primary")
+
+        async def fetch():
+            answered["event"] = asyncio.Event()
+            try:
+                return await self.registry.fetch_async("40.714,-74.006")
+            finally:
+                answered["event"].set()
+
+        engine = WeatherEngine(workers=1)
+        engine.start()
+        try:
+            self.primary.fetch_async, self.secondary.fetch_async = slow, fast
+            self.assertEqual(engine.run(fetch()), "secondary")
+            self.primary.fetch_async = failed
+            self.assertEqual(engine.run(fetch()), "secondary")
+        finally:
+            engine.stop()
+
+        self.assertEqual((self.registry.hedges, self.registry.hedge_wins, self.registry.failovers), (1, 1, 1))
+
+    def test_tracks_latency_and_errors(self):
+        """
+        Testing providers track their moving average latency, error rate and p95,
+        and providers failing too often are ranked last.
+        """
+        for milliseconds in range(1, 21):
+            self.primary.record(milliseconds / 1000, failed=False)
+        self.assertEqual(self.primary.p95(), 0.019)
+        self.assertAlmostEqual(self.registry.hedge_delay(self.primary), 0.019)
+        self.assertGreater(self.primary.latency, 0.015)
+
+        for _ in range(4):
+            self.primary.record(1.0, failed=True)
+        self.assertGreater(self.primary.error_rate, 0.5)
+        self.assertEqual(self.registry.ranked(), [self.secondary, self.primary])
+
+    def test_weatherstack_provider(self):
+        """
+        Testing the Weatherstack provider fetches the current weather of the coordinates.
+        """
+        response = mock.Mock(status_code=200, content=json.dumps(current_response).encode())
+        response.json = lambda: current_response
+        with mock.patch("requests.Session.get", return_value=response) as mocker:
+            snapshot = self.secondary.fetch("40.714,-74.006")
+
+        self.assertEqual(snapshot, WeatherSnapshot.from_weatherstack(current_response))
+        self.assertEqual(mocker.call_args[1]["params"]["query"], "40.714,-74.006")
+        self.assertEqual(self.secondary.calls, 1)
+
+    def test_make_registry(self):
+        """
+        Testing the registry is made of the providers named, and unknown names are refused.
+        """
+        registry = make_registry(["weatherstack", "openweathermap"])
+        self.assertEqual([provider.name for provider in registry.providers], ["weatherstack", "openweathermap"])
+        self.assertRaises(ValueError, make_registry, ["darksky"])
+
+
+###################################
+# Unit tests for utils/ratelimit.py
+###################################
+class UtilsRateLimiterTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = [0.0]
+        self.limiter = RateLimiter({"openweathermap": ((10, 60.0), (20, 3600.0))}, 0.2, lambda: self.now[0])
+
+    def test_buckets_refill(self):
+        """
+        Testing calls over a bucket fail fast and are allowed again once it refills.
+        """
+        for _ in range(10):
+            self.limiter.acquire("openweathermap", "key")
+        with self.assertRaisesRegex(RateLimited, "try again in 6s"):
+            self.limiter.acquire("openweathermap", "key")
+
+        self.limiter.acquire("openweathermap", "other key")
+        self.limiter.acquire("weatherstack", "key")
+        self.now[0] = 12.0
+        self.limiter.acquire("openweathermap", "key")
+        self.limiter.acquire("openweathermap", "key")
+
+    def test_all_buckets_or_none(self):
+        """
+        Testing a call refused by one bucket takes no token from the others.
+        """
+        for minute in range(2):
+            self.now[0] = minute * 60.0
+            for _ in range(10):
+                self.limiter.acquire("openweathermap", "key")
+        self.now[0] = 120.0
+        with self.assertRaisesRegex(RateLimited, "try again in 60s"):
+            self.limiter.acquire("openweathermap", "key")
+
+        minute, hour = self.limiter._buckets[("openweathermap", "key")]
+        self.assertEqual(minute.tokens, 10)
+        self.assertLess(hour.tokens, 1)
+
+    def test_background_leaves_reserve(self):
+        """
+        Testing background calls stop at the reserve, which interactive calls can still use.
+        """
+        with priority(BACKGROUND):
+            self.assertEqual(current_priority(), BACKGROUND)
+            for _ in range(8):
+                self.limiter.acquire("openweathermap", "key")
+            with self.assertRaises(RateLimited):
+                self.limiter.acquire("openweathermap", "key")
+        self.assertEqual(current_priority(), INTERACTIVE)
+
+        self.limiter.acquire("openweathermap", "key")
+        self.limiter.acquire("openweathermap", "key")
+        with self.assertRaises(RateLimited):
+            self.limiter.acquire("openweathermap", "key")
+
+    def test_fetch_weather_is_rate_limited(self):
+        """
+        Testing fetch_weather fails without sending a request once the quota is used up.
+        """
+        weather_api = OpenWeatherMapAPI("", rate_limiter=self.limiter)
+        weather_api.coordinates = "40.714,-74.006"
+        with mock.patch("requests.Session.get", return_value=_mock_weather_response()) as mocker:
+            for _ in range(10):
+                weather_api.fetch_weather()
+            with self.assertRaises(RateLimited):
+                weather_api.fetch_weather()
+
+        self.assertEqual(mocker.call_count, 10)
+
+
+#################################
+# Unit tests for utils/metrics.py
+#################################
+class UtilsMetricsTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.metrics.reset()
+
+    def test_histogram(self):
+        """
+        Testing the histogram buckets observations and estimates percentiles from them.
+        """
+        histogram = metrics.Histogram((0.01, 0.1, 1.0))
+        for seconds in (0.005, 0.005, 0.05, 0.5, 3.0):
+            histogram.observe(seconds)
+
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.percentile(40), 0.01)
+        self.assertEqual(histogram.percentile(60), 0.1)
+        self.assertEqual(histogram.percentile(100), 3.0)
+        self.assertEqual(histogram.cumulative(), [("0.01", 2), ("0.1", 3), ("1", 4), ("+Inf", 5)])
+
+    def test_trace_logs_slow_requests(self):
+        """
+        Testing a trace adds up its stages and logs their breakdown when the request is slow.
+        """
+        trace = metrics.Trace("weather 70119")
+        for _ in range(2):
+            with trace.stage("geocode"):
+                pass
+        with mock.patch.object(metrics, "slow_request_ms", 0), mock.patch.object(metrics.log, "warning") as mocker:
+            trace.finish()
+
+        self.assertEqual(list(trace.stages), ["geocode"])
+        self.assertEqual(metrics.metrics.stages["geocode"].count, 2)
+        self.assertEqual(metrics.metrics.slow_requests, 1)
+        self.assertIn("weather 70119", mocker.call_args[0])
+
+    def test_prometheus(self):
+        """
+        Testing the metrics render in the Prometheus text format.
+        """
+        metrics.metrics.observe("onecall", 0.2)
+        metrics.metrics.count_upstream("api.openweathermap.org", "200")
+        flights = {"calls": 3, "saved": 5, "in_flight": 1}
+        text = metrics.metrics.prometheus({"Weather": StripedTTLCache(maxsize=8, ttl=600).stats()}, flights)
+
+        self.assertIn('weatherbot_stage_seconds_bucket{stage="onecall",le="0.25"} 1', text)
+        self.assertIn('weatherbot_stage_seconds_count{stage="onecall"} 1', text)
+        self.assertIn('weatherbot_upstream_responses_total{host="api.openweathermap.org",status="200"} 1', text)
+        self.assertIn('weatherbot_cache_misses_total{cache="weather"} 0', text)
+        self.assertIn("weatherbot_singleflight_saved_total 5", text)
+        self.assertIn("weatherbot_singleflight_in_flight 1", text)
+        self.assertTrue(text.endswith("\n"))
+
+
+#####################################
+# Unit tests for utils/singleflight.py
+#####################################
+class UtilsSingleFlightTestCase(SupyTestCase):
+    def _run_followers(self, flight, func, count):
+        """
+        Starts a leader call that blocks until every follower is waiting on it.
+        """
+        results, errors = [], []
+        release = threading.Event()
+
+        def call():
+            try:
+                results.append(flight.do("New Orleans", lambda: release.wait() and func()))
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while flight.calls + flight.saved < count:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        return results, errors
+
+    def test_do_coalesces_calls(self):
+        """
+        Testing concurrent calls for the same key share the leader's result.
+        """
+        flight = SingleFlight()
+        func = mock.Mock(return_value=geo_response)
+        results, errors = self._run_followers(flight, func, 5)
+
+        self.assertEqual(results, [geo_response] * 5)
+        self.assertEqual(errors, [])
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(flight.stats(), {"calls": 1, "saved": 4, "in_flight": 0})
+
+    def test_do_async_coalesces_calls(self):
+        """
+        Testing coroutines share one call for the same key, and a coroutine asking while a
+        thread is making the call waits on the thread's result without blocking the loop.
+        """
+        flight = SingleFlight()
+        func = mock.Mock(return_value=geo_response)
+        release = threading.Event()
+
+        async def call():
+            await asyncio.sleep(0.05)
+            return func()
+
+        engine = WeatherEngine(workers=2)
+        engine.start()
+        try:
+            results = engine.run(engine.gather(*(flight.do_async("New Orleans", call) for _ in range(3))))
+            self.assertEqual(results, [geo_response] * 3)
+
+            thread = threading.Thread(target=flight.do, args=("New Orleans", lambda: release.wait() and func()))
+            thread.start()
+            while flight.calls < 2:
+                time.sleep(0.001)
+            follower = engine.submit(flight.do_async("New Orleans", call))
+            self.assertEqual(engine.run(asyncio.sleep(0, "free")), "free")
+            release.set()
+            self.assertEqual(follower.result(5), geo_response)
+            thread.join()
+        finally:
+            engine.stop()
+
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(flight.stats(), {"calls": 2, "saved": 3, "in_flight": 0})
+
+    def test_do_shares_exceptions(self):
+        """
+        Testing concurrent calls for the same key all raise the leader's exception
+        and that the next call is made again.
+        """
+        flight = SingleFlight()
+        results, errors = self._run_followers(flight, mock.Mock(side_effect=LocationNotFound("FAILED")), 3)
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(exc, LocationNotFound) for exc in errors))
+        self.assertEqual(flight.do("New Orleans", lambda: "retried"), "retried")
+        self.assertEqual(flight.calls, 2)
+
+
+###################################
+# Unit tests for utils/snapshot.py
+###################################
+class UtilsWeatherSnapshotTestCase(SupyTestCase):
+    def test_from_onecall(self):
+        """
+        Testing a snapshot keeps only the fields the display needs and can't be changed.
+        """
+        self.assertEqual(
+            (weather_snapshot.temp, weather_snapshot.wind_deg, weather_snapshot.high, weather_snapshot.low),
+            (52.61, 300, 54.3, 42.65),
+        )
+        self.assertEqual(weather_snapshot.summary, "Light rain in the morning and afternoon")
+        self.assertEqual(WeatherSnapshot.from_onecall(weather_response), weather_snapshot)
+        self.assertFalse(hasattr(weather_snapshot, "__dict__"))
+        with self.assertRaises(AttributeError):
+            weather_snapshot.temp = 0
+
+    def test_from_onecall_forecasts(self):
+        """
+        Testing the daily and hourly forecasts are packed into arrays that survive pickling.
+        """
+        daily, hourly = weather_snapshot.daily, weather_snapshot.hourly
+        self.assertEqual((len(daily), len(hourly), daily.step, hourly.offset), (2, 3, 86400, -21600))
+        self.assertEqual((daily.temps.typecode, daily.times.typecode), ("d", "q"))
+        self.assertEqual(daily.period(0), (1577001600, 54.3, 42.65, None, "Light rain in the morning and afternoon"))
+        self.assertEqual(hourly.period(1), (1577044800, 51.8, None, 0.0, "Overcast clouds"))
+        self.assertEqual(pickle.loads(pickle.dumps(weather_snapshot)), weather_snapshot)
+        with self.assertRaises(AttributeError):
+            daily.step = 0
+
+    def test_measures_itself(self):
+        """
+        Testing the cache measures a snapshot by its own size, which counts its forecasts' arrays.
+        """
+        daily = weather_snapshot.daily
+        self.assertEqual(approximate_size(weather_snapshot), sys.getsizeof(weather_snapshot))
+        self.assertGreater(sys.getsizeof(weather_snapshot), sys.getsizeof(daily) + sys.getsizeof(daily.temps))
+
+    def test_from_onecall_raises_weather_not_found(self):
+        """
+        Testing a response without current weather or a forecast raises WeatherNotFound.
+        """
+        self.assertRaises(WeatherNotFound, WeatherSnapshot.from_onecall, {"current": weather_response["current"]})
+        self.assertRaises(WeatherNotFound, WeatherSnapshot.from_onecall, {"daily": weather_response["daily"]})
+
+    def test_from_weatherstack(self):
+        """
+        Testing a Weatherstack snapshot has the current weather but no forecast.
+        """
+        snapshot = WeatherSnapshot.from_weatherstack(current_response)
+        self.assertEqual((snapshot.temp, snapshot.feels_like, snapshot.wind_deg), (45, 41, 300))
+        self.assertEqual(snapshot.condition, "Light rain")
+        self.assertEqual((snapshot.summary, snapshot.high, snapshot.low), (None, None, None))
+        self.assertRaises(WeatherNotFound, WeatherSnapshot.from_weatherstack, failed_geo_response)
+
+
+####################################
+# Unit tests for utils/templates.py
+####################################
+class UtilsTemplatesTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.weather_api = OpenWeatherMapAPI("New York, New York")
+        self.weather_api.location, self.weather_api.region = "New York", "New York"
+        self.weather_api.data = weather_snapshot
+
+    def test_render_forecast(self):
+        """
+        Testing render_forecast shows the coming days or hours in local time, skipping the ones that ended.
+        """
+        now = weather_response["current"]["dt"]
+        self.assertEqual(
+            render_forecast(self.weather_api, weather_snapshot.daily, 1, 5, now),
+            "\x02New York, New York\x02 :: \x02Sun\x02: Light rain in the morning and afternoon 54.3F/12.4C - "
+            "42.6F/5.9C | \x02Mon\x02: Clear sky 60.1F/15.6C - 45.5F/7.5C, 40% precip",
+        )
+        self.assertEqual(
+            render_forecast(self.weather_api, weather_snapshot.hourly, 2, 2, now + 3600),
+            "\x02New York, New York\x02 :: \x022pm\x02: Overcast clouds 11.0C/51.8F | "
+            "\x023pm\x02: Overcast clouds 10.5C/50.9F",
+        )
+        ended = render_forecast(self.weather_api, weather_snapshot.daily, 1, 5, now + 86400 * 7)
+        self.assertEqual(ended, "\x02New York, New York\x02 :: N/A")
+
+        self.weather_api.data = WeatherSnapshot.from_weatherstack(current_response)
+        self.assertRaises(WeatherNotFound, self.weather_api.forecast_format, True)
+
+    def test_default_template(self):
+        """
+        Testing display_format renders the default template imperial or metric first.
+        """
+        self.assertEqual(self.weather_api.display_format(), display_default_response)
+        self.assertEqual(self.weather_api.display_format(format=2), display_cf_response)
+
+        self.weather_api.data = None
+        self.assertRaises(WeatherNotFound, self.weather_api.display_format)
+
+    def test_custom_template(self):
+        """
+        Testing a custom template is parsed once and only computes the fields it uses.
+        """
+        template = compile_template("{place}: {temp_c} {wind:>20}|")
+        self.assertIs(compile_template("{place}: {temp_c} {wind:>20}|"), template)
+        self.assertEqual(template.fields, ("place", "temp_c", "wind"))
+
+        conditions = Conditions(self.weather_api, 2)
+        self.assertEqual(template.render(conditions), "New York, New York: 11.4C      20.6kph/12.8mph|")
+        self.assertNotIn("temp_f", conditions._values)
+        self.assertNotIn("high", conditions._values)
+
+    def test_missing_values(self):
+        """
+        Testing values the weather provider doesn't have are shown as N/A.
+        """
+        self.weather_api.data = WeatherSnapshot.from_weatherstack(current_response)
+        template = compile_template("{summary}. High {high} - Low {low_c} | {temperature}")
+        self.assertEqual(template.render(Conditions(self.weather_api, 1)), "N/A. High N/A - Low N/A | 45.0F/7.2C")
+
+    def test_invalid_template(self):
+        """
+        Testing templates with unknown fields, bad syntax or format specs a string can't take raise a ValueError.
+        """
+        self.assertRaises(ValueError, compile_template, "{place} {pressure}")
+        self.assertRaises(ValueError, compile_template, "{place!r}")
+        self.assertRaises(ValueError, compile_template, "{place")
+        self.assertRaises(ValueError, compile_template, "{place} {temperature:d}")
+        self.assertRaises(ValueError, compile_template, "{place} {temperature:.1f}")
+        self.assertEqual(compile_template("{place:>5}").fields, ("place",))
+
+
+###################################
+# Unit tests for utils/transfer.py
+###################################
+class UtilsTransferTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.tempdir = tempfile.TemporaryDirectory()
+        User.create_table()
+        for nick, format in (("Johnno", 1), ("Chad", 2)):
+            user = get_mock_user()
+            user.nick, user.format = nick, format
+            user.save()
+
+    def tearDown(self):
+        User.drop_table()
+        self.tempdir.cleanup()
+        SupyTestCase.tearDown(self)
+
+    def test_export_and_import(self):
+        """
+        Testing users exported to JSONL and CSV are imported back the same.
+        """
+        expected = [(user.nick, user.format, user.location) for user in User.select().order_by(User.nick)]
+        for name in ("users.jsonl", "users.csv"):
+            path = os.path.join(self.tempdir.name, name)
+            self.assertEqual(export_users(path), 2)
+            User.delete().execute()
+
+            self.assertEqual(import_users(path, chunk_size=1), (2, 0))
+            imported = [(user.nick, user.format, user.location) for user in User.select().order_by(User.nick)]
+            self.assertEqual(imported, expected)
+
+    def test_import_upserts_and_skips_invalid_rows(self):
+        """
+        Testing an import replaces users with the same nick and skips rows that fail validation.
+        """
+        path = os.path.join(self.tempdir.name, "users.csv")
+        with open(path, "w", newline="") as users:
+            writer = csv.writer(users)
+            writer.writerow(("nick", "host", "format", "location", "region", "coordinates"))
+            writer.writerow(("Johnno", "new@test.com", 2, "Covington", "Louisiana", "30.475,-90.100"))
+            writer.writerow(("Bad", "test@test.com", 3, "Nowhere", "Nowhere", "0,0"))
+            writer.writerow(("Nick", "test@test.com", 1, "Chicago", "Illinois"))
+
+        self.assertEqual(import_users(path), (1, 2))
+        johnno = User.get(User.nick == "Johnno")
+        self.assertEqual((johnno.host, johnno.format, johnno.location), ("new@test.com", 2, "Covington"))
+        self.assertEqual(User.select().count(), 2)
+
+
 #################################
 # Unit tests for utils/errors.py
 #################################
@@ -368,6 +2096,128 @@ class UtilsErrorsTestCase(SupyTestCase):
         """
         self.assertTrue(issubclass(WeatherNotFound, RequestException))
 
+    def test_rate_limited_error(self) -> None:
+        """
+        Testing that RateLimited exception is a subclass of
+        RequestException.
+        """
+        self.assertTrue(issubclass(RateLimited, RequestException))
+
+    def test_circuit_open_error(self) -> None:
+        """
+        Testing that CircuitOpen exception is a subclass of
+        RequestException.
+        """
+        self.assertTrue(issubclass(CircuitOpen, RequestException))
+
+
+############################
+# Unit tests for benchmarks/
+############################
+class BenchmarksStubServerTestCase(SupyTestCase):
+    def test_latency_sampler(self):
+        """
+        Testing every latency distribution samples around its mean in seconds.
+        """
+        rand = random.Random(1)
+        self.assertEqual(latency_sampler("fixed", 50, rand)(), 0.05)
+        self.assertEqual(latency_sampler("lognormal", 0, rand)(), 0.0)
+        for distribution in ("uniform", "exponential", "lognormal"):
+            sample = latency_sampler(distribution, 50, rand)
+            mean = sum(sample() for _ in range(20000)) / 20000
+            self.assertAlmostEqual(mean, 0.05, delta=0.005, msg=distribution)
+        self.assertRaises(ValueError, latency_sampler, "normal", 50, rand)
+
+    def test_admit(self):
+        """
+        Testing admit counts requests by path and answers with 429s and 500s at their rates and over the max qps.
+        """
+        state = StubState(lambda: 0.0, max_qps=2)
+        statuses = [state.admit("/current") for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(state.requests, {"/current": 3})
+
+        self.assertEqual(StubState(lambda: 0.0, error_rate=1).admit("/current"), 500)
+        self.assertEqual(StubState(lambda: 0.0, throttle_rate=1).admit("/current"), 429)
+
+        state = StubState(lambda: 0.0, error_rate=0.2, throttle_rate=0.1, seed=1)
+        statuses = [state.admit("/data/2.5/onecall") for _ in range(10000)]
+        self.assertAlmostEqual(statuses.count(429) / 10000, 0.1, delta=0.02)
+        self.assertAlmostEqual(statuses.count(500) / 10000, 0.2, delta=0.02)
+
+    def test_stub_server(self):
+        """
+        Testing the stub server answers like OpenWeatherMap and Weatherstack from the fixtures.
+        """
+        state = StubState(lambda: 0.0)
+        server = make_server("127.0.0.1", 0, state)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            self.assertEqual(requests.get(f"{url}/data/2.5/onecall").json(), weather_response)
+            geo = requests.get(f"{url}/current", params={"query": "70119"}).json()
+            self.assertEqual(geo["location"]["name"], "70119")
+            self.assertEqual(requests.get(f"{url}/unknown").status_code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(state.requests, {"/data/2.5/onecall": 1, "/current": 1})
+
+
+class BenchmarksLoadTestCase(SupyTestCase):
+    def test_percentile(self):
+        """
+        Testing percentile returns the nearest-rank percentile of sorted latencies.
+        """
+        latencies = [float(value) for value in range(1, 101)]
+        self.assertEqual(load.percentile([], 50), 0.0)
+        self.assertEqual(load.percentile([0.2], 99), 0.2)
+        self.assertEqual(load.percentile(latencies, 50), 50.0)
+        self.assertEqual(load.percentile(latencies, 99), 99.0)
+        self.assertEqual(load.percentile(latencies, 100), 100.0)
+
+    def test_run(self):
+        """
+        Testing run sends every request at the target rate and counts failures by exception.
+        """
+
+        def request(number):
+            if number % 4 == 0:
+                raise load.ErrorReply("Unable to find this location.")
+
+        result = load.run(request, qps=200, concurrency=4, total=20)
+
+        self.assertEqual(len(result.latencies), 15)
+        self.assertEqual(result.errors, {"ErrorReply": 5})
+        self.assertEqual(result.latencies, sorted(result.latencies))
+        # The last request is due after 19 / 200 seconds.
+        self.assertGreaterEqual(result.elapsed, 0.095)
+        self.assertIn("15 ok", str(result))
+
+
+class BenchmarksHotPathsTestCase(SupyTestCase):
+    def test_calibrated(self):
+        """
+        Testing calibrated reports a call's time in multiples of the faster time of the calibration loop.
+        """
+        with mock.patch.object(hot_paths, "measure", side_effect=[100.0, 500.0, 80.0]) as measure:
+            self.assertEqual(hot_paths.calibrated("call", "loop"), (500.0, 6.25))
+        self.assertEqual([call[0][0] for call in measure.call_args_list], ["loop", "call", "loop"])
+
+    def test_compare(self):
+        """
+        Testing compare only reports the benchmarks slower than their baseline by more than the threshold.
+        """
+        baselines = {"display_format": 0.5, "cache_get": 0.02, "cache_set": 0.25}
+        results = {"display_format": 0.8, "cache_get": 0.029, "cache_set": 0.1, "snapshot": 9.0}
+
+        regressions = hot_paths.compare(results, baselines, 50)
+        self.assertEqual([name for name, _ in regressions], ["display_format"])
+        self.assertAlmostEqual(regressions[0][1], 60.0)
+        self.assertEqual(len(hot_paths.compare(results, baselines, 40)), 2)
+        self.assertEqual(hot_paths.compare(results, {}, 0), [])
+
 
 #################################
 # Unit tests for models/users.py
@@ -441,6 +2291,83 @@ class UserModelCreateTables(SupyTestCase):
         self.assertEqual(User.create_tables(), "Users table already created.")
         self.assertTrue(User.table_exists())
 
+    def test_connections(self):
+        """
+        Test the pragmas are applied and every thread reuses its own connection.
+        """
+        User.create_tables()
+        self.assertFalse(connect())
+        self.assertEqual(db.execute_sql("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(db.execute_sql("PRAGMA synchronous").fetchone()[0], 1)
+
+        connections = []
+
+        def worker():
+            connections.append((connect(), connect(), db.connection()))
+            db.close()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(connections[0][:2], (True, False))
+        self.assertIsNot(connections[0][2], db.connection())
+
+
+class GeoCacheModelTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        GeoCache.create_table()
+
+    def tearDown(self):
+        GeoCache.drop_table()
+        test_db.close()
+        SupyTestCase.tearDown(self)
+
+    def test_store_and_lookup(self):
+        """
+        Test a stored location is looked up again and its last hit is updated.
+        """
+        geo = {"location": "New Orleans", "region": "Louisiana", "coordinates": "29.974,-90.087"}
+        GeoCache.store("70119", geo)
+        before = GeoCache.get(GeoCache.query == "70119").last_hit_at
+
+        self.assertEqual(GeoCache.lookup("70119"), geo)
+        self.assertIsNone(GeoCache.lookup("70118"))
+        self.assertGreaterEqual(GeoCache.get(GeoCache.query == "70119").last_hit_at, before)
+        self.assertEqual(repr(GeoCache.get(GeoCache.query == "70119")), "<GeoCache 70119>")
+
+    def test_lookup_skips_expired(self):
+        """
+        Test an expired location isn't returned and is replaced when stored again.
+        """
+        geo = {"location": "New Orleans", "region": "Louisiana", "coordinates": "29.974,-90.087"}
+        GeoCache.store("70119", geo)
+        GeoCache.update(created_at=datetime(2000, 1, 1)).execute()
+
+        self.assertIsNone(GeoCache.lookup("70119"))
+        GeoCache.store("70119", geo)
+        self.assertEqual(GeoCache.lookup("70119"), geo)
+        self.assertEqual(GeoCache.select().count(), 1)
+
+    def test_prune(self):
+        """
+        Test prune deletes the least recently hit rows in batches.
+        """
+        for day in range(1, 11):
+            GeoCache.create(
+                query=f"701{day:02}",
+                location="New Orleans",
+                region="Louisiana",
+                coordinates="29.974,-90.087",
+                last_hit_at=datetime(2020, 1, day),
+            )
+
+        self.assertEqual(GeoCache.prune(max_rows=4, batch_size=4), 6)
+        self.assertEqual(
+            [geo.query for geo in GeoCache.select().order_by(GeoCache.query)], [f"701{day:02}" for day in range(7, 11)]
+        )
+
 
 class UserSchemaTestCase(SupyTestCase):
     def test_user_schema(self):
@@ -12,6 +12,28 @@ geo_response = {
     }
 }
 
+current_response = {
+    "request": {"type": "LatLon", "query": "Lat 40.71 and Lon -74.01", "language": "en", "unit": "f"},
+    "location": geo_response["location"],
+    "current": {
+        "observation_time": "10:28 PM",
+        "temperature": 45,
+        "weather_code": 296,
+        "weather_descriptions": ["Light Rain"],
+        "wind_speed": 8,
+        "wind_degree": 300,
+        "wind_dir": "WNW",
+        "pressure": 1012,
+        "precip": 0,
+        "humidity": 87,
+        "cloudcover": 100,
+        "feelslike": 41,
+        "uv_index": 1,
+        "visibility": 9,
+        "is_day": "no",
+    },
+}
+
 geo_response_without_region = {"location": {**geo_response["location"], "region": " ", "country": "USA"}}
 
 failed_geo_response = {
@@ -68,19 +90,51 @@ weather_response = {
                     "icon": "rain",
                 }
             ],
-        }
+        },
+        {
+            "dt": 1577088000,
+            "temp": {"day": 57.2, "max": 60.1, "min": 45.5},
+            "humidity": 60,
+            "wind_speed": 6.4,
+            "wind_deg": 250,
+            "pop": 0.4,
+            "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}],
+        },
+    ],
+    "hourly": [
+        {
+            "dt": 1577041200,
+            "temp": 52.61,
+            "humidity": 82,
+            "pop": 0.2,
+            "weather": [{"id": 500, "main": "Rain", "description": "light rain", "icon": "10d"}],
+        },
+        {
+            "dt": 1577044800,
+            "temp": 51.8,
+            "humidity": 84,
+            "pop": 0,
+            "weather": [{"id": 804, "main": "Clouds", "description": "overcast clouds", "icon": "04d"}],
+        },
+        {
+            "dt": 1577048400,
+            "temp": 50.9,
+            "humidity": 85,
+            "pop": 0,
+            "weather": [{"id": 804, "main": "Clouds", "description": "overcast clouds", "icon": "04d"}],
+        },
     ],
 }
 
 display_default_response = (
-    f"\x02New York, New York\x02 :: Light Rain 52.6F/11.4C (Humidity: 82%) | "
+    f"\x02New York, New York\x02 :: Light rain 52.6F/11.4C (Humidity: 82%) | "
     f"\x02Feels like\x02: 52.6F/11.4C | \x02Wind\x02: WNW at 12.8mph/20.6kph | "  # noqa: E501
     f"\x02Today\x02: Light rain in the morning and afternoon. High 54.3F/12.4C"
     f" - Low 42.6F/5.9C"
 )
 
 display_cf_response = (
-    f"\x02New York, New York\x02 :: Light Rain 11.4C/52.6F (Humidity: 82%) | "
+    f"\x02New York, New York\x02 :: Light rain 11.4C/52.6F (Humidity: 82%) | "
     f"\x02Feels like\x02: 11.4C/52.6F | \x02Wind\x02: WNW at 20.6kph/12.8mph | "  # noqa: E501
     f"\x02Today\x02: Light rain in the morning and afternoon. High 12.4C/54.3F"
     f" - Low 5.9C/42.6F"
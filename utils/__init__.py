@@ -1,9 +1,45 @@
 from importlib import reload
 
-from . import errors, services, users, weather
+from . import (
+    aiosessions,
+    aliases,
+    breaker,
+    cache,
+    engine,
+    errors,
+    gazetteer,
+    metrics,
+    providers,
+    ratelimit,
+    refresh,
+    services,
+    sessions,
+    singleflight,
+    snapshot,
+    templates,
+    transfer,
+    users,
+    weather,
+)
 
-# To reload the modules when you reload the bot.
+# To reload the modules when you reload the bot. Modules are reloaded
+# after the modules they import from, so they pick up the new classes.
+reload(cache)
 reload(errors)
+reload(gazetteer)
+reload(aliases)
+reload(metrics)
+reload(ratelimit)
+reload(breaker)
+reload(sessions)
+reload(aiosessions)
+reload(singleflight)
+reload(engine)
+reload(refresh)
+reload(snapshot)
+reload(templates)
+reload(users)
 reload(weather)
+reload(providers)
 reload(services)
-reload(users)
+reload(transfer)
@@ -0,0 +1,296 @@
+import asyncio
+import gzip
+import json
+import ssl
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+from .breaker import CircuitBreaker
+from .errors import RateLimited
+from .metrics import metrics
+from .sessions import SessionPool, deadline, pool_maxsize, retry_pause, retry_statuses, timeout
+
+# A host is its scheme, name and port, e.g. ("https", "api.openweathermap.org", 443).
+Origin = Tuple[str, str, int]
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class Response:
+    """
+    The response to a request of the async session pool, with the parts of requests.Response
+    the apis use, so both kinds of responses are handled the same way.
+
+    Attributes:
+        url: The url requested.
+        status_code: The HTTP status code.
+        headers: The headers, with lowercase names.
+        content: The body, decompressed.
+    """
+
+    def __init__(self, url: str, status_code: int, headers: Dict[str, str], content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self) -> Any:
+        return json.loads(self.content.decode("utf-8"))
+
+    def raise_for_status(self) -> None:
+        """
+        Raises requests.HTTPError for client and server errors, like requests.Response does.
+        """
+        if 400 <= self.status_code < 600:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def __repr__(self) -> str:
+        return f"<Response [{self.status_code}]>"
+
+
+class AsyncSessionPool:
+    """
+    Non-blocking counterpart of SessionPool for coroutines on the engine's event loop.
+
+    Requests are sent with asyncio streams, so a request waiting on a host holds a socket
+    and a coroutine instead of a thread. Idle keep-alive connections are kept per host, and
+    no more connections than the host's pool size are open at once, the requests beyond it
+    wait for one to free up. Retries, backoff and the deadline work like SessionPool's, and
+    the circuit breakers are the session pool's own, so both see the same health of a host.
+
+    Connections belong to the event loop they were opened on, so the pool starts over when
+    it is used from a new loop, e.g. after the engine restarts.
+
+    Attributes:
+        session_pool: The session pool whose pool sizes and circuit breakers are used.
+    """
+
+    def __init__(self, session_pool: SessionPool):
+        self.session_pool = session_pool
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: Dict[Origin, List[Connection]] = {}
+        self._slots: Dict[Origin, asyncio.Semaphore] = {}
+        self._ssl: Optional[ssl.SSLContext] = None
+
+    async def get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        acquire: Optional[Callable[[], None]] = None,
+        timeout: float = timeout,
+    ) -> Response:
+        """
+        Sends a GET request over a pooled keep-alive connection, counting its response by
+        host and status code. Connection errors, timeouts and server errors are retried with
+        jittered backoff, as long as the attempts fit in the deadline.
+
+        Args:
+            url: The url to request.
+            params(optional): The query string parameters.
+            acquire(optional): Takes a token from the rate limiter, called before every attempt.
+            timeout(optional): Seconds an attempt may take.
+
+        Returns:
+            The response received back, which is a server error if the last retry failed too.
+
+        Raises:
+            CircuitOpen: If the circuit of the host is open.
+            RateLimited: If acquire is out of tokens for an attempt.
+            requests.ConnectionError: If the host couldn't be reached on the last attempt.
+            requests.Timeout: If the last attempt timed out.
+        """
+        host: str = urlsplit(url).netloc
+        breaker: CircuitBreaker = self.session_pool.breaker(host)
+        if params:
+            url = f"{url}?{urlencode(params)}"
+        give_up_at: float = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            breaker.allow()
+            if acquire is not None:
+                try:
+                    acquire()
+                except RateLimited:
+                    breaker.release()
+                    raise
+            try:
+                response: Response = await asyncio.wait_for(
+                    self._send(url), min(timeout, max(give_up_at - time.monotonic(), 0.0))
+                )
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, ValueError) as exc:
+                error: requests.RequestException = (
+                    requests.Timeout(f"Timed out requesting {url}")
+                    if isinstance(exc, asyncio.TimeoutError)
+                    else requests.ConnectionError(f"Unable to request {url}: {exc!r}")
+                )
+                metrics.count_upstream(host, type(error).__name__)
+                breaker.failure()
+                pause: Optional[float] = retry_pause(attempt, give_up_at)
+                if pause is None:
+                    raise error from exc
+                await asyncio.sleep(pause)
+                attempt += 1
+                continue
+
+            metrics.count_upstream(host, str(response.status_code))
+            if response.status_code < 500:
+                breaker.success()
+                return response
+            breaker.failure()
+            pause = retry_pause(attempt, give_up_at) if response.status_code in retry_statuses else None
+            if pause is None:
+                return response
+            await asyncio.sleep(pause)
+            attempt += 1
+
+    async def _send(self, url: str) -> Response:
+        """
+        Sends one request and reads its response. A request on an idle connection the host
+        has closed in the meantime is sent again on a new connection.
+        """
+        parts = urlsplit(url)
+        origin: Origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path: str = f"{parts.path or '/'}?{parts.query}" if parts.query else parts.path or "/"
+        request: bytes = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            "User-Agent: WeatherBot\r\n"
+            "Accept: application/json\r\n"
+            "Accept-Encoding: gzip\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1")
+
+        self._bind()
+        async with self._slot(origin):
+            connection, reused = self._take_idle(origin), True
+            if connection is None:
+                connection, reused = await self._open(origin), False
+            try:
+                try:
+                    response, keep_alive = await self._exchange(connection, request, url)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    if not reused:
+                        raise
+                    connection[1].close()
+                    connection = await self._open(origin)
+                    response, keep_alive = await self._exchange(connection, request, url)
+            except BaseException:
+                connection[1].close()
+                raise
+
+            if keep_alive:
+                self._idle.setdefault(origin, []).append(connection)
+            else:
+                connection[1].close()
+
+        return response
+
+    async def _exchange(self, connection: Connection, request: bytes, url: str) -> Tuple[Response, bool]:
+        """
+        Writes a request on a connection and reads back its response.
+
+        Returns:
+            The response, and whether the connection can be used again.
+        """
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+
+        status_line: bytes = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status, *_ = status_line.decode("latin-1").split(None, 2)
+        if not version.startswith("HTTP/"):
+            raise ValueError(f"Malformed status line {status_line!r}")
+
+        headers: Dict[str, str] = {}
+        while True:
+            line: bytes = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        status_code = int(status)
+        keep_alive: bool = version != "HTTP/1.0" and headers.get("connection", "").lower() != "close"
+        if status_code in (204, 304) or status_code < 200:
+            content = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            content = await self._read_chunked(reader)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            # The body runs until the host closes the connection.
+            content, keep_alive = await reader.read(), False
+
+        if headers.get("content-encoding", "").lower() == "gzip":
+            content = gzip.decompress(content)
+        return Response(url, status_code, headers, content), keep_alive
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        chunks: List[bytes] = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        # Skips the trailers up to the blank line that ends the body.
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        return b"".join(chunks)
+
+    def _bind(self) -> None:
+        """
+        Starts the pool over if it is used from another event loop than before.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            self._loop, self._idle, self._slots = loop, {}, {}
+
+    def _slot(self, origin: Origin) -> asyncio.Semaphore:
+        """
+        Returns the semaphore bounding the open connections to a host to its pool size.
+        """
+        slot: Optional[asyncio.Semaphore] = self._slots.get(origin)
+        if slot is None:
+            scheme, host, port = origin
+            base_urls: Tuple[str, ...] = (f"{scheme}://{host}", f"{scheme}://{host}:{port}")
+            maxsize: int = next(
+                (size for base_url, size in self.session_pool.hosts.items() if base_url in base_urls), pool_maxsize
+            )
+            slot = self._slots[origin] = asyncio.Semaphore(maxsize)
+        return slot
+
+    def _take_idle(self, origin: Origin) -> Optional[Connection]:
+        """
+        Returns an idle connection to a host that hasn't been closed by it, if there is one.
+        """
+        idle: List[Connection] = self._idle.get(origin, [])
+        while idle:
+            connection: Connection = idle.pop()
+            if not connection[0].at_eof():
+                return connection
+            connection[1].close()
+        return None
+
+    async def _open(self, origin: Origin) -> Connection:
+        scheme, host, port = origin
+        if scheme == "https" and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        return await asyncio.open_connection(host, port, ssl=self._ssl if scheme == "https" else None)
+
+    async def close(self) -> None:
+        """
+        Closes every idle connection. Runs on the event loop the connections were opened on.
+        """
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle = {}
+
+    def __repr__(self) -> str:
+        return f"<AsyncSessionPool {', '.join(self.session_pool.hosts)}>"
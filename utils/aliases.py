@@ -0,0 +1,67 @@
+from typing import Dict, List, MutableMapping, Optional
+
+from .gazetteer import canonicalize
+
+
+def aliases(query: str, geo: Dict[str, str]) -> List[str]:
+    """
+    Returns the canonical spellings a resolved location can be found by: the query itself,
+    and the location and region it resolved to. e.g. 70119 and new orleans la
+
+    Args:
+        query: The location that was queried.
+        geo: A dictionary of the location, region and coordinates it resolved to.
+
+    Returns:
+        The distinct, non-empty aliases.
+    """
+    names: List[str] = [canonicalize(query)]
+    if geo.get("location") and geo.get("region"):
+        names.append(canonicalize(f"{geo['location']}, {geo['region']}"))
+
+    return [name for index, name in enumerate(names) if name and name not in names[:index]]
+
+
+class AliasIndex:
+    """
+    Index of every spelling of a location seen so far, mapped to the location it resolved to.
+    Queries are looked up by their canonical spelling, and a resolved location is also indexed
+    by its own name and region, so a new spelling of a known place, like New Orleans, LA after
+    70119, resolves without going upstream.
+
+    Attributes:
+        cache: The mapping the aliases are kept in, e.g. a StripedTTLCache to bound it.
+    """
+
+    def __init__(self, cache: MutableMapping[str, Dict[str, str]]):
+        self.cache = cache
+
+    def get(self, query: str) -> Optional[Dict[str, str]]:
+        """
+        Finds the location a spelling of a query resolved to before.
+
+        Args:
+            query: The location queried.
+
+        Returns:
+            A dictionary of the location, region and coordinates, or None if not seen.
+        """
+        key: str = canonicalize(query)
+        return self.cache.get(key) if key else None
+
+    def add(self, query: str, geo: Dict[str, str]) -> None:
+        """
+        Indexes a resolved location by the query and its own name.
+
+        Args:
+            query: The location that was queried.
+            geo: A dictionary of the location, region and coordinates it resolved to.
+        """
+        for alias in aliases(query, geo):
+            self.cache[alias] = geo
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __repr__(self) -> str:
+        return f"<AliasIndex {len(self.cache)} aliases>"
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from math import ceil
+from typing import Callable
+
+from supybot import log
+
+from .errors import CircuitOpen
+from .metrics import metrics
+
+# Configurable circuit breaker settings that you can change through environment variables.
+# A circuit opens after this many failures in a row, and lets one trial call through
+# once it has been open for the reset timeout in seconds.
+failure_threshold = int(os.getenv("CIRCUIT_FAILURES", "5"))
+reset_timeout = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker of one upstream host. While it is closed calls go through
+    and failures in a row are counted. Once there are too many, it opens and calls fail
+    fast with CircuitOpen instead of blocking a thread on a host that is down. After the
+    reset timeout it is half-open and lets one trial call through, which closes it again
+    if it succeeds or opens it for another reset timeout if it fails.
+
+    Attributes:
+        name: The host the circuit guards.
+        failure_threshold: The failures in a row that open the circuit.
+        reset_timeout: The seconds the circuit stays open before a trial call.
+        timer: The clock the reset timeout is measured with.
+        state: CLOSED, OPEN or HALF_OPEN.
+        failures: The failures in a row so far.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = failure_threshold,
+        reset_timeout: float = reset_timeout,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+        self.state = CLOSED
+        self.failures = 0
+        self._opened = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        """
+        Lets a call through, or raises CircuitOpen if the circuit is open or a trial call
+        is already in flight.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            wait: float = self._opened + self.reset_timeout - self.timer()
+            if self.state == OPEN and wait <= 0:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            raise CircuitOpen(f"The weather service is unavailable, try again in {max(1, ceil(wait))}s.")
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self._opened = self.timer()
+                self._transition(OPEN)
+
+    def release(self) -> None:
+        """
+        Ends a call that failed before it said anything about the health of the host.
+        """
+        with self._lock:
+            self._trial = False
+
+    def _transition(self, state: str) -> None:
+        """
+        Moves the circuit to a new state, logging and counting it. Must be called with the lock held.
+        """
+        log.warning("Circuit of %s went from %s to %s after %s failures", self.name, self.state, state, self.failures)
+        self.state = state
+        metrics.count_circuit(self.name, state)
+
+    def __repr__(self) -> str:
+        return f"<CircuitBreaker {self.name} {self.state}>"
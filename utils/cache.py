@@ -0,0 +1,325 @@
+import pickle
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterator, List, MutableMapping, Optional, Tuple
+
+# The bytes an entry costs on top of its key and value, for its tuple and slot in the stripe.
+entry_overhead: int = sys.getsizeof((None, 0.0, 0)) + 100
+
+
+def approximate_size(value: Any) -> int:
+    """
+    Approximates the bytes used by a value, following the items of containers
+    and the attributes of objects with __slots__. Objects that measure themselves
+    with __sizeof__, like arrays and forecasts, aren't followed.
+
+    Args:
+        value: The value to measure.
+
+    Returns:
+        The approximate size in bytes.
+    """
+    size: int = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, dict):
+        return size + sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(approximate_size(item) for item in value)
+    if type(value).__sizeof__ is not object.__sizeof__:
+        return size
+    for name in getattr(type(value), "__slots__", ()):
+        size += approximate_size(getattr(value, name, None))
+    return size
+
+
+class Compressed:
+    """
+    A cold cache value stored pickled and compressed until it is used again.
+
+    Attributes:
+        data: The compressed pickle of the value.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, value: Any):
+        self.data: bytes = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def decompress(self) -> Any:
+        return pickle.loads(zlib.decompress(self.data))
+
+
+class Usage:
+    """
+    The entries and approximate bytes of a whole StripedTTLCache, shared by its stripes
+    so its max size and byte budget are enforced for the cache as a whole.
+
+    Attributes:
+        lock: The lock guarding the counts, only ever taken while holding a stripe's lock.
+        entries: The number of entries in every stripe.
+        bytes: The approximate bytes used by the entries of every stripe.
+    """
+
+    __slots__ = ("lock", "entries", "bytes")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = 0
+        self.bytes = 0
+
+    def add(self, entries: int, size: int) -> None:
+        with self.lock:
+            self.entries += entries
+            self.bytes += size
+
+
+class Stripe:
+    """
+    A slice of a StripedTTLCache with its own lock and LRU ordered entries.
+
+    Attributes:
+        usage: The usage of the whole cache, kept up to date with this stripe's changes.
+        lock: The lock guarding this stripe only.
+        entries: The cached values, the time they expire and their size, in least recently used order.
+        bytes: The approximate bytes used by the entries.
+        hits: Lookups that found a live entry.
+        misses: Lookups that found nothing or an expired entry.
+        evictions: Live entries removed to make room for new ones.
+    """
+
+    __slots__ = ("usage", "lock", "entries", "bytes", "hits", "misses", "evictions")
+
+    def __init__(self, usage: Usage):
+        self.usage = usage
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Hashable, Tuple[Any, float, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, key: Hashable, value: Any, expires: float, size: int) -> None:
+        """
+        Adds an entry, or replaces it where it is in the least recently used order.
+        """
+        item: Optional[Tuple[Any, float, int]] = self.entries.get(key)
+        added: int = size if item is None else size - item[2]
+        self.entries[key] = (value, expires, size)
+        self.bytes += added
+        self.usage.add(int(item is None), added)
+
+    def remove(self, key: Hashable) -> None:
+        item: Optional[Tuple[Any, float, int]] = self.entries.pop(key, None)
+        if item is not None:
+            self.bytes -= item[2]
+            self.usage.add(-1, -item[2])
+
+    def clear(self) -> None:
+        self.usage.add(-len(self.entries), -self.bytes)
+        self.entries.clear()
+        self.bytes = 0
+
+
+class StripedTTLCache(MutableMapping):
+    """
+    Thread-safe TTL cache with LRU eviction. Keys are spread over stripes by their hash
+    and every stripe has its own lock, so threads only contend when their keys land
+    in the same stripe instead of all serializing on one global lock.
+
+    The cache is bounded by a max number of entries and, optionally, a budget of bytes
+    measured with approximate_size(). Both are counted for the whole cache, and a write
+    that takes the cache over them evicts the least recently used entries of the stripe
+    it was written to, so the cache fills up whatever stripes its keys land on. A stripe
+    keeps at least the entry just written, so the cache can go over its max size by at
+    most one entry per stripe until the next writes.
+
+    Expired entries are kept for a grace period, where they are misses for normal lookups
+    but can still be served as stale with get_stale().
+
+    Attributes:
+        maxsize: The max number of entries in the cache.
+        ttl: The time to live of an entry in seconds.
+        grace: The seconds an expired entry is kept for get_stale().
+        maxbytes: The approximate max bytes used by the entries, or 0 for no byte budget.
+        compress_min: The size in bytes from which cold entries are compressed by compact(), or 0 to never compress.
+        timer: The clock used to expire entries.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        stripes: int = 8,
+        grace: float = 0,
+        maxbytes: int = 0,
+        compress_min: int = 0,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.grace = grace
+        self.maxbytes = maxbytes
+        self.compress_min = compress_min
+        self.timer = timer
+        self._usage = Usage()
+        self._stripes: List[Stripe] = [Stripe(self._usage) for _ in range(max(1, min(stripes, maxsize)))]
+
+    def _stripe(self, key: Hashable) -> Stripe:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _value(self, stripe: Stripe, key: Hashable, item: Tuple[Any, float, int]) -> Any:
+        """
+        Returns the value of an entry, decompressing it for good if it was compressed
+        since it is being used again. Must be called with the stripe's lock held.
+        """
+        value: Any = item[0]
+        if isinstance(value, Compressed):
+            value = value.decompress()
+            stripe.put(key, value, item[1], approximate_size(key) + approximate_size(value) + entry_overhead)
+        return value
+
+    def __getitem__(self, key: Hashable) -> Any:
+        stripe: Stripe = self._stripe(key)
+        with stripe.lock:
+            item = stripe.entries.get(key)
+            if item is None or item[1] <= self.timer():
+                if item is not None and item[1] + self.grace <= self.timer():
+                    stripe.remove(key)
+                stripe.misses += 1
+                raise KeyError(key)
+            stripe.entries.move_to_end(key)
+            stripe.hits += 1
+            return self._value(stripe, key, item)
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        size: int = approximate_size(key) + approximate_size(value) + entry_overhead
+        stripe: Stripe = self._stripe(key)
+        with stripe.lock:
+            now: float = self.timer()
+            stripe.put(key, value, now + self.ttl, size)
+            stripe.entries.move_to_end(key)
+            if self._over_budget():
+                self._expire(stripe, now)
+            while self._over_budget() and len(stripe.entries) > 1:
+                stripe.remove(next(iter(stripe.entries)))
+                stripe.evictions += 1
+
+    def __delitem__(self, key: Hashable) -> None:
+        stripe: Stripe = self._stripe(key)
+        with stripe.lock:
+            if key not in stripe.entries:
+                raise KeyError(key)
+            stripe.remove(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        stripe: Stripe = self._stripe(key)
+        with stripe.lock:
+            item = stripe.entries.get(key)
+            return item is not None and item[1] > self.timer()
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for stripe in self._stripes:
+            with stripe.lock:
+                keys: List[Hashable] = list(stripe.entries)
+            yield from keys
+
+    def __len__(self) -> int:
+        return self._usage.entries
+
+    def _over_budget(self) -> bool:
+        usage: Usage = self._usage
+        return usage.entries > self.maxsize or (self.maxbytes > 0 and usage.bytes > self.maxbytes)
+
+    def expires_at(self, key: Hashable) -> Optional[float]:
+        """
+        Returns the time an entry expires on the cache's timer, or None if there is no entry.
+        """
+        stripe: Stripe = self._stripe(key)
+        with stripe.lock:
+            item = stripe.entries.get(key)
+            return None if item is None else item[1]
+
+    def get_stale(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """
+        Gets an entry even if it has expired, as long as it is still within the grace period.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            The value and its age in seconds, or None if there is no entry.
+        """
+        stripe: Stripe = self._stripe(key)
+        with stripe.lock:
+            item = stripe.entries.get(key)
+            now: float = self.timer()
+            if item is None or item[1] + self.grace <= now:
+                return None
+            return self._value(stripe, key, item), now - (item[1] - self.ttl)
+
+    def _expire(self, stripe: Stripe, now: float) -> None:
+        expired: List[Hashable] = [key for key, item in stripe.entries.items() if item[1] + self.grace <= now]
+        for key in expired:
+            stripe.remove(key)
+
+    def expire(self) -> None:
+        """
+        Removes every entry past its grace period from the cache.
+        """
+        now: float = self.timer()
+        for stripe in self._stripes:
+            with stripe.lock:
+                self._expire(stripe, now)
+
+    def compact(self, cold: float = 0.5) -> int:
+        """
+        Compresses the large entries in the least recently used part of every stripe.
+        Does nothing unless compress min is set.
+
+        Args:
+            cold(optional): The least recently used fraction of every stripe to compress.
+
+        Returns:
+            The number of entries compressed.
+        """
+        if not self.compress_min:
+            return 0
+
+        compressed = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                keys: List[Hashable] = list(stripe.entries)[: int(len(stripe.entries) * cold)]
+                for key in keys:
+                    value, expires, size = stripe.entries[key]
+                    if size < self.compress_min or isinstance(value, Compressed):
+                        continue
+                    packed = Compressed(value)
+                    if len(packed.data) + entry_overhead < size:
+                        stripe.put(key, packed, expires, approximate_size(key) + len(packed.data) + entry_overhead)
+                        compressed += 1
+
+        return compressed
+
+    def clear(self) -> None:
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of entries, approximate bytes, hits, misses and evictions of the cache.
+        """
+        return {
+            "entries": self._usage.entries,
+            "bytes": self._usage.bytes,
+            "hits": sum(stripe.hits for stripe in self._stripes),
+            "misses": sum(stripe.misses for stripe in self._stripes),
+            "evictions": sum(stripe.evictions for stripe in self._stripes),
+        }
+
+    def __repr__(self) -> str:
+        return f"<StripedTTLCache {len(self)}/{self.maxsize} ttl={self.ttl} stripes={len(self._stripes)}>"
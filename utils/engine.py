@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, List, Optional
+
+from supybot import log
+
+from .sessions import pool_maxsize
+
+# Configurable engine settings that you can change through environment variables.
+# The workers run the calls that block, the location store and background refreshes,
+# so they bound how many of those can run at once. The timeout is kept over twice the
+# HTTP deadline, so a lookup's requests give up before anything stops waiting on them.
+workers = int(os.getenv("ENGINE_WORKERS", pool_maxsize))
+timeout = float(os.getenv("ENGINE_TIMEOUT", "30"))
+
+
+class WeatherEngine:
+    """
+    Background asyncio event loop owned by the plugin, for the work that fans out: batch
+    queries like .weather a | b or --channel, refresh-ahead and revalidations. Commands
+    submit coroutines from their own threads and get the results back through futures.
+
+    The upstream calls of a batch are sent with the async session pool, so they overlap on
+    the loop itself and a request waiting on a host holds a socket instead of a thread. The
+    calls that still block, the location store and the background refreshes, are handed to
+    a small, bounded pool of workers with call(). A single lookup gains nothing from the
+    engine, so it runs on the command's own thread instead.
+
+    Coroutines on the loop share its thread, so their rate limiter priority is always
+    interactive. Background work keeps its own priority by running on the workers.
+
+    Attributes:
+        workers: The max number of blocking calls that can run at once.
+        initializer: Called on every worker thread before its first call, e.g. to open its database
+            connection. If it raises, the error is logged and it is tried again on the next call.
+        loop: The event loop, while the engine is running.
+    """
+
+    def __init__(self, workers: int = workers, initializer: Optional[Callable[[], Any]] = None):
+        self.workers = workers
+        self.initializer = initializer
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def running(self) -> bool:
+        return self.loop is not None and self.loop.is_running()
+
+    def start(self) -> None:
+        """
+        Starts the event loop in a background thread, if it isn't running already.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            started = threading.Event()
+            self.loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="WeatherBot-worker")
+            self.loop.set_default_executor(self._executor)
+
+            def run_loop() -> None:
+                asyncio.set_event_loop(self.loop)
+                self.loop.call_soon(started.set)
+                self.loop.run_forever()
+
+            self._thread = threading.Thread(target=run_loop, name="WeatherBot-engine", daemon=True)
+            self._thread.start()
+            started.wait()
+            log.info("Started the weather engine with %s workers", self.workers)
+
+    def stop(self) -> None:
+        """
+        Stops the event loop and waits for its thread and workers to finish.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+            self.loop.close()
+            self.loop, self._executor, self._thread = None, None, None
+
+    def submit(self, coroutine: Awaitable[Any]) -> Future:
+        """
+        Schedules a coroutine on the event loop from any thread.
+
+        Args:
+            coroutine: The coroutine to run.
+
+        Returns:
+            A future of the coroutine's result.
+        """
+        if not self.running:
+            raise RuntimeError("The weather engine is not running.")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Awaitable[Any], timeout: float = timeout) -> Any:
+        """
+        Runs a coroutine on the event loop and waits for its result. Must not be called
+        from the loop's own thread.
+
+        Args:
+            coroutine: The coroutine to run.
+            timeout(optional): Seconds to wait for the result.
+
+        Returns:
+            The result of the coroutine, or raises its exception.
+        """
+        future: Future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    async def call(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Runs a blocking function on one of the workers without blocking the loop.
+
+        Args:
+            func: The blocking function to call.
+            args: The positional arguments to call it with.
+            kwargs: The keyword arguments to call it with.
+
+        Returns:
+            The result of the function.
+        """
+        return await self.loop.run_in_executor(self._executor, partial(self._work, partial(func, *args, **kwargs)))
+
+    def _work(self, func: Callable[[], Any]) -> Any:
+        """
+        Runs a call on the current worker, initializing the worker first if it hasn't been yet.
+        A failed initializer doesn't break the pool, the call is still made.
+        """
+        if self.initializer is not None and not getattr(self._local, "initialized", False):
+            try:
+                self.initializer()
+                self._local.initialized = True
+            except Exception as exc:
+                log.error("Unable to initialize the weather engine worker: %s", exc)
+        return func()
+
+    async def gather(self, *coroutines: Awaitable[Any]) -> List[Any]:
+        """
+        Runs coroutines concurrently and returns their results, or exceptions, in order.
+        """
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+
+    def __repr__(self) -> str:
+        return f"<WeatherEngine workers={self.workers} running={self.running}>"
@@ -7,3 +7,11 @@ class LocationNotFound(RequestException):
 
 class WeatherNotFound(RequestException):
     pass
+
+
+class RateLimited(RequestException):
+    pass
+
+
+class CircuitOpen(RequestException):
+    pass
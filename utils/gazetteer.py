@@ -0,0 +1,312 @@
+import argparse
+import csv
+import mmap
+import re
+import threading
+import unicodedata
+from os.path import isfile
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Any run of characters that aren't letters or digits becomes a single space.
+non_word = re.compile(r"[\W_]+")
+zip_plus_four = re.compile(r"(\d{5}) \d{4}")
+
+# US states and territories by their normalized names, mapped to their postal abbreviations.
+us_states: Dict[str, str] = {
+    "alabama": "al",
+    "alaska": "ak",
+    "arizona": "az",
+    "arkansas": "ar",
+    "california": "ca",
+    "colorado": "co",
+    "connecticut": "ct",
+    "delaware": "de",
+    "district of columbia": "dc",
+    "florida": "fl",
+    "georgia": "ga",
+    "hawaii": "hi",
+    "idaho": "id",
+    "illinois": "il",
+    "indiana": "in",
+    "iowa": "ia",
+    "kansas": "ks",
+    "kentucky": "ky",
+    "louisiana": "la",
+    "maine": "me",
+    "maryland": "md",
+    "massachusetts": "ma",
+    "michigan": "mi",
+    "minnesota": "mn",
+    "mississippi": "ms",
+    "missouri": "mo",
+    "montana": "mt",
+    "nebraska": "ne",
+    "nevada": "nv",
+    "new hampshire": "nh",
+    "new jersey": "nj",
+    "new mexico": "nm",
+    "new york": "ny",
+    "north carolina": "nc",
+    "north dakota": "nd",
+    "ohio": "oh",
+    "oklahoma": "ok",
+    "oregon": "or",
+    "pennsylvania": "pa",
+    "puerto rico": "pr",
+    "rhode island": "ri",
+    "south carolina": "sc",
+    "south dakota": "sd",
+    "tennessee": "tn",
+    "texas": "tx",
+    "utah": "ut",
+    "vermont": "vt",
+    "virginia": "va",
+    "washington": "wa",
+    "west virginia": "wv",
+    "wisconsin": "wi",
+    "wyoming": "wy",
+}
+
+# Trailing country names that add nothing to a US location.
+us_countries: Tuple[str, ...] = ("united states of america", "united states", "usa", "us")
+
+
+def normalize(query: str) -> str:
+    """
+    Normalizes a query to the form the gazetteer index is keyed with.
+
+    Args:
+        query: The location queried. e.g. New Orleans, LA
+
+    Returns:
+        The query lowercased, without accents, punctuation or repeated whitespace. e.g. new orleans la
+    """
+    decomposed: str = unicodedata.normalize("NFKD", query)
+    stripped: str = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return non_word.sub(" ", stripped.casefold()).strip()
+
+
+def canonicalize(query: str) -> str:
+    """
+    Reduces a query to one canonical spelling, so spellings of the same place share cache keys.
+    On top of normalize(), a trailing US state name is abbreviated, a trailing US country name
+    is dropped and ZIP+4 codes are cut to their ZIP code. A state name on its own is left alone,
+    since it may be the city. e.g. New York
+
+    Args:
+        query: The location queried. e.g. New Orleans, Louisiana, USA
+
+    Returns:
+        The canonical query. e.g. new orleans la
+    """
+    key: str = normalize(query)
+    zip_code: Optional[re.Match] = zip_plus_four.fullmatch(key)
+    if zip_code is not None:
+        return zip_code.group(1)
+
+    for country in us_countries:
+        if key.endswith(f" {country}"):
+            key = key[: -len(country) - 1]
+            break
+
+    words: List[str] = key.split(" ")
+    for size in (3, 2, 1):
+        if len(words) > size:
+            state: Optional[str] = us_states.get(" ".join(words[-size:]))
+            if state is not None:
+                return " ".join(words[:-size] + [state])
+
+    return key
+
+
+class Gazetteer:
+    """
+    Offline geocoder backed by a sorted, memory-mapped index file in the data/ directory.
+
+    Every line of the index is a normalized key, the location, region and coordinates
+    separated by tabs, sorted by key. Lookups binary search the mapped file directly,
+    so the index costs no memory of its own and its pages are shared between processes.
+    If the file doesn't exist, every lookup returns None.
+
+    Attributes:
+        path: The path of the index file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self) -> Optional[mmap.mmap]:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    if isfile(self.path):
+                        with open(self.path, "rb") as index:
+                            # An empty file can't be mapped, and has nothing to find anyway.
+                            if index.seek(0, 2):
+                                self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._loaded = True
+
+        return self._map
+
+    def _search(self, index: mmap.mmap, key: bytes) -> int:
+        """
+        Returns the offset of the first line with a key greater than or equal to the given key.
+        """
+        low, high = 0, len(index)
+        while low < high:
+            middle: int = (low + high) // 2
+            start: int = index.rfind(b"\n", 0, middle) + 1
+            end: int = index.find(b"\n", start)
+            end = len(index) if end == -1 else end
+            tab: int = index.find(b"\t", start, end)
+            if index[start:tab] < key:
+                low = end + 1
+            else:
+                high = start
+
+        return low
+
+    def _lines(self, index: mmap.mmap, offset: int) -> Iterator[Tuple[str, Dict[str, str]]]:
+        while offset < len(index):
+            end: int = index.find(b"\n", offset)
+            end = len(index) if end == -1 else end
+            key, location, region, coordinates = index[offset:end].decode("utf-8").split("\t")
+            yield key, {"location": location, "region": region, "coordinates": coordinates}
+            offset = end + 1
+
+    def lookup(self, query: str) -> Optional[Dict[str, str]]:
+        """
+        Finds the location of a query that matches a key exactly once normalized.
+
+        Args:
+            query: The location queried. e.g. 70119 or New Orleans, LA
+
+        Returns:
+            A dictionary of the location, region and coordinates, or None if not found.
+        """
+        index: Optional[mmap.mmap] = self._load()
+        key: str = normalize(query)
+        if index is None or not key:
+            return None
+
+        line: Optional[Tuple[str, Dict[str, str]]] = next(self._lines(index, self._search(index, key.encode())), None)
+        if line is None or line[0] != key:
+            return None
+
+        return line[1]
+
+    def search_prefix(self, query: str, limit: int = 10) -> List[Tuple[str, Dict[str, str]]]:
+        """
+        Finds the keys that start with a query once normalized.
+
+        Args:
+            query: The start of a location. e.g. new orl
+            limit(optional): The max number of matches to return.
+
+        Returns:
+            A list of the matching keys and their locations, in key order.
+        """
+        index: Optional[mmap.mmap] = self._load()
+        key: str = normalize(query)
+        if index is None or not key:
+            return []
+
+        matches: List[Tuple[str, Dict[str, str]]] = []
+        for found, geo in self._lines(index, self._search(index, key.encode())):
+            if not found.startswith(key) or len(matches) == limit:
+                break
+            matches.append((found, geo))
+
+        return matches
+
+    def resolve(self, query: str) -> Optional[Dict[str, str]]:
+        """
+        Finds the location of a query by exact key, or by prefix when every key
+        starting with the query points to the same place.
+
+        Args:
+            query: The location queried.
+
+        Returns:
+            A dictionary of the location, region and coordinates, or None if not resolved.
+        """
+        geo: Optional[Dict[str, str]] = self.lookup(query)
+        if geo is not None:
+            return geo
+
+        matches: List[Dict[str, str]] = [match for _, match in self.search_prefix(query)]
+        if matches and all(match == matches[0] for match in matches):
+            return matches[0]
+
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            self._map = None
+            self._loaded = False
+
+    def __repr__(self) -> str:
+        return f"<Gazetteer {self.path}>"
+
+
+def build_index(rows: Iterable[Tuple[str, str, str, str]], path: str) -> int:
+    """
+    Writes a gazetteer index file from rows of keys and their locations. Keys are normalized
+    and the first location seen for a key is kept.
+
+    Args:
+        rows: Tuples of a key, location, region and coordinates.
+        path: The path to write the index file to.
+
+    Returns:
+        The number of keys written.
+    """
+    entries: Dict[bytes, bytes] = {}
+    for key, location, region, coordinates in rows:
+        normalized: str = normalize(key)
+        if normalized:
+            line: str = "\t".join((normalized, location.strip(), region.strip(), coordinates))
+            entries.setdefault(normalized.encode("utf-8"), line.encode("utf-8"))
+
+    with open(path, "wb") as index:
+        index.write(b"\n".join(entries[key] for key in sorted(entries)))
+
+    return len(entries)
+
+
+def geonames_rows(path: str) -> Iterator[Tuple[str, str, str, str]]:
+    """
+    Reads a GeoNames postal code dump, e.g. US.txt, into index rows keyed by the postal
+    code, "place, state code" and "place, state".
+
+    Args:
+        path: The path of the GeoNames postal code file.
+    """
+    with open(path, encoding="utf-8", newline="") as source:
+        for row in csv.reader(source, delimiter="\t", quoting=csv.QUOTE_NONE):
+            country, postal_code, place, admin_name, admin_code = row[:5]
+            coordinates: str = f"{float(row[9]):.3f},{float(row[10]):.3f}"
+            region: str = admin_name or country
+            yield postal_code, place, region, coordinates
+            if admin_code:
+                yield f"{place}, {admin_code}", place, region, coordinates
+            if admin_name:
+                yield f"{place}, {admin_name}", place, region, coordinates
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Builds the gazetteer index from a GeoNames postal code dump.")
+    parser.add_argument("source", help="GeoNames postal code file, e.g. US.txt")
+    parser.add_argument("index", help="index file to write, e.g. data/gazetteer.tsv")
+    args = parser.parse_args()
+
+    print(f"Wrote {build_index(geonames_rows(args.source), args.index)} keys to {args.index}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from supybot import log
+
+# Configurable metrics settings that you can change through environment variables.
+# Requests slower than this are logged with the time spent in each of their stages.
+slow_request_ms = float(os.getenv("SLOW_REQUEST_MS", "2000"))
+# File in the plugin's data directory the metrics are written to in the Prometheus
+# text format, every metrics interval seconds. Leave it empty to not write it.
+metrics_file = os.getenv("METRICS_FILE", "")
+metrics_interval = int(os.getenv("METRICS_INTERVAL", "60"))
+
+# Upper bounds of the histogram buckets in seconds, from a cache hit to an upstream timeout.
+buckets: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Thread-safe histogram of durations over fixed buckets.
+
+    Attributes:
+        bounds: The upper bounds of the buckets in seconds, without the last +Inf one.
+        counts: The number of observations in every bucket, with the +Inf one last.
+        count: The number of observations.
+        total: The sum of every observation in seconds.
+        max: The largest observation in seconds.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "total", "max", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...] = buckets):
+        self.bounds = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.counts[bisect_left(self.bounds, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimates a percentile in seconds as the upper bound of the bucket it falls in,
+        or the largest observation if that is smaller or it falls in the +Inf bucket.
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank: float = percent / 100 * self.count
+            seen = 0
+            for bound, count in zip(self.bounds, self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Returns the cumulative count of every bucket by its upper bound, as Prometheus expects them.
+        """
+        with self._lock:
+            counts: List[int] = list(self.counts)
+        result: List[Tuple[str, int]] = []
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            seen += count
+            result.append(("+Inf" if bound == float("inf") else f"{bound:g}", seen))
+        return result
+
+
+class Metrics:
+    """
+    Thread-safe registry of the stage histograms and upstream counters of the plugin.
+
+    Attributes:
+        stages: The histogram of every stage of a request, by stage name.
+        upstream: The number of upstream responses, by host and status code or exception name.
+        circuits: The number of circuit breaker transitions, by host and the state moved to.
+        slow_requests: The number of requests slower than the slow request threshold.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {}
+        self.upstream: Dict[Tuple[str, str], int] = {}
+        self.circuits: Dict[Tuple[str, str], int] = {}
+        self.slow_requests = 0
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        Records the duration of a stage.
+        """
+        histogram: Optional[Histogram] = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def count_upstream(self, host: str, status: str) -> None:
+        """
+        Counts an upstream response, or a failed request by the name of its exception.
+        """
+        with self._lock:
+            self.upstream[(host, status)] = self.upstream.get((host, status), 0) + 1
+
+    def count_circuit(self, host: str, state: str) -> None:
+        """
+        Counts a circuit breaker of a host moving to a new state.
+        """
+        with self._lock:
+            self.circuits[(host, state)] = self.circuits.get((host, state), 0) + 1
+
+    def count_slow(self) -> None:
+        with self._lock:
+            self.slow_requests += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages = {}
+            self.upstream = {}
+            self.circuits = {}
+            self.slow_requests = 0
+
+    def prometheus(self, caches: Dict[str, Dict[str, int]], flights: Optional[Dict[str, int]] = None) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            caches: The stats of every cache tier by tier name, as returned by cache_stats().
+            flights(optional): The single-flight stats, as returned by SingleFlight.stats().
+
+        Returns:
+            The metrics text, ending with a newline.
+        """
+        lines: List[str] = [
+            "# HELP weatherbot_stage_seconds Time spent in each stage of a weather request.",
+            "# TYPE weatherbot_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            for bound, count in histogram.cumulative():
+                lines.append(f'weatherbot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'weatherbot_stage_seconds_sum{{stage="{stage}"}} {histogram.total:.6f}')
+            lines.append(f'weatherbot_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        lines.append("# HELP weatherbot_upstream_responses_total Upstream responses by host and status code.")
+        lines.append("# TYPE weatherbot_upstream_responses_total counter")
+        for (host, status), count in sorted(self.upstream.items()):
+            lines.append(f'weatherbot_upstream_responses_total{{host="{host}",status="{status}"}} {count}')
+
+        lines.append("# HELP weatherbot_circuit_transitions_total Circuit breaker transitions by host and state.")
+        lines.append("# TYPE weatherbot_circuit_transitions_total counter")
+        for (host, state), count in sorted(self.circuits.items()):
+            lines.append(f'weatherbot_circuit_transitions_total{{host="{host}",state="{state}"}} {count}')
+
+        lines.append("# HELP weatherbot_slow_requests_total Requests slower than the slow request threshold.")
+        lines.append("# TYPE weatherbot_slow_requests_total counter")
+        lines.append(f"weatherbot_slow_requests_total {self.slow_requests}")
+
+        if flights is not None:
+            for name, kind, description in (
+                ("calls", "counter", "Lookups and fetches made by a single-flight leader."),
+                ("saved", "counter", "Lookups and fetches that waited on the leader's call instead of being made."),
+                ("in_flight", "gauge", "Single-flight calls in flight."),
+            ):
+                metric = f"weatherbot_singleflight_{name}" + ("_total" if kind == "counter" else "")
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} {kind}")
+                lines.append(f"{metric} {flights[name]}")
+
+        for name, kind, description in (
+            ("hits", "counter", "Cache lookups that found a live entry."),
+            ("misses", "counter", "Cache lookups that found nothing or an expired entry."),
+            ("evictions", "counter", "Live cache entries removed to make room for new ones."),
+            ("entries", "gauge", "Entries in the cache."),
+            ("bytes", "gauge", "Approximate bytes used by the cache entries."),
+        ):
+            metric: str = f"weatherbot_cache_{name}_total" if kind == "counter" else f"weatherbot_cache_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for tier, stats in sorted(caches.items()):
+                lines.append(f'{metric}{{cache="{tier.lower()}"}} {stats[name]}')
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Trace:
+    """
+    The time spent in every stage of one request. Stages that run more than once,
+    like the lookups of a batch, add up.
+
+    Attributes:
+        label: What the request was, for the slow request log.
+        started: The time the request started on the perf counter.
+        stages: The seconds spent in every stage, by stage name, in the order they first ran.
+    """
+
+    __slots__ = ("label", "started", "stages")
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.started: float = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Times a stage of the request, recording it even if it raises.
+        """
+        began: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds: float = time.perf_counter() - began
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            metrics.observe(name, seconds)
+
+    def finish(self) -> float:
+        """
+        Records the total time of the request and logs it with its stages if it was slow.
+
+        Returns:
+            The total time of the request in seconds.
+        """
+        total: float = time.perf_counter() - self.started
+        metrics.observe("total", total)
+        if total * 1000 >= slow_request_ms:
+            metrics.count_slow()
+            breakdown: str = ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in self.stages.items())
+            log.warning("Slow request %s took %.1fms: %s", self.label, total * 1000, breakdown or "no stages")
+        return total
+
+    def __repr__(self) -> str:
+        return f"<Trace {self.label} {len(self.stages)} stages>"
@@ -0,0 +1,338 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from math import ceil
+from typing import Any, Deque, Dict, List, Optional, Set, Type
+
+from .errors import WeatherNotFound
+from .ratelimit import current_priority, priority
+from .weather import OpenWeatherMapAPI, WeatherstackAPI
+
+# Configurable provider settings that you can change through environment variables.
+# The weather providers in order of preference, the first healthy one is the primary.
+# With more than one, a request to the primary that hasn't answered within its p95
+# latency is hedged with a request to the next provider.
+provider_names: List[str] = [
+    name.strip() for name in os.getenv("WEATHER_PROVIDERS", "openweathermap").split(",") if name.strip()
+]
+hedge_workers = int(os.getenv("HEDGE_WORKERS", "8"))
+# Seconds to wait before hedging while a provider has too few latencies for a p95, and the least wait.
+hedge_delay = float(os.getenv("HEDGE_DELAY", "1"))
+min_hedge_delay = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+# Providers failing more often than this are only used after the healthy ones.
+max_error_rate = float(os.getenv("PROVIDER_MAX_ERROR_RATE", "0.5"))
+
+# Every weather api that can be a provider, by name.
+apis: Dict[str, Type[OpenWeatherMapAPI]] = {
+    "openweathermap": OpenWeatherMapAPI,
+    "weatherstack": WeatherstackAPI,
+}
+
+
+class Provider:
+    """
+    A weather provider and how it has been doing lately.
+
+    Attributes:
+        name: The name of the provider.
+        api: The weather api class that fetches the weather from the provider.
+        latency: The exponentially weighted moving average of its latency in seconds.
+        error_rate: The exponentially weighted moving average of its failures, from 0 to 1.
+        calls: The number of calls made to it.
+        recent: The latencies of its latest calls in seconds, to estimate its p95 from.
+        alpha: The weight of the latest call in the moving averages.
+    """
+
+    def __init__(self, name: str, api: Type[OpenWeatherMapAPI], alpha: float = 0.2, window: int = 100):
+        self.name = name
+        self.api = api
+        self.alpha = alpha
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.calls = 0
+        self.recent: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def fetch(self, coordinates: str) -> Any:
+        """
+        Fetches the weather of coordinates from the provider, recording its latency and outcome.
+        """
+        weather_api = self.api("")
+        weather_api.coordinates = coordinates
+        began: float = time.perf_counter()
+        try:
+            data: Any = weather_api.fetch_weather()
+        except Exception:
+            self.record(time.perf_counter() - began, failed=True)
+            raise
+
+        self.record(time.perf_counter() - began, failed=False)
+        return data
+
+    async def fetch_async(self, coordinates: str) -> Any:
+        """
+        Coroutine version of fetch that doesn't block the event loop.
+        """
+        weather_api = self.api("")
+        weather_api.coordinates = coordinates
+        began: float = time.perf_counter()
+        try:
+            data: Any = await weather_api.fetch_weather_async()
+        except Exception:
+            self.record(time.perf_counter() - began, failed=True)
+            raise
+
+        self.record(time.perf_counter() - began, failed=False)
+        return data
+
+    def record(self, seconds: float, failed: bool) -> None:
+        with self._lock:
+            self.calls += 1
+            if self.calls == 1:
+                self.latency, self.error_rate = seconds, float(failed)
+            else:
+                self.latency += self.alpha * (seconds - self.latency)
+                self.error_rate += self.alpha * (float(failed) - self.error_rate)
+            if not failed:
+                self.recent.append(seconds)
+
+    def p95(self, min_samples: int = 20) -> Optional[float]:
+        """
+        Returns the p95 of its recent latencies in seconds, or None with too few of them.
+        """
+        with self._lock:
+            if len(self.recent) < min_samples:
+                return None
+            latencies: List[float] = sorted(self.recent)
+        return latencies[ceil(0.95 * len(latencies)) - 1]
+
+    def __repr__(self) -> str:
+        return f"<Provider {self.name} {self.latency * 1000:.0f}ms {self.error_rate:.0%} errors>"
+
+
+class ProviderRegistry:
+    """
+    The weather providers in order of preference. Weather is fetched from the first healthy
+    provider, and when it hasn't answered within its p95 the request is hedged with the next
+    one and whichever answers first wins. A provider that fails is failed over from right away.
+    This caps the tail latency at about the primary's p95 instead of its timeout.
+
+    Attributes:
+        providers: The providers in order of preference.
+        hedges: The requests hedged because the primary was slow.
+        hedge_wins: The hedged requests the second provider answered first.
+        failovers: The requests sent to the second provider because the primary failed.
+    """
+
+    def __init__(
+        self,
+        providers: List[Provider],
+        workers: int = hedge_workers,
+        delay: float = hedge_delay,
+        min_delay: float = min_hedge_delay,
+        max_error_rate: float = max_error_rate,
+    ):
+        self.providers = providers
+        self.delay = delay
+        self.min_delay = min_delay
+        self.max_error_rate = max_error_rate
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def ranked(self) -> List[Provider]:
+        """
+        Returns the providers in order of preference, the healthy ones first.
+        """
+        return sorted(self.providers, key=lambda provider: provider.error_rate > self.max_error_rate)
+
+    def hedge_delay(self, provider: Provider) -> float:
+        p95: Optional[float] = provider.p95()
+        return max(self.min_delay, self.delay if p95 is None else p95)
+
+    def fetch(self, coordinates: str) -> Any:
+        """
+        Fetches the weather of coordinates from the primary provider, hedged with the next one.
+
+        Args:
+            coordinates: The coordinates to fetch the weather for.
+
+        Returns:
+            The weather data of the provider that answered first.
+
+        Raises:
+            The first exception raised, if every provider tried failed.
+        """
+        ranked: List[Provider] = self.ranked()
+        if len(ranked) == 1:
+            return ranked[0].fetch(coordinates)
+
+        primary, secondary = ranked[:2]
+        level: str = current_priority()
+        futures: Dict[Future, Provider] = {self._submit(primary, coordinates, level): primary}
+        pending: Set[Future] = set(futures)
+        errors: List[BaseException] = []
+        hedged = False
+        while pending:
+            timeout: Optional[float] = self.hedge_delay(primary) if len(futures) == 1 else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if hedged and futures[future] is secondary:
+                        self._count("hedge_wins")
+                    return future.result()
+                errors.append(future.exception())
+
+            if len(futures) == 1:
+                hedged = not errors
+                self._count("hedges" if hedged else "failovers")
+                future = self._submit(secondary, coordinates, level)
+                futures[future] = secondary
+                pending.add(future)
+
+        raise errors[0]
+
+    async def fetch_async(self, coordinates: str) -> Any:
+        """
+        Coroutine version of fetch that hedges with tasks on the event loop instead of the
+        hedging threads. Like there, the slower request is left to finish, so its latency is recorded.
+
+        Args:
+            coordinates: The coordinates to fetch the weather for.
+
+        Returns:
+            The weather data of the provider that answered first.
+
+        Raises:
+            The first exception raised, if every provider tried failed.
+        """
+        ranked: List[Provider] = self.ranked()
+        if len(ranked) == 1:
+            return await ranked[0].fetch_async(coordinates)
+
+        primary, secondary = ranked[:2]
+        tasks: Dict[asyncio.Future, Provider] = {self._schedule(primary, coordinates): primary}
+        pending: Set[asyncio.Future] = set(tasks)
+        errors: List[BaseException] = []
+        hedged = False
+        while pending:
+            timeout: Optional[float] = self.hedge_delay(primary) if len(tasks) == 1 else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if hedged and tasks[task] is secondary:
+                        self._count("hedge_wins")
+                    return task.result()
+                errors.append(task.exception())
+
+            if len(tasks) == 1:
+                hedged = not errors
+                self._count("hedges" if hedged else "failovers")
+                task = self._schedule(secondary, coordinates)
+                tasks[task] = secondary
+                pending.add(task)
+
+        raise errors[0]
+
+    def fetch_forecast(self, coordinates: str) -> Any:
+        """
+        Fetches the weather of coordinates from the first healthy provider whose data has the
+        forecasts, for when the weather fetched before came from one without them. It isn't
+        hedged, and the next such provider is only tried when it fails.
+
+        Args:
+            coordinates: The coordinates to fetch the weather for.
+
+        Returns:
+            The weather data, with the daily and hourly forecasts.
+
+        Raises:
+            WeatherNotFound: If none of the providers has forecasts.
+            The first exception raised, if every provider tried failed.
+        """
+        errors: List[BaseException] = []
+        for provider in self.ranked():
+            if not provider.api.forecasts:
+                continue
+            try:
+                return provider.fetch(coordinates)
+            except Exception as exc:
+                errors.append(exc)
+
+        raise errors[0] if errors else WeatherNotFound("Unable to find the forecast at this time.")
+
+    @staticmethod
+    def _schedule(provider: Provider, coordinates: str) -> asyncio.Future:
+        """
+        Fetches from a provider in a task on the event loop. Its exception is marked as
+        retrieved, so a request left to finish after the other won doesn't log it as lost.
+        """
+        task: asyncio.Future = asyncio.ensure_future(provider.fetch_async(coordinates))
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return task
+
+    def _submit(self, provider: Provider, coordinates: str, level: str) -> Future:
+        """
+        Fetches from a provider on the hedging threads, at the priority of the calling thread.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="WeatherBot-hedge")
+
+        def fetch() -> Any:
+            with priority(level):
+                return provider.fetch(coordinates)
+
+        return self._executor.submit(fetch)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def close(self) -> None:
+        """
+        Stops the hedging threads without waiting for the requests still running.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the calls, average latency in ms, error rate and p95 in ms of every provider, by name.
+        """
+        return {
+            provider.name: {
+                "calls": provider.calls,
+                "latency": provider.latency * 1000,
+                "error_rate": provider.error_rate,
+                "p95": (provider.p95() or 0.0) * 1000,
+            }
+            for provider in self.providers
+        }
+
+    def __repr__(self) -> str:
+        return f"<ProviderRegistry {', '.join(provider.name for provider in self.providers)}>"
+
+
+def make_registry(names: List[str] = provider_names) -> ProviderRegistry:
+    """
+    Creates the registry of the providers named, in that order.
+
+    Args:
+        names: The names of the providers, each one a key of apis.
+
+    Returns:
+        The provider registry.
+    """
+    unknown: List[str] = [name for name in names if name not in apis]
+    if unknown or not names:
+        raise ValueError(f"Unknown weather providers {', '.join(unknown)}, use {', '.join(apis)}.")
+    return ProviderRegistry([Provider(name, apis[name]) for name in names])
@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from math import ceil
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .errors import RateLimited
+
+# Configurable upstream quotas that you can change through environment variables.
+# Every provider gets a bucket per minute and per month for each api key, 0 turns
+# a bucket off. The OpenWeatherMap defaults are the One Call free tier.
+limits: Dict[str, Tuple[Tuple[int, float], ...]] = {
+    "weatherstack": (
+        (int(os.getenv("WS_RATE_PER_MINUTE", "0")), 60.0),
+        (int(os.getenv("WS_RATE_PER_MONTH", "0")), 30 * 86400.0),
+    ),
+    "openweathermap": (
+        (int(os.getenv("OWM_RATE_PER_MINUTE", "60")), 60.0),
+        (int(os.getenv("OWM_RATE_PER_MONTH", "1000000")), 30 * 86400.0),
+    ),
+}
+# Share of every bucket that background refreshes leave for interactive commands.
+reserve = float(os.getenv("RATE_LIMIT_RESERVE", "0.2"))
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level: str) -> Iterator[None]:
+    """
+    Sets the priority of the upstream calls made on the current thread, e.g. BACKGROUND
+    for refreshes that nobody is waiting on. Calls are interactive by default.
+
+    Args:
+        level: INTERACTIVE or BACKGROUND.
+    """
+    previous: str = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority() -> str:
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+class TokenBucket:
+    """
+    Token bucket that holds up to a capacity of tokens and refills at a steady rate.
+    Not thread-safe on its own, the rate limiter guards its buckets.
+
+    Attributes:
+        capacity: The max tokens the bucket holds, and the calls allowed in a burst.
+        rate: The tokens added back every second.
+        tokens: The tokens left as of the last update.
+        updated: The time of the last update.
+    """
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: int, period: float, now: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, floor: float) -> float:
+        """
+        Returns the seconds until the bucket has a token above the floor.
+        """
+        return max(0.0, (floor + 1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Thread-safe token buckets per provider and api key, in front of every upstream call.
+    Calls over the budget fail fast with RateLimited instead of queuing, so a burst of
+    commands can't exhaust a quota or pile up waiting threads.
+
+    Interactive calls can take every token, while background calls only take tokens
+    above the reserve, so refreshes never use up what commands need.
+
+    Attributes:
+        limits: The capacity and period in seconds of every bucket, by provider.
+        reserve: The share of every bucket kept for interactive calls.
+        timer: The clock the buckets refill by.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[Tuple[int, float], ...]] = limits,
+        reserve: float = reserve,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.limits = limits
+        self.reserve = reserve
+        self.timer = timer
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], List[TokenBucket]] = {}
+
+    def acquire(self, provider: str, key: Optional[str], level: Optional[str] = None) -> None:
+        """
+        Takes a token from every bucket of a provider and api key, or none of them.
+
+        Args:
+            provider: The name of the provider. e.g. openweathermap
+            key: The api key the call is made with.
+            level(optional): INTERACTIVE or BACKGROUND, the priority of the current thread by default.
+
+        Raises:
+            RateLimited: If any bucket is out of tokens for the priority.
+        """
+        level = level or current_priority()
+        with self._lock:
+            buckets: List[TokenBucket] = self._buckets_of(provider, key or "")
+            now: float = self.timer()
+            wait = 0.0
+            for bucket in buckets:
+                bucket.refill(now)
+                floor: float = bucket.capacity * self.reserve if level == BACKGROUND else 0.0
+                if bucket.tokens < floor + 1:
+                    wait = max(wait, bucket.wait(floor))
+            if wait:
+                raise RateLimited(
+                    f"Too many weather requests, try again in {ceil(wait)}s."
+                    if wait <= 300
+                    else "Too many weather requests, try again later."
+                )
+            for bucket in buckets:
+                bucket.tokens -= 1
+
+    def _buckets_of(self, provider: str, key: str) -> List[TokenBucket]:
+        buckets: Optional[List[TokenBucket]] = self._buckets.get((provider, key))
+        if buckets is None:
+            buckets = self._buckets[(provider, key)] = [
+                TokenBucket(capacity, period, self.timer())
+                for capacity, period in self.limits.get(provider, ())
+                if capacity > 0
+            ]
+        return buckets
+
+    def __repr__(self) -> str:
+        return f"<RateLimiter {', '.join(self.limits)}>"
@@ -0,0 +1,188 @@
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from supybot import log
+
+from .cache import StripedTTLCache
+
+# Configurable refresh-ahead settings that you can change through environment variables.
+# Entries are refreshed when they expire within the window, if their access score,
+# which halves every half life, is at least the min score.
+window = float(os.getenv("REFRESH_WINDOW", "60"))
+interval = float(os.getenv("REFRESH_INTERVAL", "30"))
+half_life = float(os.getenv("REFRESH_HALF_LIFE", "1800"))
+min_score = float(os.getenv("REFRESH_MIN_SCORE", "2"))
+batch_size = int(os.getenv("REFRESH_BATCH_SIZE", "10"))
+
+
+class Access:
+    """
+    How often a cache key has been asked for.
+
+    Attributes:
+        coordinates: The coordinates to refresh the key with.
+        score: The decayed number of accesses.
+        seen: The time of the last access or decay.
+        refreshed: Whether the entry was refreshed ahead and not used since.
+    """
+
+    __slots__ = ("coordinates", "score", "seen", "refreshed")
+
+    def __init__(self, coordinates: str, now: float):
+        self.coordinates = coordinates
+        self.score = 0.0
+        self.seen = now
+        self.refreshed = False
+
+    def decay(self, now: float, half_life: float) -> None:
+        self.score *= 0.5 ** ((now - self.seen) / half_life)
+        self.seen = now
+
+
+class RefreshScheduler:
+    """
+    Refresh-ahead scheduler for the weather cache. It tracks how often the coordinates of
+    saved users are asked for, and refreshes the hot ones shortly before they expire, so
+    frequent users almost always hit a warm cache.
+
+    Refreshes are batched by cache key, so users sharing coordinates cost one refresh,
+    and each run refreshes at most batch size keys, hottest first.
+
+    Attributes:
+        cache: The weather cache to keep warm.
+        refresh: Fetches the weather of a cache key and coordinates and stores it in the cache.
+        window: Seconds before expiry that an entry is due for a refresh.
+        half_life: Seconds for an access score to halve.
+        min_score: The score a key needs to be refreshed.
+        batch_size: The max number of keys refreshed per run.
+        refreshes: The number of refreshes made.
+        hits: Refreshed entries that were used before they expired or were refreshed again.
+        wasted: Refreshed entries that were never used.
+    """
+
+    def __init__(
+        self,
+        cache: StripedTTLCache,
+        refresh: Callable[[str, str], None],
+        window: float = window,
+        half_life: float = half_life,
+        min_score: float = min_score,
+        batch_size: int = batch_size,
+    ):
+        self.cache = cache
+        self.refresh = refresh
+        self.window = window
+        self.half_life = half_life
+        self.min_score = min_score
+        self.batch_size = batch_size
+        self.refreshes = 0
+        self.hits = 0
+        self.wasted = 0
+        self._lock = threading.Lock()
+        self._accesses: Dict[str, Access] = {}
+
+    def record(self, key: str, coordinates: str) -> None:
+        """
+        Records an access to the weather of a saved user.
+
+        Args:
+            key: The weather cache key.
+            coordinates: The coordinates of the user.
+        """
+        now: float = self.cache.timer()
+        with self._lock:
+            access: Optional[Access] = self._accesses.get(key)
+            if access is None:
+                access = self._accesses[key] = Access(coordinates, now)
+            access.decay(now, self.half_life)
+            access.score += 1
+            if access.refreshed:
+                access.refreshed = False
+                self.hits += 1
+
+    def due(self) -> List[Tuple[str, str]]:
+        """
+        Finds the hot keys that expire within the window, and forgets keys that went cold.
+
+        Returns:
+            Up to batch size keys and their coordinates, hottest first.
+        """
+        now: float = self.cache.timer()
+        due: List[Tuple[float, str, str]] = []
+        with self._lock:
+            for key, access in list(self._accesses.items()):
+                access.decay(now, self.half_life)
+                expires: Optional[float] = self.cache.expires_at(key)
+                if access.refreshed and (expires is None or expires <= now):
+                    access.refreshed = False
+                    self.wasted += 1
+                if access.score < self.min_score:
+                    if access.score < 0.1 and not access.refreshed:
+                        del self._accesses[key]
+                    continue
+                if expires is not None and expires - now <= self.window:
+                    due.append((access.score, key, access.coordinates))
+
+        due.sort(reverse=True)
+        return [(key, coordinates) for _, key, coordinates in due[: self.batch_size]]
+
+    def mark_refreshed(self, key: str) -> None:
+        """
+        Marks an entry as refreshed ahead of its expiry.
+
+        Args:
+            key: The weather cache key.
+        """
+        with self._lock:
+            self.refreshes += 1
+            access: Optional[Access] = self._accesses.get(key)
+            if access is not None:
+                if access.refreshed:
+                    self.wasted += 1
+                access.refreshed = True
+
+    def run(self) -> int:
+        """
+        Refreshes every entry that is due on the calling thread.
+
+        Returns:
+            The number of entries refreshed.
+        """
+        refreshed = 0
+        for key, coordinates in self.due():
+            if self.refresh_key(key, coordinates):
+                refreshed += 1
+
+        return refreshed
+
+    def refresh_key(self, key: str, coordinates: str) -> bool:
+        """
+        Refreshes one entry, logging any failure instead of raising it.
+
+        Returns:
+            Whether the entry was refreshed.
+        """
+        try:
+            self.refresh(key, coordinates)
+        except Exception as exc:
+            log.warning("Unable to refresh the weather for %s: %s", key, exc)
+            return False
+
+        self.mark_refreshed(key)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of refreshes, refresh hits, wasted refreshes and tracked keys.
+        """
+        with self._lock:
+            return {
+                "refreshes": self.refreshes,
+                "hits": self.hits,
+                "wasted": self.wasted,
+                "tracked": len(self._accesses),
+            }
+
+    def __repr__(self) -> str:
+        return f"<RefreshScheduler refreshes={self.refreshes} hits={self.hits} wasted={self.wasted}>"
@@ -1,21 +1,223 @@
 import os
-from typing import Dict, Union
+import threading
+from decimal import Decimal
+from functools import partial
+from os.path import abspath, dirname, join
+from typing import Any, Dict, List, MutableMapping, Optional, Set, Tuple, Type, Union
 
-from cachetools import TTLCache, cached
+from peewee import DatabaseError
+from supybot import log
 
-from ..models.users import User
-from .users import AnonymousUser
+from ..models.users import GeoCache, User, connect
+from .aliases import AliasIndex
+from .cache import StripedTTLCache
+from .engine import WeatherEngine
+from .errors import LocationNotFound
+from .gazetteer import Gazetteer, canonicalize
+from .metrics import Trace, metrics
+from .providers import ProviderRegistry, make_registry
+from .ratelimit import BACKGROUND, current_priority, priority
+from .refresh import RefreshScheduler
+from .singleflight import SingleFlight
+from .templates import Template
+from .users import AnonymousUser, UserRecord
 from .weather import OpenWeatherMapAPI, WeatherAPI
 
 # Configurable ttl cache settings that you can change
 # through environment variables.
 maxsize = int(os.getenv("TTL_CACHE_MAX_SIZE"))
 ttl = int(os.getenv("TTL_CACHE_TIME"))
+stripes = int(os.getenv("TTL_CACHE_STRIPES", "8"))
+# Approximate byte budgets of the caches, on top of their max sizes. 0 turns a budget off.
+maxbytes = int(os.getenv("TTL_CACHE_MAX_BYTES", str(1024 * 1024)))
+weather_maxbytes = int(os.getenv("WEATHER_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+# Entries of at least this many bytes are compressed once they go cold. 0 turns compression off.
+compress_min = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", "0"))
+compact_interval = int(os.getenv("CACHE_COMPACT_INTERVAL", "300"))
 
-ttl_cache = TTLCache(maxsize=maxsize, ttl=ttl)
+ttl_cache = StripedTTLCache(maxsize=maxsize, ttl=ttl, stripes=stripes, maxbytes=maxbytes, compress_min=compress_min)
+
+# Weather data is cached by coordinates snapped to a grid, in degrees, so users
+# in the same area share one upstream fetch.
+weather_maxsize = int(os.getenv("WEATHER_CACHE_MAX_SIZE", maxsize))
+weather_ttl = int(os.getenv("WEATHER_CACHE_TIME", "600"))
+grid = float(os.getenv("WEATHER_CACHE_GRID", "0.05"))
+# Seconds expired weather data is still served while it is fetched again in the background.
+grace = int(os.getenv("WEATHER_CACHE_GRACE", "1800"))
+
+weather_cache = StripedTTLCache(
+    maxsize=weather_maxsize,
+    ttl=weather_ttl,
+    stripes=stripes,
+    grace=grace,
+    maxbytes=weather_maxbytes,
+    compress_min=compress_min,
+)
+
+# Rendered weather lines are cached on top of the weather data, by place, display format
+# and template, along with the snapshot they were rendered from. A line is only reused
+# while the weather cache still has that snapshot, so repeat requests skip formatting.
+rendered_maxsize = int(os.getenv("RENDERED_CACHE_MAX_SIZE", weather_maxsize))
+rendered_cache = StripedTTLCache(maxsize=rendered_maxsize, ttl=weather_ttl + grace, stripes=stripes, maxbytes=maxbytes)
+
+# Offline index of postal codes and cities that is tried before the geolocation api.
+path: str = dirname(abspath(__file__))
+gazetteer = Gazetteer(join(path, "..", "data", os.getenv("GAZETTEER_FILE", "gazetteer.tsv")))
+
+# Every spelling of a location seen, and the name it resolved to, mapped to its coordinates
+# for a week by default, so new spellings of a known place don't go upstream.
+alias_maxsize = int(os.getenv("ALIAS_INDEX_MAX_SIZE", "10000"))
+alias_ttl = int(os.getenv("ALIAS_INDEX_TIME", str(7 * 86400)))
+alias_index = AliasIndex(StripedTTLCache(maxsize=alias_maxsize, ttl=alias_ttl, stripes=stripes, maxbytes=maxbytes))
+
+# Concurrent cache misses for the same location or coordinates share one upstream call.
+flights = SingleFlight()
+
+
+def weather_flight(key: str) -> Tuple[str, str, str]:
+    """
+    Returns the single-flight key of a weather fetch. Fetches only share a call with others
+    at the same priority, so a command never waits on a background refresh the rate limiter
+    can refuse to make with its reserve.
+
+    Args:
+        key: The weather cache key of the coordinates.
+    """
+    return "weather", key, current_priority()
+
+
+def forecast_flight(key: str) -> Tuple[str, str, str]:
+    """
+    Returns the single-flight key of a fetch of the forecasts of a weather cache key. It is
+    separate from the weather's, so a command asking for the forecast never shares a fetch that
+    can come from a provider without one.
+
+    Args:
+        key: The weather cache key of the coordinates.
+    """
+    return "forecast", key, current_priority()
+
+
+# The weather providers fetched from, hedging the primary with the next one if there is one.
+providers = make_registry()
+
+# Event loop the plugin starts on load. Lookups run on it while it is running,
+# otherwise they run on the calling thread. Every worker opens its own database
+# connection when it starts and keeps it.
+engine = WeatherEngine(initializer=connect)
+
+# The days and hours shown by the forecast and hourly commands.
+forecast_days = int(os.getenv("FORECAST_DAYS", "5"))
+forecast_hours = int(os.getenv("FORECAST_HOURS", "6"))
+
+# The max number of locations or users shown by one batch query.
+many_max = int(os.getenv("QUERY_MANY_MAX", "10"))
+
+# Keys of stale weather data being fetched again in the background.
+revalidating: Set[str] = set()
+revalidating_lock = threading.Lock()
+
+
+def refresh_weather(key: str, coordinates: str) -> None:
+    """
+    Fetches the weather of coordinates again and stores it in the weather cache,
+    at background priority so it never takes the quota commands need.
+
+    Args:
+        key: The weather cache key of the coordinates.
+        coordinates: The coordinates to fetch the weather for.
+    """
+    with priority(BACKGROUND):
+        weather_cache[key] = flights.do(weather_flight(key), partial(providers.fetch, coordinates))
+
+
+# Keeps the weather of saved users that ask often warm in the weather cache.
+refresher = RefreshScheduler(weather_cache, refresh_weather)
+
+
+def refresh_ahead() -> None:
+    """
+    Refreshes the hot entries of the weather cache that are about to expire. The plugin
+    calls this periodically, and the refreshes run on the engine so the caller never
+    blocks on upstream calls.
+    """
+    if engine.running:
+        engine.submit(refresh_due())
+
+
+def compact_caches() -> None:
+    """
+    Compresses the large, cold entries of both caches, if compression is turned on.
+    """
+    compressed: int = ttl_cache.compact() + weather_cache.compact()
+    if compressed:
+        log.debug("Compressed %s cold cache entries", compressed)
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Returns the stats and byte budget of every cache tier, by tier name.
+    """
+    return {
+        "Locations": {**ttl_cache.stats(), "maxbytes": ttl_cache.maxbytes},
+        "Aliases": {**alias_index.cache.stats(), "maxbytes": alias_index.cache.maxbytes},
+        "Weather": {**weather_cache.stats(), "maxbytes": weather_cache.maxbytes},
+        "Rendered": {**rendered_cache.stats(), "maxbytes": rendered_cache.maxbytes},
+    }
+
+
+def write_metrics(path: str) -> None:
+    """
+    Writes the metrics, cache stats and single-flight stats in the Prometheus text format,
+    replacing the file at once so a scraper never reads it half written.
+
+    Args:
+        path: The path of the file to write.
+    """
+    try:
+        with open(f"{path}.tmp", "w") as metrics_file:
+            metrics_file.write(metrics.prometheus(cache_stats(), flights.stats()))
+        os.replace(f"{path}.tmp", path)
+    except OSError as exc:
+        log.warning("Unable to write the metrics to %s: %s", path, exc)
+
+
+def format_age(age: float) -> str:
+    """
+    Returns the marker added to a display of stale weather data.
+
+    Args:
+        age: The age of the weather data in seconds.
+    """
+    return f" | \x02Updated\x02: {int(age // 60)}m ago"
+
+
+async def refresh_due() -> None:
+    """
+    Refreshes every entry that is due concurrently on the engine.
+    """
+    due: List[Tuple[str, str]] = refresher.due()
+    await engine.gather(*(engine.call(refresher.refresh_key, key, coordinates) for key, coordinates in due))
+
+
+def snap_coordinates(coordinates: str, grid: float = grid) -> str:
+    """
+    Snaps coordinates to the nearest point on a grid, to be used as a cache key.
+
+    Args:
+        coordinates: The coordinates to snap. e.g. 29.974,-90.087
+        grid: The size of the grid in degrees.
+
+    Returns:
+        The snapped coordinates. e.g. 29.95,-90.10 with a grid of 0.05
+    """
+    places: int = max(0, -Decimal(str(grid)).as_tuple().exponent)
+    # Adding 0.0 turns a negative zero into a positive one, so it can't become a separate key.
+    lat, long = (round(float(value) / grid) * grid + 0.0 for value in coordinates.split(","))
+
+    return f"{lat:.{places}f},{long:.{places}f}"
 
 
-@cached(cache=ttl_cache)
 def query_location(query: str) -> Dict[str, str]:
     """
     Client function to get a user's queried location.
@@ -26,25 +228,178 @@ def query_location(query: str) -> Dict[str, str]:
     Returns:
         A dictionary of results of location, region and coordinates.
     """
-    weather = WeatherService(OpenWeatherMapAPI(query))
+    weather = WeatherService(
+        OpenWeatherMapAPI(query), weather_cache, ttl_cache, GeoCache, gazetteer, aliases=alias_index
+    )
     return weather.get_location()
 
 
-def query_current_weather(query: str, user: Union[User, AnonymousUser]) -> str:
+def query_current_weather(
+    query: str,
+    user: Union[User, UserRecord, AnonymousUser],
+    template: Optional[Template] = None,
+    trace: Optional[Trace] = None,
+) -> str:
     """
     Client function to get user's weather display.
 
     Args:
         query: The location to query for the weather api.
         user: The user object found in the db or an anonymous user object.
+        template(optional): The template to display the weather with.
+        trace(optional): The trace of the request to record the time of every stage to.
 
     Returns:
         A formatted string to display of the weather to output.
     """
-    weather = WeatherService(OpenWeatherMapAPI(query))
+    weather = WeatherService(
+        OpenWeatherMapAPI(query),
+        weather_cache,
+        ttl_cache,
+        GeoCache,
+        gazetteer,
+        template,
+        trace,
+        providers,
+        alias_index,
+        rendered_cache,
+    )
     return weather.get_current(user)
 
 
+def query_forecast(
+    query: str,
+    user: Union[User, UserRecord, AnonymousUser],
+    hourly: bool = False,
+    trace: Optional[Trace] = None,
+) -> str:
+    """
+    Client function to get a user's daily or hourly forecast display, from the same
+    cached weather data as the current weather.
+
+    Args:
+        query: The location to query for the weather api.
+        user: The user object found in the db or an anonymous user object.
+        hourly(optional): Shows the coming hours instead of the coming days.
+        trace(optional): The trace of the request to record the time of every stage to.
+
+    Returns:
+        A formatted string to display of the forecast to output.
+    """
+    weather = WeatherService(
+        OpenWeatherMapAPI(query), weather_cache, ttl_cache, GeoCache, gazetteer, None, trace, providers, alias_index
+    )
+    return weather.get_forecast(user, hourly)
+
+
+def query_many(
+    requests: List[Tuple[str, Union[User, UserRecord, AnonymousUser]]],
+    template: Optional[Template] = None,
+    trace: Optional[Trace] = None,
+) -> List[Union[str, Exception]]:
+    """
+    Client function to get the weather display of many locations or users in one pass.
+    Locations are resolved once per distinct query and weather is fetched once per
+    distinct snapped coordinates, concurrently on the engine when it is running.
+
+    Args:
+        requests: Tuples of the location to query and the user asking, or an empty
+            query and the saved user to show the weather of.
+        template(optional): The template to display the weather with.
+        trace(optional): The trace of the request to record the time of every stage to.
+
+    Returns:
+        The formatted weather display, or the exception raised, of each request in order.
+    """
+    if engine.running:
+        return engine.run(query_many_async(requests, template, trace))
+
+    results: List[Union[str, Exception]] = []
+    for query, user in requests:
+        try:
+            results.append(query_current_weather(query, user, template, trace))
+        except Exception as exc:
+            results.append(exc)
+
+    return results
+
+
+async def query_many_async(
+    requests: List[Tuple[str, Union[User, UserRecord, AnonymousUser]]],
+    template: Optional[Template] = None,
+    trace: Optional[Trace] = None,
+) -> List[Union[str, Exception]]:
+    """
+    Coroutine version of query_many that runs on the engine.
+    """
+    trace = trace or Trace()
+    services: List[WeatherService] = [
+        WeatherService(
+            OpenWeatherMapAPI(query),
+            weather_cache,
+            ttl_cache,
+            GeoCache,
+            gazetteer,
+            template,
+            trace,
+            providers,
+            alias_index,
+            rendered_cache,
+        )
+        for query, _ in requests
+    ]
+    results: List[Union[str, Exception]] = [None] * len(requests)
+
+    # Resolves every distinct query once.
+    locating: Dict[str, WeatherService] = {}
+    for service, (query, _) in zip(services, requests):
+        if query:
+            locating.setdefault(query, service)
+    found: List[Any] = await engine.gather(*(service.get_location_async(engine) for service in locating.values()))
+    locations: Dict[str, Any] = dict(zip(locating, found))
+
+    # Fetches the weather of every distinct key once.
+    keys: List[Optional[str]] = []
+    fetching: Dict[str, WeatherService] = {}
+    for index, (service, (query, user)) in enumerate(zip(services, requests)):
+        try:
+            if query:
+                if isinstance(locations[query], Exception):
+                    raise locations[query]
+                service.use_location(locations[query])
+            elif isinstance(user, AnonymousUser):
+                raise LocationNotFound("No weather location set.")
+            else:
+                await service.weather_api.set_location_async(user)
+            key: str = snap_coordinates(service.weather_api.coordinates)
+        except Exception as exc:
+            results[index] = exc
+            keys.append(None)
+            continue
+
+        service.record_access(key, user)
+        fetching.setdefault(key, service)
+        keys.append(key)
+    fetched: List[Any] = await engine.gather(
+        *(service.get_weather_async(engine, key) for key, service in fetching.items())
+    )
+    weather: Dict[str, Any] = dict(zip(fetching, fetched))
+
+    for index, (service, key, (_, user)) in enumerate(zip(services, keys, requests)):
+        if key is None:
+            continue
+        if isinstance(weather[key], Exception):
+            results[index] = weather[key]
+            continue
+        try:
+            service.weather_api.data, age = weather[key]
+            results[index] = service.display(user, age)
+        except Exception as exc:
+            results[index] = exc
+
+    return results
+
+
 class WeatherService:
     """
     Weather service that takes in a weather api interface to query current
@@ -52,12 +407,43 @@ class WeatherService:
 
     Attributes:
         weather_api: A class that implements the WeatherAPI interface.
+        weather_cache: An optional cache of weather data keyed by snapped coordinates. Expired
+            data in its grace period is served stale while it is fetched again in the background.
+        location_cache: An optional cache of location results keyed by canonical query.
+        location_store: An optional persistent store of location results behind the location cache.
+        gazetteer: An optional offline index of locations tried before the location store.
+        template: An optional template to display the weather with, instead of the default one.
+        trace: The trace the time spent in every stage is recorded to.
+        providers: An optional registry of weather providers to fetch the weather from, instead of the weather api.
+        aliases: An optional index of the spellings of locations already resolved, tried before anything else.
+        rendered_cache: An optional cache of rendered weather lines, reused while their snapshot is current.
     """
 
-    def __init__(self, weather_api: WeatherAPI):
+    def __init__(
+        self,
+        weather_api: WeatherAPI,
+        weather_cache: Optional[StripedTTLCache] = None,
+        location_cache: Optional[MutableMapping[str, Dict[str, str]]] = None,
+        location_store: Optional[Type[GeoCache]] = None,
+        gazetteer: Optional[Gazetteer] = None,
+        template: Optional[Template] = None,
+        trace: Optional[Trace] = None,
+        providers: Optional[ProviderRegistry] = None,
+        aliases: Optional[AliasIndex] = None,
+        rendered_cache: Optional[StripedTTLCache] = None,
+    ):
         self.weather_api = weather_api
+        self.weather_cache = weather_cache
+        self.location_cache = location_cache
+        self.location_store = location_store
+        self.gazetteer = gazetteer
+        self.template = template
+        self.trace = trace or Trace()
+        self.providers = providers
+        self.aliases = aliases
+        self.rendered_cache = rendered_cache
 
-    def get_current(self, user: Union[User, AnonymousUser]) -> str:
+    def get_current(self, user: Union[User, UserRecord, AnonymousUser]) -> str:
         """
         Gets the current weather data and formats it to display to a user.
 
@@ -67,13 +453,430 @@ class WeatherService:
         Returns:
              A formatted string to display of the weather to output.
         """
-        self.weather_api.find_current_weather(user)
-        return self.weather_api.display_format(user.format)
+        age: Optional[float] = self.load(user)
+        return self.display(user, age)
+
+    def get_forecast(self, user: Union[User, UserRecord, AnonymousUser], hourly: bool = False) -> str:
+        """
+        Gets the weather data and formats its daily or hourly forecast to display to a user.
+        It is the same cached data the current weather is shown from.
+
+        Args:
+            user: The user object found in the db or an anonymous user object.
+            hourly(optional): Shows the coming hours instead of the coming days.
+
+        Returns:
+             A formatted string to display of the forecast to output.
+        """
+        age: Optional[float] = self.load(user)
+        data: Any = self.weather_api.data
+        if data is not None and data.daily is None and self.providers is not None and self.weather_cache is not None:
+            # Weather from a provider without forecasts is fetched again from one that has them.
+            key: str = snap_coordinates(self.weather_api.coordinates)
+            with self.trace.stage("onecall"):
+                self.weather_api.data = flights.do(forecast_flight(key), self.fetch_forecast)
+            self.weather_cache[key] = self.weather_api.data
+            age = None
+
+        return self.display_forecast(user, hourly, age)
+
+    def load(self, user: Union[User, UserRecord, AnonymousUser]) -> Optional[float]:
+        """
+        Sets the location and weather data of the query, or of the user's saved location,
+        on the weather api, from the caches when they have them.
+
+        Args:
+            user: The user object found in the db or an anonymous user object.
+
+        Returns:
+            The age of the weather data in seconds if it is stale.
+        """
+        if self.weather_cache is None:
+            with self.trace.stage("onecall"):
+                self.weather_api.find_current_weather(user)
+            return None
+
+        if self.weather_api.query:
+            self.use_location(self.get_location())
+        else:
+            self.weather_api.set_location(user)
+
+        key: str = snap_coordinates(self.weather_api.coordinates)
+        self.record_access(key, user)
+        self.weather_api.data, age = self.get_weather(key)
+
+        return age
 
     def get_location(self) -> Dict[str, str]:
         """
         Gets the location, region, and coordinate values that were queried by the user.
 
+        Returns:
+            A dictionary of location results that was queried by a user.
+        """
+        with self.trace.stage("geocode"):
+            if self.location_cache is None:
+                return self.find_location()
+
+            key: str = self.location_key()
+            geo: Optional[Dict[str, str]] = self.location_cache.get(key)
+            if geo is None:
+                geo = flights.do(("location", key), self.lookup_location)
+                self.location_cache[key] = geo
+
+            return dict(geo)
+
+    async def get_location_async(self, engine: WeatherEngine) -> Dict[str, str]:
+        """
+        Coroutine version of get_location that runs on the engine. Only the location
+        store is called on a worker, the weather api is called without blocking the loop.
+
+        Args:
+            engine: The running engine.
+
+        Returns:
+            A dictionary of location results that was queried by a user.
+        """
+        with self.trace.stage("geocode"):
+            if self.location_cache is None:
+                return await self.find_location_async()
+
+            key: str = self.location_key()
+            geo: Optional[Dict[str, str]] = self.location_cache.get(key)
+            if geo is None:
+                geo = await flights.do_async(("location", key), partial(self.lookup_location_async, engine))
+                self.location_cache[key] = geo
+
+            return dict(geo)
+
+    def get_weather(self, key: str) -> Tuple[Any, Optional[float]]:
+        """
+        Gets the weather data of a key from the weather cache, or fetches it on a miss.
+
+        Args:
+            key: The weather cache key of the coordinates that were set.
+
+        Returns:
+            The weather data, and its age in seconds if it is stale.
+        """
+        with self.trace.stage("onecall"):
+            data, age = self.cached_weather(key)
+            if data is None:
+                data = flights.do(weather_flight(key), self.fetch_weather)
+                self.weather_cache[key] = data
+
+        return data, age
+
+    async def get_weather_async(self, engine: WeatherEngine, key: str) -> Tuple[Any, Optional[float]]:
+        """
+        Coroutine version of get_weather that runs on the engine. A stale key is still
+        revalidated on a worker, at background priority.
+
+        Args:
+            engine: The running engine.
+            key: The weather cache key of the coordinates that were set.
+
+        Returns:
+            The weather data, and its age in seconds if it is stale.
+        """
+        with self.trace.stage("onecall"):
+            data, age = self.cached_weather(key)
+            if data is None:
+                data = await flights.do_async(weather_flight(key), self.fetch_weather_async)
+                self.weather_cache[key] = data
+
+        return data, age
+
+    def fetch_weather(self) -> Any:
+        """
+        Fetches the weather data of the coordinates that were set from the providers,
+        or from the weather api if there are none.
+        """
+        if self.providers is None:
+            return self.weather_api.fetch_weather()
+        return self.providers.fetch(self.weather_api.coordinates)
+
+    def fetch_forecast(self) -> Any:
+        """
+        Fetches the weather data of the coordinates that were set from the providers that have forecasts.
+        """
+        return self.providers.fetch_forecast(self.weather_api.coordinates)
+
+    async def fetch_weather_async(self) -> Any:
+        """
+        Coroutine version of fetch_weather that doesn't block the event loop.
+        """
+        if self.providers is None:
+            return await self.weather_api.fetch_weather_async()
+        return await self.providers.fetch_async(self.weather_api.coordinates)
+
+    def cached_weather(self, key: str) -> Tuple[Any, Optional[float]]:
+        """
+        Gets weather data from the weather cache. Expired data still in its grace period is
+        returned right away, and one revalidation of it is started in the background.
+
+        Args:
+            key: The weather cache key.
+
+        Returns:
+            The weather data, or None if not cached, and its age in seconds if it is stale.
+        """
+        data: Any = self.weather_cache.get(key)
+        if data is not None:
+            return data, None
+
+        stale: Optional[Tuple[Any, float]] = self.weather_cache.get_stale(key)
+        if stale is None:
+            return None, None
+
+        self.revalidate(key)
+        return stale
+
+    def revalidate(self, key: str) -> None:
+        """
+        Fetches the weather data of a stale key again in the background, unless it
+        is already being fetched. Runs on the engine if it is running.
+
+        Args:
+            key: The weather cache key.
+        """
+        with revalidating_lock:
+            if key in revalidating:
+                return
+            revalidating.add(key)
+
+        weather_cache: StripedTTLCache = self.weather_cache
+        fetch_weather = self.fetch_weather
+
+        def fetch() -> None:
+            try:
+                with priority(BACKGROUND):
+                    weather_cache[key] = flights.do(weather_flight(key), fetch_weather)
+            except Exception as exc:
+                log.warning("Unable to revalidate the weather for %s: %s", key, exc)
+            finally:
+                with revalidating_lock:
+                    revalidating.discard(key)
+
+        if engine.running:
+            engine.submit(engine.call(fetch))
+        else:
+            threading.Thread(target=fetch, name="WeatherBot-revalidate", daemon=True).start()
+
+    def display(self, user: Union[User, UserRecord, AnonymousUser], age: Optional[float] = None) -> str:
+        """
+        Formats the weather data to display to a user, marking its age if it is stale.
+
+        Args:
+            user: The user object found in the db or an anonymous user object.
+            age(optional): The age of stale weather data in seconds.
+
+        Returns:
+             A formatted string to display of the weather to output.
+        """
+        with self.trace.stage("render"):
+            display: str = self.render(user.format)
+        if age is not None:
+            display += format_age(age)
+
+        return display
+
+    def display_forecast(
+        self, user: Union[User, UserRecord, AnonymousUser], hourly: bool = False, age: Optional[float] = None
+    ) -> str:
+        """
+        Formats the daily or hourly forecast of the weather data to display to a user, marking its age if it is stale.
+
+        Args:
+            user: The user object found in the db or an anonymous user object.
+            hourly(optional): Shows the coming hours instead of the coming days.
+            age(optional): The age of stale weather data in seconds.
+
+        Returns:
+             A formatted string to display of the forecast to output.
+        """
+        with self.trace.stage("render"):
+            display: str = self.weather_api.forecast_format(
+                hourly, user.format, forecast_hours if hourly else forecast_days
+            )
+        if age is not None:
+            display += format_age(age)
+
+        return display
+
+    def render(self, format: int) -> str:
+        """
+        Renders the weather data in a display format, or reuses the line already rendered
+        from the same snapshot for the same place, format and template.
+
+        Args:
+            format: The display format, 1 for imperial first or 2 for metric first.
+
+        Returns:
+             The rendered weather line.
+        """
+        if self.rendered_cache is None:
+            return self.weather_api.display_format(format, self.template)
+
+        weather_api: WeatherAPI = self.weather_api
+        key: Tuple[Any, ...] = (
+            weather_api.coordinates,
+            weather_api.location,
+            weather_api.region,
+            format,
+            self.template.source if self.template else None,
+        )
+        rendered: Optional[Tuple[Any, str]] = self.rendered_cache.get(key)
+        # Compressed weather entries come back as equal copies, so snapshots are compared by value too.
+        if rendered is not None and (rendered[0] is weather_api.data or rendered[0] == weather_api.data):
+            return rendered[1]
+
+        display: str = weather_api.display_format(format, self.template)
+        self.rendered_cache[key] = (weather_api.data, display)
+        return display
+
+    def record_access(self, key: str, user: Union[User, UserRecord, AnonymousUser]) -> None:
+        """
+        Records an access to the weather of a saved user for the refresh-ahead scheduler.
+
+        Args:
+            key: The weather cache key.
+            user: The user object found in the db or an anonymous user object.
+        """
+        if not self.weather_api.query and not isinstance(user, AnonymousUser):
+            refresher.record(key, self.weather_api.coordinates)
+
+    def use_location(self, geo: Dict[str, str]) -> None:
+        """
+        Sets the location attributes of the weather api from location results.
+
+        Args:
+            geo: A dictionary of location results.
+        """
+        self.weather_api.location = geo["location"]
+        self.weather_api.region = geo["region"]
+        self.weather_api.coordinates = geo["coordinates"]
+
+    def location_key(self) -> str:
+        """
+        Returns the canonical spelling of the query that location results are cached by,
+        or the query itself if nothing of it is left. e.g. new orleans la
+        """
+        return canonicalize(self.weather_api.query) or self.weather_api.query
+
+    def lookup_location(self) -> Dict[str, str]:
+        """
+        Looks up the location of the query in the alias index, then resolves it and adds it
+        to the index. Every spelling of it, and the name it resolved to, are found in the
+        index from then on.
+
+        Returns:
+            A dictionary of location results that was queried by a user.
+        """
+        query: str = self.weather_api.query
+        if self.aliases is None:
+            return self.resolve_location()
+
+        geo: Optional[Dict[str, str]] = self.aliases.get(query)
+        if geo is None:
+            geo = self.resolve_location()
+            self.aliases.add(query, geo)
+
+        return geo
+
+    async def lookup_location_async(self, engine: WeatherEngine) -> Dict[str, str]:
+        """
+        Coroutine version of lookup_location that runs on the engine.
+
+        Args:
+            engine: The running engine.
+
+        Returns:
+            A dictionary of location results that was queried by a user.
+        """
+        query: str = self.weather_api.query
+        if self.aliases is None:
+            return await self.resolve_location_async(engine)
+
+        geo: Optional[Dict[str, str]] = self.aliases.get(query)
+        if geo is None:
+            geo = await self.resolve_location_async(engine)
+            self.aliases.add(query, geo)
+
+        return geo
+
+    def resolve_location(self) -> Dict[str, str]:
+        """
+        Resolves the location of the query with the offline gazetteer and then the persistent
+        store, if there are any, and only finds it with the weather api when neither has it.
+        The store is best effort, so database errors are logged and the weather api is used instead.
+
+        Returns:
+            A dictionary of location results that was queried by a user.
+        """
+        if self.gazetteer is not None:
+            geo: Optional[Dict[str, str]] = self.gazetteer.resolve(self.weather_api.query)
+            if geo is not None:
+                return geo
+
+        if self.location_store is None:
+            return self.find_location()
+
+        key: str = self.location_key()
+        try:
+            geo = self.location_store.lookup(key)
+        except DatabaseError as exc:
+            log.error("geocache lookup: %s", exc)
+            geo = None
+
+        if geo is None:
+            geo = self.find_location()
+            try:
+                self.location_store.store(key, geo)
+            except DatabaseError as exc:
+                log.error("geocache store: %s", exc)
+
+        return geo
+
+    async def resolve_location_async(self, engine: WeatherEngine) -> Dict[str, str]:
+        """
+        Coroutine version of resolve_location that runs on the engine. The location store
+        blocks on the database, so it is called on a worker.
+
+        Args:
+            engine: The running engine.
+
+        Returns:
+            A dictionary of location results that was queried by a user.
+        """
+        if self.gazetteer is not None:
+            geo: Optional[Dict[str, str]] = self.gazetteer.resolve(self.weather_api.query)
+            if geo is not None:
+                return geo
+
+        if self.location_store is None:
+            return await self.find_location_async()
+
+        key: str = self.location_key()
+        try:
+            geo = await engine.call(self.location_store.lookup, key)
+        except DatabaseError as exc:
+            log.error("geocache lookup: %s", exc)
+            geo = None
+
+        if geo is None:
+            geo = await self.find_location_async()
+            try:
+                await engine.call(self.location_store.store, key, geo)
+            except DatabaseError as exc:
+                log.error("geocache store: %s", exc)
+
+        return geo
+
+    def find_location(self) -> Dict[str, str]:
+        """
+        Finds the location, region, and coordinate values of the query with the weather api.
+
         Returns:
             A dictionary of location results that was queried by a user.
         """
@@ -84,5 +887,16 @@ class WeatherService:
             "coordinates": self.weather_api.coordinates,
         }
 
+    async def find_location_async(self) -> Dict[str, str]:
+        """
+        Coroutine version of find_location that doesn't block the event loop.
+        """
+        await self.weather_api.find_geolocation_async()
+        return {
+            "location": self.weather_api.location,
+            "region": self.weather_api.region,
+            "coordinates": self.weather_api.coordinates,
+        }
+
     def __repr__(self) -> str:
         return f"<WeatherService {self.weather_api}>"
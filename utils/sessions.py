@@ -0,0 +1,202 @@
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from supybot import log
+
+from .breaker import CircuitBreaker
+from .errors import RateLimited
+from .metrics import metrics
+
+# Configurable pool settings that you can change through environment variables.
+# The pool size is per host, so a burst of commands can reuse up to that many
+# keep-alive connections before new ones have to be opened.
+pool_maxsize = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+prewarm = os.getenv("HTTP_PREWARM", "true").lower() in ("1", "true", "yes")
+# Seconds a request may take to connect or to send back data. Failed requests are
+# retried up to the retries, after sleeping a random time of up to the backoff
+# doubled for every attempt, and never more than the max backoff.
+timeout = float(os.getenv("HTTP_TIMEOUT", "10"))
+retries = int(os.getenv("HTTP_RETRIES", "2"))
+backoff = float(os.getenv("HTTP_RETRY_BACKOFF", "0.25"))
+max_backoff = float(os.getenv("HTTP_RETRY_MAX_BACKOFF", "2"))
+# Seconds all the attempts of a request may take together, backoff included. No retry is made
+# past it and the last attempt's timeout is cut short to fit. A lookup can make two requests,
+# the location then the weather, so keep it under half of ENGINE_TIMEOUT.
+deadline = float(os.getenv("HTTP_DEADLINE", "12"))
+
+# Responses to retry, since the host may answer the next attempt.
+retry_statuses = frozenset((500, 502, 503, 504))
+
+
+def retry_pause(attempt: int, give_up_at: float) -> Optional[float]:
+    """
+    Returns the backoff to wait after a failed attempt, or None if there are no retries left
+    or the next attempt wouldn't start before the deadline.
+
+    Args:
+        attempt: The number of the attempt that failed, from 0.
+        give_up_at: The monotonic time of the deadline.
+    """
+    if attempt >= retries:
+        return None
+    pause: float = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    if time.monotonic() + pause >= give_up_at:
+        return None
+    return pause
+
+
+class SessionPool:
+    """
+    Thread-safe pool of keep-alive HTTP connections shared by the weather apis.
+
+    A requests.Session holds cookies and other state that is not safe to share between
+    threads, so every thread gets its own session. All of those sessions mount the same
+    adapters though, so the underlying urllib3 connection pools are shared by every thread.
+
+    Every host has a circuit breaker, so requests to a host that keeps failing fail fast.
+
+    Attributes:
+        hosts: The base urls of the hosts to pool, mapped to the max connections kept for each.
+        breakers: The circuit breaker of every host requested, by host.
+    """
+
+    def __init__(self, hosts: Dict[str, int]):
+        self.hosts = hosts
+        self._adapters: Dict[str, HTTPAdapter] = {
+            base_url: HTTPAdapter(pool_connections=1, pool_maxsize=maxsize) for base_url, maxsize in hosts.items()
+        }
+        self._default_adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        self._local = threading.local()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._breakers_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        The session of the current thread, created on first use.
+        """
+        session: requests.Session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self._default_adapter)
+            session.mount("https://", self._default_adapter)
+            # requests picks the longest matching prefix, so each pooled host
+            # gets its own adapter and pool size.
+            for base_url, adapter in self._adapters.items():
+                session.mount(base_url, adapter)
+            self._local.session = session
+
+        return session
+
+    def get(self, url: str, acquire: Optional[Callable[[], None]] = None, **kwargs: Any) -> requests.Response:
+        """
+        Sends a GET request over a pooled keep-alive connection, counting its
+        response by host and status code. Connection errors, timeouts and server
+        errors are retried with jittered backoff, since GETs are safe to repeat,
+        as long as the attempts fit in the deadline.
+
+        Args:
+            url: The url to request.
+            acquire(optional): Takes a token from the rate limiter, called before every attempt
+                so retries count against the upstream quota too.
+            kwargs: Any keyword arguments that requests.Session.get takes.
+
+        Returns:
+            The response received back, which is a server error if the last retry failed too.
+
+        Raises:
+            CircuitOpen: If the circuit of the host is open.
+            RateLimited: If acquire is out of tokens for an attempt.
+        """
+        host: str = urlsplit(url).netloc
+        breaker: CircuitBreaker = self.breaker(host)
+        request_timeout: float = kwargs.pop("timeout", timeout)
+        give_up_at: float = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            breaker.allow()
+            if acquire is not None:
+                try:
+                    acquire()
+                except RateLimited:
+                    breaker.release()
+                    raise
+            kwargs["timeout"] = min(request_timeout, max(give_up_at - time.monotonic(), 0.0))
+            try:
+                response: requests.Response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                metrics.count_upstream(host, type(exc).__name__)
+                breaker.failure()
+                if not self._retry(attempt, give_up_at):
+                    raise
+                attempt += 1
+                continue
+            except requests.RequestException as exc:
+                metrics.count_upstream(host, type(exc).__name__)
+                breaker.release()
+                raise
+
+            metrics.count_upstream(host, str(response.status_code))
+            if response.status_code < 500:
+                breaker.success()
+                return response
+            breaker.failure()
+            if response.status_code not in retry_statuses or not self._retry(attempt, give_up_at):
+                return response
+            attempt += 1
+
+    @staticmethod
+    def _retry(attempt: int, give_up_at: float) -> bool:
+        """
+        Sleeps the backoff after a failed attempt, if there is to be another one.
+
+        Args:
+            attempt: The number of the attempt that failed, from 0.
+            give_up_at: The monotonic time of the deadline.
+
+        Returns:
+            Whether to make another attempt.
+        """
+        pause: Optional[float] = retry_pause(attempt, give_up_at)
+        if pause is None:
+            return False
+        time.sleep(pause)
+        return True
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        """
+        Returns the circuit breaker of a host, created on first use.
+        """
+        breaker: Optional[CircuitBreaker] = self.breakers.get(host)
+        if breaker is None:
+            with self._breakers_lock:
+                breaker = self.breakers.setdefault(host, CircuitBreaker(host))
+        return breaker
+
+    def warm(self) -> None:
+        """
+        Opens a connection to every pooled host, so the first command after loading
+        the plugin doesn't have to pay for the TCP and TLS handshakes.
+        """
+        for base_url in self.hosts:
+            try:
+                self.session.head(base_url, timeout=5)
+            except requests.RequestException as exc:
+                log.warning("Unable to pre-warm a connection to %s: %s", base_url, exc)
+
+    def close(self) -> None:
+        """
+        Closes every pooled connection.
+        """
+        for adapter in self._adapters.values():
+            adapter.close()
+        self._default_adapter.close()
+
+    def __repr__(self) -> str:
+        return f"<SessionPool {', '.join(self.hosts)}>"
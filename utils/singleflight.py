@@ -0,0 +1,143 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from supybot import log
+
+
+class Call:
+    """
+    A call in flight that other threads, or coroutines, can wait on.
+
+    Attributes:
+        done: Set once the call has finished.
+        result: The result of the call.
+        error: The exception raised by the call, if any.
+        future: Resolved once the call has finished, if a coroutine on an event loop is making it.
+    """
+
+    __slots__ = ("done", "result", "error", "future")
+
+    def __init__(self, future: Optional[asyncio.Future] = None):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.future = future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key. The first thread to ask for a key
+    becomes the leader and makes the call, every other thread asking for that key
+    while it is in flight waits for the leader's result or exception.
+
+    Attributes:
+        calls: The number of calls that were actually made.
+        saved: The number of calls that were saved by waiting on a leader instead.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Call] = {}
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """
+        Calls func, unless a call for the same key is already in flight.
+
+        Args:
+            key: The key that identifies identical calls.
+            func: The function to call if this thread becomes the leader.
+
+        Returns:
+            The result of the leader's call.
+        """
+        with self._lock:
+            call: Optional[Call] = self._in_flight.get(key)
+            leader: bool = call is None
+            if leader:
+                call = self._in_flight[key] = Call()
+                self.calls += 1
+            else:
+                self.saved += 1
+
+        if not leader:
+            log.debug("Waiting on the call in flight for %s", key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+        return call.result
+
+    async def do_async(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Coroutine version of do for the engine's event loop. Coroutines and threads asking for
+        the same key share one call. A coroutine waiting on a thread's call waits on a worker,
+        so the loop isn't blocked.
+
+        Args:
+            key: The key that identifies identical calls.
+            func: The coroutine function to await if this coroutine becomes the leader.
+
+        Returns:
+            The result of the leader's call.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        with self._lock:
+            call: Optional[Call] = self._in_flight.get(key)
+            leader: bool = call is None
+            if leader:
+                call = self._in_flight[key] = Call(loop.create_future())
+                self.calls += 1
+            else:
+                self.saved += 1
+
+        if not leader:
+            log.debug("Waiting on the call in flight for %s", key)
+            if call.future is None:
+                await loop.run_in_executor(None, call.done.wait)
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # Shielded, so a follower that is cancelled doesn't cancel the leader's call.
+            return await asyncio.shield(call.future)
+
+        try:
+            call.result = await func()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+            if call.error is None:
+                call.future.set_result(call.result)
+            else:
+                call.future.set_exception(call.error)
+                # Marked as retrieved, so it isn't logged as lost when no coroutine waited on it.
+                call.future.exception()
+
+        return call.result
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of calls made and saved, and how many are in flight right now.
+        """
+        with self._lock:
+            return {"calls": self.calls, "saved": self.saved, "in_flight": len(self._in_flight)}
+
+    def __repr__(self) -> str:
+        return f"<SingleFlight calls={self.calls} saved={self.saved}>"
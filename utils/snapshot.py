@@ -0,0 +1,322 @@
+import sys
+from array import array
+from math import isnan, nan
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import requests
+from supybot import log
+
+from .aiosessions import Response
+from .errors import WeatherNotFound
+
+try:
+    import orjson
+except ImportError:
+    # Falls back to the json decoder of requests when orjson isn't installed.
+    orjson = None
+
+
+def decode(response: Union[requests.Response, Response]) -> Dict[str, Any]:
+    """
+    Decodes the JSON body of a response, with orjson if it is installed.
+
+    Args:
+        response: The response of an api, from the session pool or the async session pool.
+
+    Returns:
+        The decoded JSON body.
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+class Forecast:
+    """
+    A daily or hourly forecast stored column by column in typed arrays instead of a dict
+    per period, so the 48 hours and 8 days of a One Call response stay small in the weather
+    cache. Missing numbers are stored as NaN and read back as None. Forecasts are immutable.
+
+    Attributes:
+        step: The length of a period in seconds, 86400 for days or 3600 for hours.
+        offset: The UTC offset of the location in seconds, to show local times with.
+        times: The start of every period as a unix timestamp.
+        temps: The temperature of every hour, or the high of every day, in fahrenheit.
+        lows: The low of every day in fahrenheit, all NaN for hours.
+        pops: The probability of precipitation of every period, from 0 to 1.
+        conditions: The condition of every period. e.g. Light rain
+    """
+
+    __slots__ = ("step", "offset", "times", "temps", "lows", "pops", "conditions")
+
+    def __init__(
+        self,
+        step: int,
+        offset: int,
+        times: array,
+        temps: array,
+        lows: array,
+        pops: array,
+        conditions: Tuple[str, ...],
+    ):
+        set_field = object.__setattr__
+        set_field(self, "step", step)
+        set_field(self, "offset", offset)
+        set_field(self, "times", times)
+        set_field(self, "temps", temps)
+        set_field(self, "lows", lows)
+        set_field(self, "pops", pops)
+        set_field(self, "conditions", conditions)
+
+    @classmethod
+    def from_onecall(cls, periods: List[Dict[str, Any]], step: int, offset: int = 0) -> "Forecast":
+        """
+        Packs the daily or hourly periods of a One Call api response into arrays.
+
+        Args:
+            periods: The daily or hourly list of the response.
+            step: The length of a period in seconds, 86400 for daily or 3600 for hourly.
+            offset: The timezone_offset of the response in seconds.
+
+        Returns:
+            The forecast of the periods.
+        """
+        temps: List[Any] = [period.get("temp") for period in periods]
+        # Days have a high and a low, hours a single temperature.
+        if temps and isinstance(temps[0], dict):
+            highs: List[Any] = [temp.get("max") for temp in temps]
+            lows: array = array("d", [nan if temp.get("min") is None else temp.get("min") for temp in temps])
+        else:
+            highs, lows = temps, array("d", [nan]) * len(temps)
+
+        return cls(
+            step,
+            offset,
+            array("q", [period.get("dt") or 0 for period in periods]),
+            array("d", [nan if high is None else high for high in highs]),
+            lows,
+            array("d", [period.get("pop", nan) for period in periods]),
+            # Interned so the few distinct conditions are shared by every forecast in the cache.
+            tuple([sys.intern(period.get("weather")[0].get("description").capitalize()) for period in periods]),
+        )
+
+    def upcoming(self, now: float, count: int) -> range:
+        """
+        Returns the indexes of the first periods that haven't ended yet, in the local time of the location.
+
+        Args:
+            now: The current unix timestamp.
+            count: The max periods.
+        """
+        current: int = int(now + self.offset) // self.step
+        start: int = 0
+        while start < len(self.times) and (self.times[start] + self.offset) // self.step < current:
+            start += 1
+        return range(start, min(start + count, len(self.times)))
+
+    def period(self, index: int) -> Tuple[int, Optional[float], Optional[float], Optional[float], str]:
+        """
+        Returns the time, temperature or high, low, probability of precipitation and condition of a period.
+        """
+        numbers: List[Optional[float]] = [
+            None if isnan(column[index]) else column[index] for column in (self.temps, self.lows, self.pops)
+        ]
+        return (self.times[index], *numbers, self.conditions[index])
+
+    def _fields(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __sizeof__(self) -> int:
+        # The conditions are interned and shared by every forecast, so only their tuple is counted.
+        getsizeof = sys.getsizeof
+        return (
+            object.__sizeof__(self)
+            + getsizeof(self.times)
+            + getsizeof(self.temps)
+            + getsizeof(self.lows)
+            + getsizeof(self.pops)
+            + getsizeof(self.conditions)
+        )
+
+    def __reduce__(self) -> Tuple[type, Tuple[Any, ...]]:
+        return Forecast, self._fields()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("Forecast is immutable.")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("Forecast is immutable.")
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Forecast):
+            return NotImplemented
+        # NaN never equals itself, so the float columns are compared by their bytes.
+        return (self.step, self.offset, self.times, self.conditions) == (
+            other.step,
+            other.offset,
+            other.times,
+            other.conditions,
+        ) and all(
+            mine.tobytes() == theirs.tobytes()
+            for mine, theirs in ((self.temps, other.temps), (self.lows, other.lows), (self.pops, other.pops))
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.step, self.offset, self.times.tobytes(), self.conditions))
+
+    def __repr__(self) -> str:
+        return f"<Forecast {len(self.times)} x {self.step}s>"
+
+
+class WeatherSnapshot:
+    """
+    The current weather reduced to the fields the display needs, as soon as it is received.
+    Snapshots are immutable, so one can be cached and shared by every thread rendering it.
+
+    Attributes:
+        time: The time of the observation as a unix timestamp.
+        temp: The temperature in fahrenheit.
+        feels_like: The feels like temperature in fahrenheit.
+        humidity: The humidity in percent.
+        wind_speed: The wind speed in mph.
+        wind_deg: The wind direction in degrees, if known.
+        condition: The current condition. e.g. Light rain
+        summary: The summary of today's forecast, if the provider has one.
+        high: Today's high in fahrenheit, if the provider has one.
+        low: Today's low in fahrenheit, if the provider has one.
+        daily: The forecast of the coming days, if the provider has one.
+        hourly: The forecast of the coming hours, if the provider has one.
+    """
+
+    __slots__ = (
+        "time",
+        "temp",
+        "feels_like",
+        "humidity",
+        "wind_speed",
+        "wind_deg",
+        "condition",
+        "summary",
+        "high",
+        "low",
+        "daily",
+        "hourly",
+    )
+
+    def __init__(
+        self,
+        time: int,
+        temp: float,
+        feels_like: float,
+        humidity: Optional[int],
+        wind_speed: float,
+        wind_deg: Optional[int],
+        condition: str,
+        summary: Optional[str],
+        high: Optional[float],
+        low: Optional[float],
+        daily: Optional[Forecast] = None,
+        hourly: Optional[Forecast] = None,
+    ):
+        values = (time, temp, feels_like, humidity, wind_speed, wind_deg, condition, summary, high, low, daily, hourly)
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_onecall(cls, data: Dict[str, Any]) -> "WeatherSnapshot":
+        """
+        Takes the fields the display needs out of a One Call api response, with the
+        daily and hourly forecasts packed into arrays.
+
+        Args:
+            data: The decoded One Call response.
+
+        Returns:
+            The snapshot of the current weather, or raises WeatherNotFound if the response is missing it.
+        """
+        current: Optional[Dict[str, Any]] = data.get("current")
+        forecast: Optional[Dict[str, Any]] = data.get("daily")
+        if not current or not forecast:
+            log.error("JSON data does not have current or forecast keys")
+            raise WeatherNotFound("Unable to find the weather at this time.")
+
+        today: Dict[str, Any] = forecast[0]
+        offset: int = data.get("timezone_offset") or 0
+        hourly: Optional[List[Dict[str, Any]]] = data.get("hourly")
+        return cls(
+            time=current.get("dt"),
+            temp=current.get("temp"),
+            feels_like=current.get("feels_like"),
+            humidity=current.get("humidity"),
+            wind_speed=current.get("wind_speed"),
+            wind_deg=current.get("wind_deg"),
+            condition=current.get("weather")[0].get("description").capitalize(),
+            summary=today.get("weather")[0].get("description").capitalize(),
+            high=today.get("temp").get("max"),
+            low=today.get("temp").get("min"),
+            daily=Forecast.from_onecall(forecast, 86400, offset),
+            hourly=Forecast.from_onecall(hourly, 3600, offset) if hourly else None,
+        )
+
+    @classmethod
+    def from_weatherstack(cls, data: Dict[str, Any]) -> "WeatherSnapshot":
+        """
+        Takes the fields the display needs out of a Weatherstack current weather response,
+        requested in fahrenheit. It has no forecast, so there is no summary, high or low.
+
+        Args:
+            data: The decoded Weatherstack response.
+
+        Returns:
+            The snapshot of the current weather, or raises WeatherNotFound if the response is missing it.
+        """
+        current: Optional[Dict[str, Any]] = data.get("current")
+        if not current:
+            log.error("JSON data does not have current key: %s", data.get("error", {}).get("info"))
+            raise WeatherNotFound("Unable to find the weather at this time.")
+
+        descriptions: List[str] = current.get("weather_descriptions") or ["N/A"]
+        return cls(
+            time=data.get("location", {}).get("localtime_epoch"),
+            temp=current.get("temperature"),
+            feels_like=current.get("feelslike"),
+            humidity=current.get("humidity"),
+            wind_speed=current.get("wind_speed"),
+            wind_deg=current.get("wind_degree"),
+            condition=descriptions[0].capitalize(),
+            summary=None,
+            high=None,
+            low=None,
+        )
+
+    def _fields(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __sizeof__(self) -> int:
+        # The fields are numbers, strings and forecasts that measure themselves, so none are followed.
+        getsizeof = sys.getsizeof
+        return object.__sizeof__(self) + sum([getsizeof(getattr(self, name)) for name in self.__slots__])
+
+    def __reduce__(self) -> Tuple[type, Tuple[Any, ...]]:
+        # Pickles through __init__, since the slots can't be set on an immutable snapshot.
+        return WeatherSnapshot, self._fields()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("WeatherSnapshot is immutable.")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("WeatherSnapshot is immutable.")
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, WeatherSnapshot):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self) -> int:
+        return hash(self._fields())
+
+    def __repr__(self) -> str:
+        return f"<WeatherSnapshot {self.time} {self.temp}F {self.condition}>"
@@ -0,0 +1,208 @@
+from datetime import datetime, timezone
+from functools import lru_cache
+from string import Formatter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .snapshot import Forecast, WeatherSnapshot
+
+# The template of the default weather display, with {b} toggling bold.
+default_template = (
+    "{b}{place}{b} :: {condition} {temperature} (Humidity: {humidity}%) | {b}Feels like{b}: {feels_like} "
+    "| {b}Wind{b}: {wind_dir} at {wind} | {b}Today{b}: {summary}. High {high} - Low {low}"
+)
+
+
+# Shown in place of a value the weather provider doesn't have.
+missing = "N/A"
+
+
+def fahrenheit(value: Optional[float]) -> str:
+    return missing if value is None else f"{value:.1f}F"
+
+
+def celsius(value: Optional[float]) -> str:
+    return missing if value is None else f"{(value - 32) / 1.8:.1f}C"
+
+
+def mph(value: float) -> str:
+    return f"{value:.1f}mph"
+
+
+def kph(value: float) -> str:
+    return f"{value * 1.609344:.1f}kph"
+
+
+class Conditions:
+    """
+    The display fields of a weather api's data, computed lazily. A field is only computed
+    the first time a template asks for it, so conversions a template doesn't show are never made.
+
+    Attributes:
+        weather_api: The weather api with the location and data to display.
+        format: The display format, 1 for imperial first or 2 for metric first.
+    """
+
+    __slots__ = ("weather_api", "format", "_values")
+
+    def __init__(self, weather_api: Any, format: int = 1):
+        self.weather_api = weather_api
+        self.format = format
+        self._values: Dict[str, str] = {}
+
+    @property
+    def weather(self) -> WeatherSnapshot:
+        return self.weather_api.data
+
+    def both(self, imperial: str, metric: str) -> str:
+        """
+        Joins the imperial and metric field of a value in the order of the display format.
+        """
+        if self[imperial] == missing:
+            return missing
+        if self.format == 1:
+            return f"{self[imperial]}/{self[metric]}"
+        return f"{self[metric]}/{self[imperial]}"
+
+    def __getitem__(self, name: str) -> str:
+        value: Optional[str] = self._values.get(name)
+        if value is None:
+            value = self._values[name] = fields[name](self)
+        return value
+
+
+# Every field a template can use and how it is computed.
+fields: Dict[str, Callable[[Conditions], str]] = {
+    "b": lambda _: "\x02",
+    "location": lambda c: f"{c.weather_api.location}",
+    "region": lambda c: f"{c.weather_api.region}",
+    "place": lambda c: f"{c['location']}, {c['region']}",
+    "condition": lambda c: c.weather.condition,
+    "summary": lambda c: c.weather.summary or missing,
+    "humidity": lambda c: f"{c.weather.humidity}",
+    "wind_dir": lambda c: c.weather_api.format_directions(c.weather.wind_deg),
+    "temp_f": lambda c: fahrenheit(c.weather.temp),
+    "temp_c": lambda c: celsius(c.weather.temp),
+    "temperature": lambda c: c.both("temp_f", "temp_c"),
+    "feels_f": lambda c: fahrenheit(c.weather.feels_like),
+    "feels_c": lambda c: celsius(c.weather.feels_like),
+    "feels_like": lambda c: c.both("feels_f", "feels_c"),
+    "high_f": lambda c: fahrenheit(c.weather.high),
+    "high_c": lambda c: celsius(c.weather.high),
+    "high": lambda c: c.both("high_f", "high_c"),
+    "low_f": lambda c: fahrenheit(c.weather.low),
+    "low_c": lambda c: celsius(c.weather.low),
+    "low": lambda c: c.both("low_f", "low_c"),
+    "wind_mph": lambda c: mph(c.weather.wind_speed),
+    "wind_kph": lambda c: kph(c.weather.wind_speed),
+    "wind": lambda c: c.both("wind_mph", "wind_kph"),
+}
+
+
+class Template:
+    """
+    A display template parsed once into its literal text and the fields between it.
+    Templates use str.format syntax with the names in fields, e.g. {place} :: {temperature}
+
+    Attributes:
+        source: The template as it was written.
+        fields: The names of the fields the template uses, in order.
+    """
+
+    __slots__ = ("source", "fields", "_parts")
+
+    def __init__(self, source: str):
+        self.source = source
+        self._parts: List[Tuple[str, Optional[str], str]] = []
+        for literal, name, spec, conversion in Formatter().parse(source):
+            if name is not None and name not in fields:
+                raise ValueError(f"Unknown template field {{{name}}}.")
+            if conversion:
+                raise ValueError(f"Conversions aren't supported in template field {{{name}}}.")
+            if spec:
+                # Every field renders to a string, so a spec that can't format one fails here
+                # instead of when the weather is shown.
+                try:
+                    f"{missing:{spec}}"
+                except ValueError:
+                    raise ValueError(f"Invalid format spec in template field {{{name}:{spec}}}.") from None
+            self._parts.append((literal, name, spec or ""))
+        self.fields: Tuple[str, ...] = tuple(name for _, name, _ in self._parts if name is not None)
+
+    def render(self, conditions: Conditions) -> str:
+        """
+        Renders the template with the fields of the weather conditions it uses.
+
+        Args:
+            conditions: The conditions to take the fields from.
+
+        Returns:
+            The rendered display.
+        """
+        rendered: List[str] = []
+        for literal, name, spec in self._parts:
+            rendered.append(literal)
+            if name is not None:
+                # Supybot replaces the format builtin, so format specs are applied with an f-string.
+                rendered.append(f"{conditions[name]:{spec}}" if spec else conditions[name])
+
+        return "".join(rendered)
+
+    def __repr__(self) -> str:
+        return f"<Template {self.source!r}>"
+
+
+@lru_cache(maxsize=64)
+def compile_template(source: str) -> Template:
+    """
+    Parses a template, or returns the one already parsed from the same source.
+
+    Args:
+        source: The template. e.g. {b}{place}{b} :: {temperature}
+
+    Returns:
+        The parsed template, or raises a ValueError if it uses unknown fields, bad syntax or invalid format specs.
+    """
+    return Template(source)
+
+
+def temperatures(value: Optional[float], format: int = 1) -> str:
+    """
+    Joins the fahrenheit and celsius of a temperature in the order of the display format.
+    """
+    if value is None:
+        return missing
+    if format == 1:
+        return f"{fahrenheit(value)}/{celsius(value)}"
+    return f"{celsius(value)}/{fahrenheit(value)}"
+
+
+def render_forecast(weather_api: Any, forecast: Forecast, format: int, count: int, now: float) -> str:
+    """
+    Renders the coming days or hours of a forecast on one line, e.g.
+    New Orleans, LA :: Mon: Light rain 54.3F/12.4C - 42.7F/5.9C, 40% precip | Tue: ...
+
+    Args:
+        weather_api: The weather api with the location to display.
+        forecast: The daily or hourly forecast.
+        format: The display format, 1 for imperial first or 2 for metric first.
+        count: The max days or hours shown.
+        now: The current unix timestamp, the periods that already ended are skipped.
+
+    Returns:
+        The rendered forecast.
+    """
+    periods: List[str] = []
+    for index in forecast.upcoming(now, count):
+        time, temp, low, pop, condition = forecast.period(index)
+        local: datetime = datetime.fromtimestamp(time + forecast.offset, timezone.utc)
+        if forecast.step == 3600:
+            label: str = f"{local.hour % 12 or 12}{'am' if local.hour < 12 else 'pm'}"
+            temps: str = temperatures(temp, format)
+        else:
+            label = local.strftime("%a")
+            temps = f"{temperatures(temp, format)} - {temperatures(low, format)}"
+        precip: str = f", {pop:.0%} precip" if pop else ""
+        periods.append(f"\x02{label}\x02: {condition} {temps}{precip}")
+
+    place: str = f"\x02{weather_api.location}, {weather_api.region}\x02"
+    return f"{place} :: {' | '.join(periods) or missing}"
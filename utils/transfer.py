@@ -0,0 +1,138 @@
+import argparse
+import csv
+import json
+import os
+from os.path import isfile
+from typing import Any, Dict, Iterator, List, Tuple
+
+from marshmallow import ValidationError
+from peewee import DatabaseError
+from supybot import log
+
+from ..models.users import User, UserSchema, db, db_path
+
+# Configurable import settings that you can change through environment variables.
+# Every chunk of rows is written with one multi-row upsert in its own transaction.
+# Sqlite limits the variables in one statement, so keep chunk size * 6 columns under 32766.
+chunk_size = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+
+# The user fields that are exported and imported, in column order.
+user_fields: Tuple[str, ...] = ("nick", "host", "format", "location", "region", "coordinates")
+
+
+def file_format(path: str) -> str:
+    """
+    Returns the format of a users file from its extension, csv or jsonl.
+    """
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def export_users(path: str) -> int:
+    """
+    Writes every saved user to a JSONL or CSV file.
+
+    Args:
+        path: The file to write. Files ending in .csv are written as CSV, anything else as JSONL.
+
+    Returns:
+        The number of users written.
+    """
+    if not isfile(db_path) or not User.table_exists():
+        raise DatabaseError("Users db and table not created yet.")
+
+    rows = User.select(*(getattr(User, field) for field in user_fields)).order_by(User.id).tuples().iterator()
+    written = 0
+    with open(path, "w", encoding="utf-8", newline="") as out:
+        if file_format(path) == "csv":
+            writer = csv.writer(out)
+            writer.writerow(user_fields)
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+        else:
+            for row in rows:
+                out.write(json.dumps(dict(zip(user_fields, row))) + "\n")
+                written += 1
+
+    log.info("Exported %s users to %s", written, path)
+    return written
+
+
+def read_users(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Reads the rows of a JSONL or CSV users file, skipping blank lines.
+
+    Args:
+        path: The file to read.
+    """
+    with open(path, encoding="utf-8", newline="") as source:
+        if file_format(path) == "csv":
+            yield from csv.DictReader(source)
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def import_users(path: str, chunk_size: int = chunk_size) -> Tuple[int, int]:
+    """
+    Imports users from a JSONL or CSV file without any upstream calls. Every row is validated
+    with the UserSchema, and valid rows are upserted by nick in chunks, each in one transaction.
+    The users table is created if it doesn't exist yet.
+
+    Args:
+        path: The file to read. Files ending in .csv are read as CSV, anything else as JSONL.
+        chunk_size(optional): The number of rows written per transaction.
+
+    Returns:
+        The number of users imported and the number of invalid rows skipped.
+    """
+    User.create_tables()
+    schema = UserSchema()
+    imported, skipped = 0, 0
+    chunk: List[Dict[str, Any]] = []
+    for line, row in enumerate(read_users(path), start=1):
+        try:
+            user: Dict[str, Any] = schema.load({field: row.get(field) for field in user_fields})
+        except ValidationError as exc:
+            log.warning("Skipped row %s of %s: %s", line, path, exc.messages)
+            skipped += 1
+            continue
+
+        chunk.append(user)
+        if len(chunk) == chunk_size:
+            imported += _upsert(chunk)
+            chunk = []
+
+    if chunk:
+        imported += _upsert(chunk)
+
+    log.info("Imported %s users from %s, skipped %s", imported, path, skipped)
+    return imported, skipped
+
+
+def _upsert(chunk: List[Dict[str, Any]]) -> int:
+    with db.atomic():
+        User.insert_many(chunk).on_conflict(
+            conflict_target=[User.nick], preserve=[getattr(User, field) for field in user_fields[1:]],
+        ).execute()
+
+    return len(chunk)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Exports or imports the saved users as JSONL or CSV.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("file", help="users file, CSV if it ends in .csv, otherwise JSONL")
+    parser.add_argument("--chunk-size", type=int, default=chunk_size, help="rows written per transaction")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        print(f"Exported {export_users(args.file)} users to {args.file}")
+    else:
+        imported, skipped = import_users(args.file, args.chunk_size)
+        print(f"Imported {imported} users from {args.file}, skipped {skipped} invalid rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 import os
+import threading
 from os.path import abspath, dirname, isfile, join
-from typing import Union
+from typing import Dict, Optional, Union
 
 from dotenv import load_dotenv
 from peewee import DatabaseError
+from supybot import log
 
 from ..models.users import User
 
@@ -24,16 +26,119 @@ class AnonymousUser:
     format = 1
 
 
-def get_user(nick: str) -> Union[User, AnonymousUser]:
+class UserRecord:
     """
-    Gets a user out of the database. If not found, it returns a default user object.
+    A compact, read-only copy of a saved user kept in the user directory.
+
+    Attributes:
+        nick: The user's nick.
+        host: The user's host.
+        format: The display format of the user.
+        location: The city of the user's saved location.
+        region: The region or state of the user's saved location.
+        coordinates: The coordinates of the user's saved location.
+    """
+
+    __slots__ = ("nick", "host", "format", "location", "region", "coordinates")
+
+    def __init__(self, nick: str, host: str, format: int, location: str, region: str, coordinates: str):
+        self.nick = nick
+        self.host = host
+        self.format = format
+        self.location = location
+        self.region = region
+        self.coordinates = coordinates
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserRecord":
+        return cls(user.nick, user.host, user.format, user.location, user.region, user.coordinates)
+
+    def __repr__(self) -> str:
+        return f"<UserRecord {self.nick}>"
+
+
+class UserDirectory:
+    """
+    Process-local directory of every saved user, loaded from the users table in one query
+    when the plugin loads. Lookups by nick then cost a dictionary lookup instead of
+    checking for the database file and table and querying it on every command.
+    Writes to the users table must be written through with put().
+
+    Attributes:
+        loaded: Whether the directory was loaded from the database.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._users: Dict[str, UserRecord] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> int:
+        """
+        Loads every saved user from the users table, replacing what was loaded before.
+
+        Returns:
+            The number of users loaded.
+        """
+        if not isfile(db_path) or not User.table_exists():
+            raise DatabaseError("Users db and table not created yet.")
+
+        query = User.select(User.nick, User.host, User.format, User.location, User.region, User.coordinates)
+        users: Dict[str, UserRecord] = {row.nick: UserRecord.from_user(row) for row in query}
+        with self._lock:
+            self._users = users
+            self.loaded = True
+
+        log.info("Loaded %s users into the user directory", len(users))
+        return len(users)
+
+    def get(self, nick: str) -> Optional[UserRecord]:
+        return self._users.get(nick)
+
+    def put(self, user: User) -> None:
+        """
+        Writes a saved or updated user through to the directory.
+
+        Args:
+            user: The user model that was saved.
+        """
+        with self._lock:
+            self._users[user.nick] = UserRecord.from_user(user)
+
+    def clear(self) -> None:
+        """
+        Empties the directory, so lookups go to the database until it is loaded again.
+        """
+        with self._lock:
+            self._users = {}
+            self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __repr__(self) -> str:
+        return f"<UserDirectory {len(self)} users loaded={self.loaded}>"
+
+
+# The plugin loads the directory when it loads, or when the users table is created.
+directory = UserDirectory()
+
+
+def get_user(nick: str) -> Union[User, UserRecord, AnonymousUser]:
+    """
+    Gets a user out of the user directory, or the database if the directory isn't loaded.
+    If not found, it returns a default user object.
 
     Args:
         nick: the name of the user's nick.
 
     Returns:
-        A User model object or a default AnonymousUser.
+        A UserRecord, a User model object or a default AnonymousUser.
     """
+    if directory.loaded:
+        record: Optional[UserRecord] = directory.get(nick)
+        return AnonymousUser() if record is None else record
+
     user: Union[User, AnonymousUser]
     try:
         if not isfile(db_path) or not User.table_exists():
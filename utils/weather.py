@@ -1,13 +1,40 @@
 import os
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Union
+from functools import partial
+from typing import Any, Dict, Optional, Union
 
 import requests
 from supybot import log
 
 from ..models.users import User
+from .aiosessions import AsyncSessionPool, Response
 from .errors import LocationNotFound, WeatherNotFound
-from .users import AnonymousUser
+from .ratelimit import RateLimiter
+from .sessions import SessionPool, pool_maxsize
+from .snapshot import Forecast, WeatherSnapshot, decode
+from .templates import Conditions, Template, compile_template, default_template, render_forecast
+from .users import AnonymousUser, UserRecord
+
+# The api base urls can be pointed at another server, e.g. the stub server in benchmarks/.
+WS_URL = os.getenv("WS_API_URL", "http://api.weatherstack.com")
+OWM_URL = os.getenv("OWM_API_URL", "https://api.openweathermap.org")
+
+# Keep-alive connection pools shared by every WeatherAPI instance. The pool size
+# of each host can be changed through environment variables.
+shared_pool = SessionPool(
+    {
+        WS_URL: int(os.getenv("WS_POOL_MAXSIZE", pool_maxsize)),
+        OWM_URL: int(os.getenv("OWM_POOL_MAXSIZE", pool_maxsize)),
+    }
+)
+
+# The non-blocking counterpart of the shared pool for coroutines on the engine's event loop.
+# It uses the shared pool's sizes and circuit breakers.
+shared_async_pool = AsyncSessionPool(shared_pool)
+
+# Upstream quotas shared by every WeatherAPI instance, per provider and api key.
+shared_limiter = RateLimiter()
 
 
 class WeatherAPI(ABC):
@@ -15,13 +42,60 @@ class WeatherAPI(ABC):
     Base abstract class for weather APIs. This class can be subclassed to implement a new API
     service for weather data.
 
-    Contains 2 abstract methods that must be implemented in the child class.
+    Contains 6 abstract methods that must be implemented in the child class. The async ones
+    are the coroutine versions run on the engine's event loop, and must not block it.
 
     Attributes:
         query: The location to query for weather results.
+        session_pool: The pool of keep-alive connections used to send requests.
+        rate_limiter: The upstream quotas every request is taken from.
+        async_pool: The pool of keep-alive connections used to send requests from coroutines.
     """
 
     query: str
+    session_pool: SessionPool
+    rate_limiter: RateLimiter
+    async_pool: AsyncSessionPool
+
+    def __init__(
+        self,
+        query: str,
+        session_pool: Optional[SessionPool] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        async_pool: Optional[AsyncSessionPool] = None,
+    ):
+        self.query = query
+        self.session_pool = session_pool or shared_pool
+        self.rate_limiter = rate_limiter or shared_limiter
+        self.async_pool = async_pool or shared_async_pool
+
+    @abstractmethod
+    def set_location(self, user: Union[User, UserRecord, AnonymousUser]) -> None:
+        """
+        Should set the location, region and coordinates attributes for the user or query.
+        """
+        pass
+
+    @abstractmethod
+    async def set_location_async(self, user: Union[User, UserRecord, AnonymousUser]) -> None:
+        """
+        Should set the location, region and coordinates attributes for the user or query, without blocking.
+        """
+        pass
+
+    @abstractmethod
+    def fetch_weather(self) -> Any:
+        """
+        Should fetch and return the weather data for the coordinates that were set.
+        """
+        pass
+
+    @abstractmethod
+    async def fetch_weather_async(self) -> Any:
+        """
+        Should fetch and return the weather data for the coordinates that were set, without blocking.
+        """
+        pass
 
     @abstractmethod
     def find_current_weather(self, query: str) -> None:
@@ -31,7 +105,7 @@ class WeatherAPI(ABC):
         pass
 
     @abstractmethod
-    def display_format(self) -> str:
+    def display_format(self, format: int = 1, template: Optional[Template] = None) -> str:
         """
         Should format the weather data to be displayed on screen by a user.
         """
@@ -47,26 +121,54 @@ class OpenWeatherMapAPI(WeatherAPI):
         location: The city of the location queried.
         region: The region or state of location queried.
         coordinates: The coordinates of the location queried.
-        data: The current weather data received back from the api.
+        data: The snapshot of the current weather data received back from the api.
+        forecasts: Whether its data has the daily and hourly forecasts.
     """
 
-    def __init__(self, query: str):
-        self.query = query
+    forecasts = True
+
+    def __init__(
+        self,
+        query: str,
+        session_pool: Optional[SessionPool] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        async_pool: Optional[AsyncSessionPool] = None,
+    ):
+        super().__init__(query, session_pool, rate_limiter, async_pool)
         self.location: Union[None, str] = None
         self.region: Union[None, str] = None
         self.coordinates: Union[None, str] = None
-        self.data: Union[None, Dict[str, Any]] = None
+        self.data: Optional[WeatherSnapshot] = None
 
     def find_geolocation(self) -> None:
         """
         Finds the location and coordinates and sets the class atttributes according to user's query.
         """
-        payload = {
+        payload: Dict[str, str] = self._geolocation_payload()
+        acquire = partial(self.rate_limiter.acquire, "weatherstack", payload["access_key"])
+        # https requires the paid tier, so we use http here.
+        response: requests.Response = self.session_pool.get(f"{WS_URL}/current", params=payload, acquire=acquire)
+        self._set_geolocation(response)
+
+    async def find_geolocation_async(self) -> None:
+        """
+        Coroutine version of find_geolocation that doesn't block the event loop.
+        """
+        payload: Dict[str, str] = self._geolocation_payload()
+        acquire = partial(self.rate_limiter.acquire, "weatherstack", payload["access_key"])
+        response: Response = await self.async_pool.get(f"{WS_URL}/current", params=payload, acquire=acquire)
+        self._set_geolocation(response)
+
+    def _geolocation_payload(self) -> Dict[str, str]:
+        return {
             "access_key": os.getenv("WS_API_KEY"),
             "query": self.query,
         }
-        # https requires the paid tier, so we use http here.
-        response: requests.Response = requests.get("http://api.weatherstack.com/current", params=payload)
+
+    def _set_geolocation(self, response: Union[requests.Response, Response]) -> None:
+        """
+        Sets the location attributes from the response of a geolocation request.
+        """
         response.raise_for_status()
 
         res_data: Dict[str, Any] = response.json()
@@ -121,9 +223,13 @@ class OpenWeatherMapAPI(WeatherAPI):
 
         return directions[formula]
 
-    def find_current_weather(self, user: Union[User, AnonymousUser]) -> None:
+    def set_location(self, user: Union[User, UserRecord, AnonymousUser]) -> None:
         """
-        Returns the current weather found of a user's location query and sets the data class attribute.
+        Sets the location attributes from the user's saved location when there is no query,
+        otherwise it finds the geolocation of the query.
+
+        Args:
+            user: The user object found in the db or an anonymous user object.
         """
         if not self.query and not isinstance(user, AnonymousUser):
             self.location = user.location
@@ -132,69 +238,152 @@ class OpenWeatherMapAPI(WeatherAPI):
         else:
             self.find_geolocation()
 
+    async def set_location_async(self, user: Union[User, UserRecord, AnonymousUser]) -> None:
+        """
+        Coroutine version of set_location that doesn't block the event loop.
+
+        Args:
+            user: The user object found in the db or an anonymous user object.
+        """
+        if not self.query and not isinstance(user, AnonymousUser):
+            self.set_location(user)
+        else:
+            await self.find_geolocation_async()
+
+    def fetch_weather(self) -> WeatherSnapshot:
+        """
+        Fetches the current weather data for the coordinates that were set.
+
+        Returns:
+            The snapshot of the weather data received back from the api.
+        """
+        payload: Dict[str, str] = self._onecall_payload()
+        acquire = partial(self.rate_limiter.acquire, "openweathermap", payload["appid"])
+        response: requests.Response = self.session_pool.get(
+            f"{OWM_URL}/data/2.5/onecall", params=payload, acquire=acquire
+        )
+        response.raise_for_status()
+
+        return WeatherSnapshot.from_onecall(decode(response))
+
+    async def fetch_weather_async(self) -> WeatherSnapshot:
+        """
+        Coroutine version of fetch_weather that doesn't block the event loop.
+        """
+        payload: Dict[str, str] = self._onecall_payload()
+        acquire = partial(self.rate_limiter.acquire, "openweathermap", payload["appid"])
+        response: Response = await self.async_pool.get(f"{OWM_URL}/data/2.5/onecall", params=payload, acquire=acquire)
+        response.raise_for_status()
+
+        return WeatherSnapshot.from_onecall(decode(response))
+
+    def _onecall_payload(self) -> Dict[str, str]:
         lat, long = self.coordinates.split(",")
-        payload = {
-            "exclude": "minutely,hourly",
+        return {
+            "exclude": "minutely",
             "units": "imperial",
             "appid": os.getenv("OWM_API_KEY"),
             "lat": lat,
             "lon": long,
         }
-        response = requests.get(f"https://api.openweathermap.org/data/2.5/onecall", params=payload)
-        response.raise_for_status()
 
-        self.data: Dict[str, Any] = response.json()
+    def find_current_weather(self, user: Union[User, UserRecord, AnonymousUser]) -> None:
+        """
+        Returns the current weather found of a user's location query and sets the data class attribute.
+        """
+        self.set_location(user)
+        self.data: WeatherSnapshot = self.fetch_weather()
 
-    def display_format(self, format: int = 1) -> str:
+    def display_format(self, format: int = 1, template: Optional[Template] = None) -> str:
         """
         Takes the data that was queried and formats it to display to the user.
 
         Args:
             format(optional): The format you want to display the weather with.
                 e.g. imperial first or metric - F/C or C/F
+            template(optional): The template to display the weather with, the default template if not given.
 
         Returns:
             A formatted string to display of the current weather.
         """
-        current: Dict[Union[str, float]] = self.data.get("current")
-        forecast: Dict[str, List[Dict]] = self.data.get("daily")
-        if not current or not forecast:
-            log.error("JSON data does not have current or forecast keys")
+        if self.data is None:
             raise WeatherNotFound("Unable to find the weather at this time.")
 
-        temp: float = current.get("temp")
-        feels: float = current.get("feels_like")
-        wind_spd: float = current.get("wind_speed")
-        forecast_high: float = forecast[0].get("temp").get("max")
-        forecast_low: float = forecast[0].get("temp").get("min")
-
-        # Format to display imperial or metric units first.
-        # e.g. 1 = imperial, 2 = metric, default is imperial.
-        if format == 1:
-            temperature = f"{temp:.1f}F/{(temp - 32)/1.8:.1f}C"
-            feels_like = f"{feels:.1f}F/{(feels - 32)/1.8:.1f}C"
-            high = f"{forecast_high:.1f}F/{(forecast_high - 32)/1.8:.1f}C"
-            low = f"{forecast_low:.1f}F/{(forecast_low - 32)/1.8:.1f}C"
-            wind = f"{wind_spd:.1f}mph/{wind_spd * 1.609344:.1f}kph"
-        else:
-            temperature = f"{(temp - 32)/1.8:.1f}C/{temp:.1f}F"
-            feels_like = f"{(feels - 32)/1.8:.1f}C/{feels:.1f}F"
-            high = f"{(forecast_high - 32)/1.8:.1f}C/{forecast_high:.1f}F"
-            low = f"{(forecast_low - 32)/1.8:.1f}C/{forecast_low:.1f}F"
-            wind = f"{wind_spd * 1.609344:.1f}kph/{wind_spd:.1f}mph"
-
-        place = f"{self.location}, {self.region}"
-        condition: str = current.get("weather")[0].get("description").capitalize()
-        humidity = f"{current.get('humidity')}"
-        wind_dir: str = self.format_directions(current.get("wind_deg"))
-        summary: str = forecast[0].get("weather")[0].get("description").capitalize()
-
-        display = (
-            f"\x02{place}\x02 :: {condition} {temperature} (Humidity: {humidity}%) | \x02Feels like\x02: {feels_like} "
-            f"| \x02Wind\x02: {wind_dir} at {wind} | \x02Today\x02: {summary}. High {high} - Low {low}"
-        )
+        return (template or compile_template(default_template)).render(Conditions(self, format))
 
-        return display
+    def forecast_format(self, hourly: bool = False, format: int = 1, count: int = 5) -> str:
+        """
+        Takes the forecast of the data that was queried and formats it to display to the user.
+
+        Args:
+            hourly(optional): Shows the coming hours instead of the coming days.
+            format(optional): The format you want to display the weather with.
+                e.g. imperial first or metric - F/C or C/F
+            count(optional): The max days or hours to show.
+
+        Returns:
+            A formatted string to display of the forecast.
+        """
+        forecast: Optional[Forecast] = None
+        if self.data is not None:
+            forecast = self.data.hourly if hourly else self.data.daily
+        if forecast is None:
+            raise WeatherNotFound("Unable to find the forecast at this time.")
+
+        return render_forecast(self, forecast, format, count, time.time())
 
     def __repr__(self) -> str:
         return f"<OpenWeatherMapAPI {self.query}>"
+
+
+class WeatherstackAPI(OpenWeatherMapAPI):
+    """
+    Weather API class that gets the current weather from Weatherstack instead of OpenWeatherMap,
+    as a second provider to hedge with. Weatherstack's current weather has no forecast, so the
+    summary, high and low of today are left out of its data.
+
+    Attributes:
+        query: The location to query for weather results. e.g. 70119 or New Orleans, LA
+        location: The city of the location queried.
+        region: The region or state of location queried.
+        coordinates: The coordinates of the location queried.
+        data: The snapshot of the current weather data received back from the api.
+        forecasts: Whether its data has the daily and hourly forecasts.
+    """
+
+    forecasts = False
+
+    def fetch_weather(self) -> WeatherSnapshot:
+        """
+        Fetches the current weather data for the coordinates that were set.
+
+        Returns:
+            The snapshot of the weather data received back from the api.
+        """
+        payload: Dict[str, str] = self._current_payload()
+        acquire = partial(self.rate_limiter.acquire, "weatherstack", payload["access_key"])
+        response: requests.Response = self.session_pool.get(f"{WS_URL}/current", params=payload, acquire=acquire)
+        response.raise_for_status()
+
+        return WeatherSnapshot.from_weatherstack(decode(response))
+
+    async def fetch_weather_async(self) -> WeatherSnapshot:
+        """
+        Coroutine version of fetch_weather that doesn't block the event loop.
+        """
+        payload: Dict[str, str] = self._current_payload()
+        acquire = partial(self.rate_limiter.acquire, "weatherstack", payload["access_key"])
+        response: Response = await self.async_pool.get(f"{WS_URL}/current", params=payload, acquire=acquire)
+        response.raise_for_status()
+
+        return WeatherSnapshot.from_weatherstack(decode(response))
+
+    def _current_payload(self) -> Dict[str, str]:
+        return {
+            "access_key": os.getenv("WS_API_KEY"),
+            "query": self.coordinates,
+            "units": "f",
+        }
+
+    def __repr__(self) -> str:
+        return f"<WeatherstackAPI {self.query}>"